@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Description: benchmark suite for IniMotif
+
+Synthetic FASTA/FASTQ files with planted motifs are generated at several scales, the main
+entry points (kmer counting, top kmers, motif scanning, html output, masking, async kmer
+counting and logo drawing) are timed, and the results are saved as json and compared against
+a stored baseline so that performance regressions show up.
+
+Usage:
+    python inimotif_bench.py gen --n-seq 100000 --file-type fastq out.fq
+    python inimotif_bench.py run --scales 1k,10k --out bench.json --baseline bench_baseline.json
+    python inimotif_bench.py run --scales 1k --out bench_baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from inimotif_metrics import get_peak_rss
+
+# number of reads for each benchmark scale
+SCALES = {'1k': 10**3, '10k': 10**4, '100k': 10**5, '1m': 10**6, '10m': 10**7}
+
+DNA_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+REVCOM_TABLE = bytes.maketrans(b'ACGTN', b'TGCAN')
+
+
+def gen_planted_seq_file(file_path, n_seq=100, min_len=30, max_len=60, motif='TTAGGCATCA',
+                         plant_rate=0.3, n_rate=0.01, file_type='fasta', seed=0, batch_size=50000):
+    """
+    generate random DNA sequences with a planted motif, extends test_gen_rand_fa_file in
+    kmer_count_async.py to large scales, FASTQ output and N content
+    Args:
+        file_path: output file path, gzip compressed if it ends with ".gz"
+        n_seq: number of sequences (reads)
+        min_len: minimum sequence length, inclusive
+        max_len: maximum sequence length, inclusive, should be no shorter than the motif
+        motif: motif planted into the sequences, forward or reverse complement with equal chance
+        plant_rate: fraction of sequences carrying the motif
+        n_rate: fraction of bases replaced by "N"
+        file_type: fasta or fastq
+        seed: random seed
+        batch_size: number of sequences generated and written at a time
+    """
+    import gzip
+    assert file_type in ('fasta', 'fastq'), f'Unknown file_type={file_type}'
+    assert len(motif) <= min_len <= max_len
+    rng = np.random.default_rng(seed)
+    motif_fw = motif.upper().encode()
+    motif_rc = motif_fw.translate(REVCOM_TABLE)[::-1]
+
+    fh = gzip.open(file_path, 'wb') if file_path.endswith('.gz') else open(file_path, 'wb')
+    with fh:
+        for st in range(0, n_seq, batch_size):
+            n = min(batch_size, n_seq - st)
+            len_arr = rng.integers(min_len, max_len + 1, size=n)
+            seq_arr = DNA_BASES[rng.integers(0, 4, size=int(len_arr.sum()))]
+            seq_arr[rng.random(len(seq_arr)) < n_rate] = ord('N')
+            offsets = np.concatenate(([0], np.cumsum(len_arr)))
+
+            # plant motif at a random position of the selected sequences
+            for i in np.where(rng.random(n) < plant_rate)[0]:
+                pos = offsets[i] + rng.integers(0, len_arr[i] - len(motif_fw) + 1)
+                tmp_motif = motif_fw if rng.random() < 0.5 else motif_rc
+                seq_arr[pos:pos + len(tmp_motif)] = np.frombuffer(tmp_motif, dtype=np.uint8)
+
+            seq_bytes = seq_arr.tobytes()
+            lines = []
+            for i in range(n):
+                seq = seq_bytes[offsets[i]:offsets[i + 1]]
+                if file_type == 'fasta':
+                    lines.append(b'>seq%d\n%s\n' % (st + i, seq))
+                else:
+                    lines.append(b'@seq%d\n%s\n+\n%s\n' % (st + i, seq, b'I' * len(seq)))
+            fh.write(b''.join(lines))
+
+
+# benchmark cases
+# each case takes the input file and parameters, does the untimed setup work and returns the
+# callable to be timed
+def _case_kmer_counter_scan_file(in_file, para):
+    from inimotif_core import KmerCounter
+    kc = KmerCounter(para['kmer_len'])
+    return lambda: kc.scan_file(in_file)
+
+
+def _case_get_top_kmers(in_file, para):
+    from inimotif_core import KmerCounter
+    kc = KmerCounter(para['kmer_len'])
+    kc.scan_file(in_file)
+    return lambda: kc.get_top_kmers()
+
+
+def _get_motif_manager(in_file, para):
+    from inimotif_core import KmerCounter, MotifManager
+    kc = KmerCounter(para['kmer_len'])
+    kc.scan_file(in_file)
+    return MotifManager(kc, n_max_mutation=para['n_max_mutation'])
+
+
+def _case_motif_manager_scan_file(in_file, para):
+    mm = _get_motif_manager(in_file, para)
+    return lambda: mm.scan_file(in_file)
+
+
+def _case_output_match_html(in_file, para):
+    mm = _get_motif_manager(in_file, para)
+    outfile = os.path.join(para['work_dir'], 'motif_match.html')
+    return lambda: mm.output_match_html(in_file, outfile=outfile)
+
+
+def _case_masker_mask_file(in_file, para):
+    from inimotif_util import Masker
+    masker = Masker()
+    masker.add_reppat('A', 6, True)
+    masker.add_reppat('CA', 4, True)
+    masker.add_motif(para['motif'], 1, True)
+    out_file = os.path.join(para['work_dir'], 'masked.fasta')
+    return lambda: masker.mask_file(in_file, out_file)
+
+
+def _case_count_kmer(in_file, para):
+    from kmer_count_async import count_kmer
+    return lambda: count_kmer(in_file, para['kmer_len'], out_dir=para['work_dir'])
+
+
+def _case_draw_logo(in_file, para):
+    from dna_logo import Logo
+    rng = np.random.default_rng(0)
+    count_mat = rng.integers(0, 1000, size=(para['kmer_len'], 4))
+    out_file = os.path.join(para['work_dir'], 'logo.png')
+    return lambda: Logo(count_mat=count_mat, out_logo_file=out_file).draw_logo()
+
+
+BENCH_CASES = {
+    'KmerCounter.scan_file': _case_kmer_counter_scan_file,
+    'KmerCounter.get_top_kmers': _case_get_top_kmers,
+    'MotifManager.scan_file': _case_motif_manager_scan_file,
+    'MotifManager.output_match_html': _case_output_match_html,
+    'Masker.mask_file': _case_masker_mask_file,
+    'count_kmer': _case_count_kmer,
+    'Logo.draw_logo': _case_draw_logo,
+}
+
+
+def _run_case(case_name, in_file, para):
+    # run one benchmark case, executed in a fresh process such that the peak memory is per case
+    with tempfile.TemporaryDirectory() as work_dir:
+        para = dict(para, work_dir=work_dir)
+        func = BENCH_CASES[case_name](in_file, para)
+        rss_before = get_peak_rss()
+        wall_st, cpu_st = time.perf_counter(), time.process_time()
+        func()
+        wall_time, cpu_time = time.perf_counter() - wall_st, time.process_time() - cpu_st
+        rss_after = get_peak_rss()
+
+    res = {'wall_time': wall_time, 'cpu_time': cpu_time, 'peak_rss_mb': rss_after, 'peak_rss_increase_mb': None}
+    if rss_after is not None:
+        res['peak_rss_increase_mb'] = rss_after - rss_before
+    return res
+
+
+def run_benchmarks(scales=('1k', '10k'), case_names=None, data_dir='./bench_data', kmer_len=8,
+                   motif='TTAGGCATCA', n_max_mutation=1, min_len=30, max_len=60, n_rate=0.01, n_repeat=1):
+    """
+    run benchmark cases on synthetic data sets
+    Args:
+        scales: keys of SCALES, data set sizes to be benchmarked
+        case_names: keys of BENCH_CASES, all cases if None
+        data_dir: directory of synthetic data sets, generated data sets are reused
+        kmer_len: kmer length used by the cases
+        motif: planted motif
+        n_max_mutation: maximum number of mutations for motif scanning and masking
+        min_len: minimum read length
+        max_len: maximum read length
+        n_rate: fraction of "N" bases
+        n_repeat: number of repeats for each case, the fastest run is reported
+    Returns:
+        a dictionary that can be saved as json
+    """
+    if case_names is None:
+        case_names = list(BENCH_CASES.keys())
+    for case_name in case_names:
+        assert case_name in BENCH_CASES, f'Unknown benchmark case {case_name}, should be one of {list(BENCH_CASES)}'
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    para = {'kmer_len': kmer_len, 'motif': motif, 'n_max_mutation': n_max_mutation}
+    res_dict = {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                         'n_cpu': os.cpu_count(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                         'min_len': min_len, 'max_len': max_len, 'n_rate': n_rate, **para},
+                'cases': {}}
+    mp_context = multiprocessing.get_context('spawn')
+    for scale in scales:
+        n_seq = SCALES[scale]
+        in_file = os.path.join(data_dir, f'bench_{scale}_{min_len}_{max_len}_{motif}.fasta')
+        if not os.path.exists(in_file):
+            print(f'Generating {in_file}')
+            gen_planted_seq_file(in_file, n_seq, min_len=min_len, max_len=max_len, motif=motif, n_rate=n_rate)
+
+        for case_name in case_names:
+            print(f'Running {case_name} scale={scale}')
+            run_res_list = []
+            for _ in range(n_repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+                    run_res_list.append(executor.submit(_run_case, case_name, in_file, para).result())
+            res = min(run_res_list, key=lambda x: x['wall_time'])
+            res['n_seq'] = n_seq
+            res['seq_per_sec'] = n_seq / res['wall_time'] if res['wall_time'] > 0 else None
+            res_dict['cases'][f'{case_name}/{scale}'] = res
+    return res_dict
+
+
+def compare_with_baseline(res_dict, baseline_dict, time_tol=0.2, mem_tol=0.2):
+    """
+    compare benchmark results with a baseline
+    Args:
+        res_dict: current benchmark results
+        baseline_dict: baseline benchmark results
+        time_tol: relative increase of wall time reported as regression
+        mem_tol: relative increase of peak memory reported as regression
+    Returns:
+        a list of (case, metric, baseline value, current value, ratio, regression flag)
+    """
+    cmp_list = []
+    for case, res in res_dict['cases'].items():
+        if case not in baseline_dict['cases']:
+            continue
+        base_res = baseline_dict['cases'][case]
+        for metric, tol in (('wall_time', time_tol), ('peak_rss_mb', mem_tol)):
+            val, base_val = res.get(metric), base_res.get(metric)
+            if val is None or not base_val:
+                continue
+            ratio = val / base_val
+            cmp_list.append((case, metric, base_val, val, ratio, ratio > 1 + tol))
+    return cmp_list
+
+
+def print_results(res_dict, cmp_list=None):
+    print(f'{"case":<45}{"wall(s)":>10}{"cpu(s)":>10}{"rss(MB)":>10}{"seq/s":>12}')
+    for case, res in res_dict['cases'].items():
+        rss = res['peak_rss_mb']
+        rss_str = f'{rss:>10.1f}' if rss is not None else f'{"NA":>10}'
+        print(f'{case:<45}{res["wall_time"]:>10.3f}{res["cpu_time"]:>10.3f}{rss_str}{res["seq_per_sec"]:>12.0f}')
+    if cmp_list is None:
+        return
+    print()
+    print(f'{"case":<45}{"metric":>14}{"baseline":>12}{"current":>12}{"ratio":>8}')
+    for case, metric, base_val, val, ratio, flag in cmp_list:
+        tmpstr = '  REGRESSION' if flag else ''
+        print(f'{case:<45}{metric:>14}{base_val:>12.3f}{val:>12.3f}{ratio:>8.2f}{tmpstr}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='IniMotif benchmark suite')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    gen_parser = subparsers.add_parser('gen', help='generate a synthetic data set with a planted motif')
+    gen_parser.add_argument('out_file', help='output file, gzip compressed if it ends with .gz')
+    gen_parser.add_argument('--n-seq', type=int, default=1000, help='number of sequences')
+    gen_parser.add_argument('--min-len', type=int, default=30, help='minimum sequence length')
+    gen_parser.add_argument('--max-len', type=int, default=60, help='maximum sequence length')
+    gen_parser.add_argument('--motif', default='TTAGGCATCA', help='planted motif')
+    gen_parser.add_argument('--plant-rate', type=float, default=0.3, help='fraction of sequences with the motif')
+    gen_parser.add_argument('--n-rate', type=float, default=0.01, help='fraction of N bases')
+    gen_parser.add_argument('--file-type', default='fasta', choices=['fasta', 'fastq'])
+    gen_parser.add_argument('--seed', type=int, default=0)
+
+    run_parser = subparsers.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('--scales', default='1k,10k', help=f'comma separated scales from {list(SCALES)}')
+    run_parser.add_argument('--cases', default=None, help=f'comma separated cases from {list(BENCH_CASES)}')
+    run_parser.add_argument('--data-dir', default='./bench_data', help='directory of synthetic data sets')
+    run_parser.add_argument('--kmer-len', type=int, default=8)
+    run_parser.add_argument('--motif', default='TTAGGCATCA', help='planted motif')
+    run_parser.add_argument('--min-len', type=int, default=30, help='minimum sequence length')
+    run_parser.add_argument('--max-len', type=int, default=60, help='maximum sequence length')
+    run_parser.add_argument('--n-rate', type=float, default=0.01, help='fraction of N bases')
+    run_parser.add_argument('--repeat', type=int, default=1, help='number of repeats, fastest run is reported')
+    run_parser.add_argument('--out', default='bench_results.json', help='output json file')
+    run_parser.add_argument('--baseline', default=None, help='baseline json file to compare with')
+    run_parser.add_argument('--time-tol', type=float, default=0.2, help='relative wall time increase reported as regression')
+    run_parser.add_argument('--mem-tol', type=float, default=0.2, help='relative peak memory increase reported as regression')
+
+    args = parser.parse_args()
+    if args.command == 'gen':
+        gen_planted_seq_file(args.out_file, args.n_seq, min_len=args.min_len, max_len=args.max_len, motif=args.motif,
+                             plant_rate=args.plant_rate, n_rate=args.n_rate, file_type=args.file_type, seed=args.seed)
+        return
+
+    scales = args.scales.split(',')
+    for scale in scales:
+        assert scale in SCALES, f'Unknown scale {scale}, should be one of {list(SCALES)}'
+    case_names = args.cases.split(',') if args.cases else None
+    res_dict = run_benchmarks(scales, case_names, data_dir=args.data_dir, kmer_len=args.kmer_len, motif=args.motif,
+                              min_len=args.min_len, max_len=args.max_len, n_rate=args.n_rate, n_repeat=args.repeat)
+    with open(args.out, 'w') as fh:
+        json.dump(res_dict, fh, indent=2)
+
+    cmp_list = None
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline_dict = json.load(fh)
+        cmp_list = compare_with_baseline(res_dict, baseline_dict, args.time_tol, args.mem_tol)
+    print_results(res_dict, cmp_list)
+
+    if cmp_list and any(x[-1] for x in cmp_list):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Description: headless batch command line interface of IniMotif
+
+Runs many ChIP-seq / SELEX-seq data sets listed in a manifest through one shared process pool.
+The manifest is a json list or json lines (one data set per line), read from files or stdin ("-").
+The keys of a data set are the parameters of ChipSeqProcessor / SelexSeqProcessor, e.g.
+
+    {"type": "chip", "file_name": "NF1-3.fa", "identifier": "NF1", "min_kmer_len": 6, "max_kmer_len": 8}
+    {"type": "selex", "file_name_arr": ["r1.fa", "r2.fa", "r3.fa"], "identifier": "TF1",
+     "min_selex_round": 1, "max_selex_round": 3, "min_kmer_len": 6, "max_kmer_len": 8}
+
+Missing parameters are taken from the command line options. Usage:
+    python inimotif_cli.py -j 32 --max-memory 200 --out-dir results manifest.jsonl
+    cat manifest.jsonl | python inimotif_cli.py -j 32 -
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+DATASET_TYPES = ('chip', 'selex')
+
+
+def read_manifest(fh):
+    """
+    read data sets from a manifest file handle, either a json list or json lines
+    Returns:
+        a list of dictionaries
+    """
+    content = fh.read()
+    if content.lstrip().startswith('['):
+        return json.loads(content)
+    dataset_list = []
+    for i_line, line in enumerate(content.splitlines()):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            dataset_list.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            raise ValueError(f'Invalid json in manifest line {i_line+1}: {e}')
+    return dataset_list
+
+
+def prepare_dataset(dataset, defaults):
+    """
+    check a data set and fill in missing parameters
+    Args:
+        dataset: dictionary from the manifest
+        defaults: default parameters from the command line
+    Returns:
+        a new dictionary with "type", "identifier", "out_dir" and the processor parameters
+    """
+    dataset = dict(dataset)
+    dataset_type = dataset.get('type', 'selex' if 'file_name_arr' in dataset else 'chip')
+    if dataset_type not in DATASET_TYPES:
+        raise ValueError(f'Unknown data set type {dataset_type}, should be one of {DATASET_TYPES}')
+    dataset['type'] = dataset_type
+
+    if dataset_type == 'chip':
+        if 'file_name' not in dataset:
+            raise ValueError('ChIP-seq data set needs "file_name"')
+        file_list = [dataset['file_name']]
+    else:
+        if 'file_name_arr' not in dataset:
+            raise ValueError('SELEX-seq data set needs "file_name_arr"')
+        file_list = dataset['file_name_arr']
+        dataset.setdefault('min_selex_round', 1)
+        dataset.setdefault('max_selex_round', dataset['min_selex_round'] + len(file_list) - 1)
+        n_round = dataset['max_selex_round'] - dataset['min_selex_round'] + 1
+        if n_round != len(file_list):
+            raise ValueError(f'{len(file_list)} files given for {n_round} SELEX rounds')
+
+    if 'identifier' not in dataset:
+        dataset['identifier'] = os.path.basename(file_list[0]).split('.')[0]
+    for key, val in defaults.items():
+        dataset.setdefault(key, val)
+    if 'out_dir' not in dataset:
+        dataset['out_dir'] = os.path.join(defaults.get('base_out_dir', '.'), dataset['identifier'])
+    dataset.pop('base_out_dir', None)
+    return dataset
+
+
+def _init_worker(max_memory_bytes):
+    # limit the address space of a worker process such that a large data set fails with MemoryError
+    # instead of bringing down the whole node
+    if max_memory_bytes and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+
+
+def run_dataset(dataset):
+    """
+    run a data set in a worker process, output of the processor goes to inimotif.log in its output directory
+    Returns:
+        a dictionary with the status of the run
+    """
+    from inimotif_main import ChipSeqProcessor, SelexSeqProcessor
+
+    dataset = dict(dataset)
+    dataset_type = dataset.pop('type')
+    res = {'identifier': dataset['identifier'], 'type': dataset_type, 'out_dir': dataset['out_dir'],
+           'status': 'done', 'error': None}
+    wall_st = time.perf_counter()
+    try:
+        if not os.path.exists(dataset['out_dir']):
+            os.makedirs(dataset['out_dir'])
+        log_file = os.path.join(dataset['out_dir'], 'inimotif.log')
+        with open(log_file, 'w') as log_fh, contextlib.redirect_stdout(log_fh), contextlib.redirect_stderr(log_fh):
+            if dataset_type == 'chip':
+                processor = ChipSeqProcessor(**dataset)
+            else:
+                processor = SelexSeqProcessor(**dataset)
+            processor.run()
+    except Exception as e:
+        res['status'] = 'failed'
+        res['error'] = f'{type(e).__name__}: {e}'
+        res['traceback'] = traceback.format_exc()
+        with open(os.path.join(dataset['out_dir'], 'inimotif.log'), 'a') as log_fh:
+            log_fh.write(res['traceback'])
+    res['wall_time'] = time.perf_counter() - wall_st
+    return res
+
+
+def run_batch(dataset_list, n_jobs=1, max_memory_gb=None):
+    """
+    run all data sets through one shared process pool, failed data sets do not stop the batch
+    Args:
+        dataset_list: list of prepared data sets, see prepare_dataset
+        n_jobs: number of data sets processed concurrently
+        max_memory_gb: memory limit of the whole batch in GB, split evenly between the workers
+    Returns:
+        a list of run status dictionaries in the order of dataset_list
+    """
+    max_memory_bytes = int(max_memory_gb * 2**30 / n_jobs) if max_memory_gb else None
+    n_dataset = len(dataset_list)
+    res_list = [None] * n_dataset
+    pending = list(range(n_dataset))[::-1]
+    n_finished = 0
+
+    def report(i, res):
+        nonlocal n_finished
+        res_list[i] = res
+        n_finished += 1
+        if res['status'] == 'done':
+            print(f'[{n_finished}/{n_dataset}] done {res["identifier"]} ({res["wall_time"]:.1f}s)', flush=True)
+        else:
+            print(f'[{n_finished}/{n_dataset}] FAILED {res["identifier"]}: {res["error"]}', flush=True)
+
+    while pending:
+        running = {}
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(max_memory_bytes,)) as executor:
+                while pending or running:
+                    # only keep n_jobs data sets in flight, such that the start message means started
+                    while pending and len(running) < n_jobs:
+                        i = pending.pop()
+                        try:
+                            future = executor.submit(run_dataset, dataset_list[i])
+                        except BrokenProcessPool:
+                            # the pool broke before the data set was submitted, it is run in the next pool
+                            pending.append(i)
+                            raise
+                        print(f'[{n_finished}/{n_dataset}] start {dataset_list[i]["identifier"]}', flush=True)
+                        running[future] = i
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        report(running[future], future.result())
+                        del running[future]
+        except BrokenProcessPool:
+            # a worker was killed (e.g. by the OOM killer), the data sets in flight are marked as failed
+            # and the remaining data sets continue in a new pool
+            for future, i in running.items():
+                if future.done() and future.exception() is None:
+                    report(i, future.result())
+                else:
+                    report(i, {'identifier': dataset_list[i]['identifier'], 'type': dataset_list[i]['type'],
+                               'out_dir': dataset_list[i]['out_dir'], 'status': 'failed',
+                               'error': 'worker process terminated abruptly', 'wall_time': None})
+    return res_list
+
+
+def write_summary(res_list, out_file):
+    with open(out_file, 'w') as fh:
+        fh.write('identifier\ttype\tstatus\twall_time\tout_dir\terror\n')
+        for res in res_list:
+            wall_time = f'{res["wall_time"]:.2f}' if res['wall_time'] is not None else ''
+            error = res['error'] or ''
+            fh.write(f'{res["identifier"]}\t{res["type"]}\t{res["status"]}\t{wall_time}\t{res["out_dir"]}\t{error}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run IniMotif on many ChIP-seq / SELEX-seq data sets without the GUI')
+    parser.add_argument('manifest', nargs='*', default=['-'],
+                        help='manifest files (json list or json lines), "-" reads from stdin')
+    parser.add_argument('-j', '--jobs', dest='n_jobs', type=int, default=os.cpu_count(),
+                        help='number of data sets processed concurrently')
+    parser.add_argument('-m', '--max-memory', dest='max_memory', type=float, default=None,
+                        help='memory limit of the whole batch in GB, split evenly between the workers')
+    parser.add_argument('-o', '--out-dir', dest='out_dir', default='.',
+                        help='base output directory, data sets without "out_dir" go to <out-dir>/<identifier>')
+    parser.add_argument('-s', '--summary', dest='summary', default=None,
+                        help='write a tsv summary of all data sets, default <out-dir>/batch_summary.tsv')
+    parser.add_argument('--min-kmer-len', type=int, default=6, help='default minimum kmer length')
+    parser.add_argument('--max-kmer-len', type=int, default=8, help='default maximum kmer length')
+    parser.add_argument('--n-max-mutation', type=int, default=2, help='default maximum number of mutations')
+    parser.add_argument('--file-type', default='fasta', help='default input file type')
+    parser.add_argument('--min-count', type=int, default=None,
+                        help='default minimum count of a kmer, rarer kmers are filtered out by a count-min sketch')
+    parser.add_argument('--no-revcom', dest='revcom_flag', action='store_false',
+                        help='do not count reverse complements')
+    args = parser.parse_args()
+
+    dataset_list = []
+    for manifest in args.manifest:
+        if manifest == '-':
+            dataset_list += read_manifest(sys.stdin)
+        else:
+            with open(manifest) as fh:
+                dataset_list += read_manifest(fh)
+
+    defaults = {'base_out_dir': args.out_dir, 'min_kmer_len': args.min_kmer_len, 'max_kmer_len': args.max_kmer_len,
+                'n_max_mutation': args.n_max_mutation, 'file_type': args.file_type, 'revcom_flag': args.revcom_flag,
+                'min_count': args.min_count}
+    dataset_list = [prepare_dataset(dataset, defaults) for dataset in dataset_list]
+    out_dir_list = [dataset['out_dir'] for dataset in dataset_list]
+    assert len(set(out_dir_list)) == len(out_dir_list), 'output directories of data sets must be unique'
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    print(f'Processing {len(dataset_list)} data sets with {args.n_jobs} workers')
+    res_list = run_batch(dataset_list, n_jobs=args.n_jobs, max_memory_gb=args.max_memory)
+
+    summary_file = args.summary if args.summary else os.path.join(args.out_dir, 'batch_summary.tsv')
+    write_summary(res_list, summary_file)
+    n_failed = sum(res['status'] != 'done' for res in res_list)
+    print(f'{len(res_list)-n_failed} data sets done, {n_failed} failed, summary written to {summary_file}')
+    if n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,6 @@ Created on Fri Nov 22 11:18:39 2019
 """
 from Bio import SeqIO
 import numpy as np
-import gzip
 from collections import Counter
 from typing import Tuple,Set
 from itertools import product, combinations
@@ -24,6 +23,9 @@ import warnings
 from adjustText import adjust_text
 
 from dna_logo import Logo
+from inimotif_sketch import CountMinSketch, get_filter_stats
+from inimotif_io import open_seq_file, read_fasta_records
+from inimotif_hits import get_motif_spec, iter_fasta_hits, write_hits
 
 def save_figure(file_name):
     plt.savefig(file_name,dpi=300)
@@ -37,8 +39,12 @@ class KmerCounter:
         k: length of kmer
         revcom_flag: bool, counting reverse complement or not
         unique_kmer_in_seq_mode: only count unique kmer on a given input sequence
+        min_count: if given, a kmer is only admitted into kmer_dict after it has been counted min_count times,
+            rare kmers are counted in a count-min sketch instead. The count of an admitted kmer starts from its
+            sketch estimate, which may be slightly higher than its true count.
+        sketch_width: number of counters in each row of the count-min sketch
     """
-    def __init__(self, k, revcom_flag=True, unique_kmer_in_seq_mode=True):
+    def __init__(self, k, revcom_flag=True, unique_kmer_in_seq_mode=True, min_count=None, sketch_width=2**20):
         assert k>0, "kmer length should be greater than 0"
         assert k<32, "kmer should be shorter than 32 bases"
 
@@ -53,6 +59,9 @@ class KmerCounter:
         self.k = k
         self.revcom_flag = revcom_flag
         self.unique_kmer_in_seq_mode = unique_kmer_in_seq_mode
+        self.min_count = min_count if min_count and min_count > 1 else None
+        self.sketch_width = sketch_width
+        self.sketch = None
 
         base_map = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
         self.base = {bk:self.dtype(base_map[bk]) for bk in base_map}
@@ -65,7 +74,9 @@ class KmerCounter:
         self.top_kmers_list = None
 
         self.n_seq = 0
+        self.n_base = 0
         self.n_total_kmer = 0
+        self.n_counted_kmer = 0  # total count merged into kmer_dict and sketch
 
     # generate a hash mask for kmers such that bits out of scope can be masked to 0
     def gen_hash_mask(self,k):
@@ -146,11 +157,36 @@ class KmerCounter:
 
     # merge the counted kmers
     def merge_res(self, kmer_dict) -> None:
+        if self.min_count and self.sketch is None:
+            self.sketch = CountMinSketch(self.sketch_width, conservative=True)
+
+        new_key_list = []
+        new_val_list = []
         for key in kmer_dict:
             # a kmer is only counted once in a input string in kmer_dict
             val = 1 if self.unique_kmer_in_seq_mode else kmer_dict[key]
-            self.kmer_dict[key] = self.kmer_dict.get(key,0) + val
             self.n_total_kmer += kmer_dict[key]
+            self.n_counted_kmer += val
+            if self.sketch is None or key in self.kmer_dict:
+                self.kmer_dict[key] = self.kmer_dict.get(key,0) + val
+            else:
+                new_key_list.append(key)
+                new_val_list.append(val)
+
+        # kmers not in kmer_dict are counted in the sketch until they reach min_count
+        if new_key_list:
+            kh_arr = np.array(new_key_list, dtype=self.dtype)
+            self.sketch.add(kh_arr, new_val_list)
+            for key, est in zip(new_key_list, self.sketch.query(kh_arr).tolist()):
+                if est >= self.min_count:
+                    self.kmer_dict[key] = est
+
+    # statistics of the kmers filtered out by min_count, None if min_count is not set
+    def get_filter_stats(self):
+        if self.sketch is None:
+            return None
+        return get_filter_stats(self.sketch, self.min_count, self.n_counted_kmer, len(self.kmer_dict),
+                                sum(self.kmer_dict.values()))
 
     # check if a kmer is palindrome
     def is_palindrome(self, kmer, kmer_type="string"):
@@ -281,28 +317,38 @@ class KmerCounter:
                     res_set.add(kh)
         return res_set
 
-    def scan_file(self, file_name, file_type="fasta"):
+    def scan_file(self, file_name, file_type="fasta", top_kmers_flag=True, masker=None, mask_out_file=None):
         """
         file_name: input DNA sequence file name
         file_type: fasta, fastq,
+        top_kmers_flag: if top kmers should be calculated after scanning, otherwise call get_top_kmers() later
+        masker: if given, e.g. an inimotif_util.Masker, each sequence is masked in memory before it is counted
+        mask_out_file: if given, the masked sequences are also written to this fasta file
+        """
+        seq_iter = (seq for _, seq in read_fasta_records(file_name, masker=masker, mask_out_file=mask_out_file))
+        return self.scan_seqs(seq_iter, top_kmers_flag=top_kmers_flag)
+
+    def scan_seqs(self, seq_iter, top_kmers_flag=True):
+        """
+        seq_iter: iterable of DNA sequence strings, e.g. the masked sequences of a file kept in memory
+        top_kmers_flag: if top kmers should be calculated after scanning, otherwise call get_top_kmers() later
         """
         self.n_seq = 0
+        self.n_base = 0
         self.n_total_kmer = 0
+        self.n_counted_kmer = 0
         self.kmer_dict = {}
         self.top_kmers_list = None
+        self.sketch = None
 
-        if file_name.endswith(".gz"):
-            fh = gzip.open(file_name,"rt")
-        else:
-            fh = open(file_name, "r")
-
-        for rec in SeqIO.parse(fh,"fasta"):
+        for seq in seq_iter:
             self.n_seq += 1
-            tmpdict = self.scan_seq(str(rec.seq))
+            self.n_base += len(seq)
+            tmpdict = self.scan_seq(seq)
             self.merge_res(tmpdict)
-        fh.close()
 
-        self.top_kmers_list = self.get_top_kmers()
+        if top_kmers_flag:
+            self.top_kmers_list = self.get_top_kmers()
         return self.kmer_dict
 
     # make kmer distribution plot
@@ -550,6 +596,19 @@ class MotifManager:
             i += 1
         return forward_pos_list,revcom_pos_list
 
+    def iter_hits(self, file_name):
+        """
+        scan a fasta file for the motif
+        Returns: a generator of the hits (MotifHit), identified by the consensus sequence, see inimotif_hits
+        """
+        spec = get_motif_spec(self.consensus_seq, self.kmer_counter, self.consensus_hash, self.n_max_mutation,
+                              self.revcom_flag)
+        return iter_fasta_hits(file_name, [spec])
+
+    def export_hits(self, file_name, out_file, file_format=None):
+        # write the hits as BED or TSV lines while scanning, returns the number of hits, see HitWriter
+        return write_hits(self.iter_hits(file_name), out_file, file_format)
+
     def _get_style_str(self):
         style_str = """
         body {
@@ -572,10 +631,7 @@ class MotifManager:
         return style_str
 
     def output_match_html(self, file_name, file_type="fasta", outfile="motif_match.html"):
-        if file_name.endswith(".gz"):
-            fh = gzip.open(file_name,"rt")
-        else:
-            fh = open(file_name, "r")
+        fh = open_seq_file(file_name)
         style_str = self._get_style_str()
         doc, tag, text = Doc().tagtext()
         doc.asis('<!DOCTYPE html>')
@@ -676,18 +732,19 @@ class MotifManager:
     def merge_res_revcom(self, pos_cnt) -> None:
         self.tfbs_pos_dis_revcom += pos_cnt
 
-    def scan_file(self, file_name, file_type="fasta"):
+    def scan_file(self, file_name, file_type="fasta", masker=None):
         """
         file_name: input DNA sequence file name
         file_type: fasta, fastq,
+        masker: if given, each sequence is masked in memory before it is scanned, see KmerCounter.scan_file
         """
-        if file_name.endswith(".gz"):
-            fh = gzip.open(file_name,"rt")
-        else:
-            fh = open(file_name, "r")
+        self.scan_seqs(seq for _, seq in read_fasta_records(file_name, masker=masker))
 
-        for i,rec in enumerate(SeqIO.parse(fh,"fasta")):
-            tmpseq = str(rec.seq)
+    def scan_seqs(self, seq_iter):
+        """
+        seq_iter: iterable of DNA sequence strings, the sequences counted by the kmer counter
+        """
+        for i,tmpseq in enumerate(seq_iter):
             tmpcnt = self.scan_seq(tmpseq, self.forward_motif_ball)
             self.merge_res_forward(tmpcnt)
             self.n_tfbs_forward_arr[i] = sum(tmpcnt)
@@ -695,7 +752,6 @@ class MotifManager:
                 tmpcnt = self.scan_seq(tmpseq, self.revcom_motif_ball)
                 self.merge_res_revcom(tmpcnt)
                 self.n_tfbs_revcom_arr[i] = sum(tmpcnt)
-        fh.close()
 
         if self.revcom_flag:
             self.n_tfbs_seq = sum( np.logical_or(self.n_tfbs_forward_arr>0, self.n_tfbs_revcom_arr>0) )
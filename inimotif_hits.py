@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Description: motif hits as coordinates, one record per hit: sequence id, start, end, strand, motif id, mismatches
+
+Hits are produced by generators while the input is read and written line by line as BED or TSV, such that large
+inputs are never held in memory and the output can be piped into downstream tools ("-" writes to stdout).
+
+    scanner.export_hits("peaks.fa", "hits.bed.gz")
+    for hit in motif_manager.iter_hits("peaks.fa"):
+        print(hit.seq_id, hit.start, hit.strand)
+
+Coordinates are 0-based and half-open as in BED. A kmer matching the motif on both strands is reported once for
+each strand, a palindromic motif only on the forward strand.
+"""
+import gzip
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from inimotif_io import read_fasta_batches
+from kmer_count_async import get_backend, get_invalid_hash, get_seq_hash_arr
+
+MotifHit = namedtuple("MotifHit", ["seq_id", "start", "end", "strand", "motif_id", "n_mismatch"])
+
+# a motif to scan, revcom_hash is None if the reverse strand is not scanned
+MotifSpec = namedtuple("MotifSpec", ["motif_id", "kmer_len", "consensus_hash", "revcom_hash", "n_max_mutation"])
+
+HIT_FILE_FORMATS = ("bed", "tsv")
+
+
+def get_motif_spec(motif_id, kmer_counter, consensus_hash, n_max_mutation, revcom_flag=True):
+    # consensus_hash: hash of the consensus sequence by kmer_counter
+    revcom_hash = kmer_counter.revcom_hash(consensus_hash)
+    if not revcom_flag or revcom_hash == consensus_hash:
+        revcom_hash = None
+    return MotifSpec(motif_id, kmer_counter.k, consensus_hash, revcom_hash, n_max_mutation)
+
+
+def find_motif_hits(hash_arr, spec: MotifSpec):
+    """
+    find the kmers within n_max_mutation mismatches of the consensus or its reverse complement
+    Args:
+        hash_arr: kmer hashes of a sequence, see get_seq_hash_arr
+        spec: the motif
+    Returns:
+        a list of (start position array, strand, mismatch array), one for each scanned strand
+    """
+    valid_flag = hash_arr != get_invalid_hash(hash_arr.dtype.type)
+    dist_arr = np.empty(len(hash_arr), dtype=np.uint8)
+    res_list = []
+    for strand, consensus_hash in (("+", spec.consensus_hash), ("-", spec.revcom_hash)):
+        if consensus_hash is None:
+            continue
+        get_backend("numpy").hamming_dist(hash_arr, np.array([consensus_hash], dtype=hash_arr.dtype), spec.kmer_len,
+                                          dist_arr)
+        pos_arr = np.flatnonzero(valid_flag & (dist_arr <= spec.n_max_mutation))
+        res_list.append((pos_arr, strand, dist_arr[pos_arr]))
+    return res_list
+
+
+def iter_fasta_hits(file_name, spec_list, batch_size=2**22):
+    """
+    scan all records of a fasta file for the motifs, the records of a batch are joined by "N" and each motif length
+    is hashed once per batch
+    Args:
+        file_name: input fasta file, may be gzip compressed
+        spec_list: list of MotifSpec
+        batch_size: number of bases of a batch of records
+    Returns:
+        a generator of MotifHit, in the order of the records, by start position within a record
+    """
+    kmer_len_arr = np.array([spec.kmer_len for spec in spec_list], dtype=np.int64)
+    for batch in read_fasta_batches(file_name, batch_size):
+        seq_list = [seq.upper() for _, seq in batch]
+        seq_st_arr = np.cumsum([0] + [len(seq) + 1 for seq in seq_list[:-1]], dtype=np.int64)
+        joined_seq = "N".join(seq_list)
+
+        hash_dict = {}
+        pos_list, rc_list, dist_list, motif_ind_list = [], [], [], []
+        for i_motif, spec in enumerate(spec_list):
+            if spec.kmer_len not in hash_dict:
+                hash_dict[spec.kmer_len] = get_seq_hash_arr(joined_seq, spec.kmer_len)
+            for pos_arr, strand, dist_arr in find_motif_hits(hash_dict[spec.kmer_len], spec):
+                pos_list.append(pos_arr)
+                rc_list.append(np.full(len(pos_arr), strand == "-"))
+                dist_list.append(dist_arr)
+                motif_ind_list.append(np.full(len(pos_arr), i_motif))
+        if not pos_list:
+            continue
+        pos_arr, rc_arr = np.concatenate(pos_list), np.concatenate(rc_list)
+        dist_arr, motif_ind_arr = np.concatenate(dist_list), np.concatenate(motif_ind_list)
+        inds = np.lexsort((rc_arr, motif_ind_arr, pos_arr))
+        pos_arr, rc_arr, dist_arr, motif_ind_arr = pos_arr[inds], rc_arr[inds], dist_arr[inds], motif_ind_arr[inds]
+
+        # positions in the joined sequence to positions in the records
+        seq_ind_arr = np.searchsorted(seq_st_arr, pos_arr, side="right") - 1
+        st_arr = pos_arr - seq_st_arr[seq_ind_arr]
+        ed_arr = st_arr + kmer_len_arr[motif_ind_arr]
+        seq_id_list = [title.split(None, 1)[0] if title else "" for title, _ in batch]
+        for i_seq, st, ed, rc, i_motif, dist in zip(seq_ind_arr.tolist(), st_arr.tolist(), ed_arr.tolist(),
+                                                    rc_arr.tolist(), motif_ind_arr.tolist(), dist_arr.tolist()):
+            yield MotifHit(seq_id_list[i_seq], st, ed, "-" if rc else "+", spec_list[i_motif].motif_id, dist)
+
+
+class HitWriter:
+    """
+    write motif hits line by line, as they are produced
+
+    bed: seq_id, start, end, motif_id, n_mismatch (as score), strand, i.e. BED6
+    tsv: seq_id, start, end, strand, motif_id, n_mismatch, with a header line
+
+    Attributes:
+        out_file: output file, gzip compressed if it ends with ".gz", "-" writes to stdout
+        file_format: "bed" or "tsv", derived from out_file if None (".bed" or ".bed.gz" is bed, otherwise tsv)
+        n_hit: number of hits written
+    """
+    def __init__(self, out_file, file_format=None):
+        if file_format is None:
+            file_format = "bed" if out_file.endswith((".bed", ".bed.gz")) else "tsv"
+        assert file_format in HIT_FILE_FORMATS, f"file_format={file_format} should be one of {HIT_FILE_FORMATS}"
+        self.out_file = out_file
+        self.file_format = file_format
+        self.n_hit = 0
+        if out_file == "-":
+            self.fh = sys.stdout
+        elif out_file.endswith(".gz"):
+            self.fh = gzip.open(out_file, "wt")
+        else:
+            self.fh = open(out_file, "w")
+        if file_format == "tsv":
+            self.fh.write("\t".join(MotifHit._fields) + "\n")
+
+    def write(self, hit: MotifHit):
+        if self.file_format == "bed":
+            line = f"{hit.seq_id}\t{hit.start}\t{hit.end}\t{hit.motif_id}\t{hit.n_mismatch}\t{hit.strand}\n"
+        else:
+            line = f"{hit.seq_id}\t{hit.start}\t{hit.end}\t{hit.strand}\t{hit.motif_id}\t{hit.n_mismatch}\n"
+        self.fh.write(line)
+        self.n_hit += 1
+
+    def close(self):
+        if self.fh is sys.stdout:
+            self.fh.flush()
+        else:
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_hits(hit_iter, out_file, file_format=None):
+    # write all hits of a generator, see HitWriter. Returns the number of hits written
+    with HitWriter(out_file, file_format) as writer:
+        for hit in hit_iter:
+            writer.write(hit)
+    return writer.n_hit
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Description: input layer for sequence files, gzip compressed inputs are decompressed off the main thread
+
+BGZF files (bgzip, the block gzip format of samtools/htslib) consist of independent gzip blocks of at most 64KB,
+these blocks are decompressed in parallel by a thread pool, zlib releases the GIL while decompressing.
+Plain gzip files are decompressed by a read-ahead thread that feeds the decompressed bytes through a bounded queue.
+Uncompressed files are opened as usual.
+
+    with open_seq_file("reads.fq.gz") as fh:
+        for line in fh:
+            ...
+"""
+import gzip
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# size of the compressed data read at once from a plain gzip file
+READ_SIZE = 2**20
+# number of BGZF blocks decompressed by one task of the thread pool, about 1MB of compressed data
+N_BLOCK_PER_TASK = 16
+# maximum number of decompressed pieces waiting in the queue of the read-ahead thread
+QUEUE_SIZE = 16
+
+
+def get_compression(file_name):
+    # "bgzf", "gzip" or None, detected from the header of the file rather than the file name
+    with open(file_name, "rb") as fh:
+        header = fh.read(18)
+    if header[:2] != GZIP_MAGIC:
+        return None
+    # BGZF: FEXTRA flag set and an extra subfield "BC" of length 2 holding the block size
+    if len(header) == 18 and header[3] & 4 and header[12:14] == b"BC" and header[14:16] == b"\x02\x00":
+        return "bgzf"
+    return "gzip"
+
+
+def iter_gzip(fh, read_size=READ_SIZE):
+    # decompress a plain gzip file piece by piece, concatenated gzip members are supported.
+    # A truncated file raises EOFError as gzip.open does
+    decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    member_started = False  # if data of the current gzip member has been read
+    while True:
+        data = fh.read(read_size)
+        if not data:
+            break
+        member_started = True
+        while data:
+            res = decomp.decompress(data)
+            if res:
+                yield res
+            if not decomp.eof:
+                break
+            # start of the next gzip member
+            data = decomp.unused_data
+            member_started = bool(data)
+            decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    res = decomp.flush()
+    if res:
+        yield res
+    if member_started and not decomp.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def read_bgzf_blocks(fh, n_block):
+    # read the next n_block raw BGZF blocks, an empty list at the end of the file
+    block_list = []
+    for _ in range(n_block):
+        header = fh.read(18)
+        if not header:
+            break
+        if len(header) < 18 or header[:2] != GZIP_MAGIC or header[12:14] != b"BC":
+            raise Exception(f"Invalid BGZF block header in {fh.name}")
+        xlen = struct.unpack("<H", header[10:12])[0]
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        block_list.append((header + fh.read(block_size - 18), xlen))
+    return block_list
+
+
+def decompress_bgzf_blocks(block_list):
+    # decompress raw BGZF blocks, runs in the thread pool
+    res_list = []
+    for block, xlen in block_list:
+        data = zlib.decompress(block[12 + xlen:-8], -zlib.MAX_WBITS)
+        if len(data) != struct.unpack("<I", block[-4:])[0]:
+            raise Exception("Corrupted BGZF block, size of the decompressed data does not match")
+        res_list.append(data)
+    return b"".join(res_list)
+
+
+def iter_bgzf(fh, executor, max_pending):
+    # decompress a BGZF file, groups of blocks are decompressed in parallel and yielded in order
+    pending = []
+    while True:
+        block_list = read_bgzf_blocks(fh, N_BLOCK_PER_TASK)
+        if block_list:
+            pending.append(executor.submit(decompress_bgzf_blocks, block_list))
+        if pending and (len(pending) >= max_pending or not block_list):
+            yield pending.pop(0).result()
+        if not block_list and not pending:
+            break
+
+
+class ReadAheadStream(io.RawIOBase):
+    """
+    raw binary stream of the bytes produced by a generator running on a read-ahead thread, at most q_size pieces
+    are waiting in the queue. Exceptions of the generator are raised by read.
+    """
+    def __init__(self, gen_func, q_size=QUEUE_SIZE):
+        super().__init__()
+        self.queue = queue.Queue(maxsize=q_size)
+        self.stop_event = threading.Event()
+        self.data = b""
+        self.pos = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self._run, args=(gen_func,), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # put an item into the queue unless the stream is closed
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, gen_func):
+        gen = gen_func()
+        try:
+            for data in gen:
+                if not self._put(data):
+                    return
+        except BaseException as e:
+            self._put(e)
+            return
+        finally:
+            gen.close()  # release the resources of the generator also if the stream is closed early
+        self._put(None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos >= len(self.data):
+            if self.eof:
+                return 0
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+                return 0
+            if isinstance(item, BaseException):
+                self.eof = True
+                raise item
+            self.data, self.pos = item, 0
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stop_event.set()
+            self.thread.join()
+        super().close()
+
+
+def open_seq_file(file_name, mode="rt", n_threads=None):
+    """
+    open a sequence file for reading, gzip compressed files are decompressed on background threads
+    Args:
+        file_name: input file name
+        mode: "rt" for text, "rb" for bytes
+        n_threads: number of threads decompressing the blocks of a BGZF file, number of cpus if None
+    Returns:
+        a file object
+    """
+    assert mode in ("r", "rt", "rb"), f"open_seq_file only supports reading, mode={mode}"
+    compression = get_compression(file_name)
+    if compression is None:
+        return open(file_name, mode)
+
+    raw_fh = open(file_name, "rb")
+    if compression == "bgzf":
+        n_threads = n_threads if n_threads else os.cpu_count()
+        executor = ThreadPoolExecutor(max_workers=n_threads)
+
+        def gen_func():
+            try:
+                yield from iter_bgzf(raw_fh, executor, max_pending=2 * n_threads)
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raw_fh.close()
+    else:
+        def gen_func():
+            try:
+                yield from iter_gzip(raw_fh)
+            finally:
+                raw_fh.close()
+
+    fh = io.BufferedReader(ReadAheadStream(gen_func), buffer_size=READ_SIZE)
+    if mode == "rb":
+        return fh
+    return io.TextIOWrapper(fh)
+
+
+def read_fasta_batches(file_name, batch_size=2**22):
+    # (title, sequence) records of a fasta file, in batches of about batch_size bases
+    with open_seq_file(file_name) as fh:
+        batch, n_base = [], 0
+        for title, seq in SimpleFastaParser(fh):
+            batch.append((title, seq))
+            n_base += len(seq)
+            if n_base >= batch_size:
+                yield batch
+                batch, n_base = [], 0
+        if batch:
+            yield batch
+
+
+def format_fasta(title, seq, line_width=60):
+    # fasta text of a record, same as SeqIO.write for line_width=60
+    if not line_width:
+        return f'>{title}\n{seq}\n' if seq else f'>{title}\n'
+    line_list = [f'>{title}\n']
+    line_list += [seq[i:i + line_width] + '\n' for i in range(0, len(seq), line_width)]
+    return ''.join(line_list)
+
+
+def read_fasta_records(file_name, masker=None, mask_out_file=None, batch_size=2**22, line_width=60):
+    """
+    (title, sequence) records of a fasta file, optionally masked in memory batch by batch while the file is read,
+    such that no masked copy of the file has to be written and parsed again
+    Args:
+        file_name: input fasta file, may be gzip compressed
+        masker: if given, an object with mask_list(seq_list), e.g. inimotif_util.Masker, the records are masked
+            as by Masker.mask_file
+        mask_out_file: if given, the (masked) records are also written to this fasta file, gzip compressed if it
+            ends with ".gz"
+        batch_size: number of bases of a batch of records
+        line_width: number of bases in each line of mask_out_file, 0 writes each sequence in one line
+    Returns:
+        a generator of (title, sequence)
+    """
+    out_fh = None
+    if mask_out_file is not None:
+        out_fh = gzip.open(mask_out_file, "wt") if mask_out_file.endswith(".gz") else open(mask_out_file, "w")
+    try:
+        for batch in read_fasta_batches(file_name, batch_size):
+            if masker is not None:
+                seq_list = masker.mask_list([seq for _, seq in batch])
+                batch = [(title, seq) for (title, _), seq in zip(batch, seq_list)]
+            if out_fh is not None:
+                out_fh.write("".join(format_fasta(title, seq, line_width) for title, seq in batch))
+            yield from batch
+    finally:
+        if out_fh is not None:
+            out_fh.close()
@@ -5,13 +5,16 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from inimotif_core import KmerCounter, MotifManager, save_figure
+from inimotif_io import read_fasta_records
+from inimotif_metrics import StageMetrics
 from yattag import Doc,indent
 import numpy as np
 
 class FileProcessor:
     def __init__(self, file_name=None, file_type="fasta", out_dir=".",
               kmer_len=0, unique_kmer_in_seq_mode=True, revcom_flag=True,
-              consensus_seq=None, n_max_mutation=2, kmer_dict=None):
+              consensus_seq=None, n_max_mutation=2, kmer_dict=None, min_count=None, masker=None, mask_out_file=None,
+              masked_seq_list=None):
         assert os.path.exists(file_name), f"input file {file_name} does not exist"
 
         # store input parameters
@@ -27,8 +30,16 @@ class FileProcessor:
         self.consensus_seq = consensus_seq
         self.n_max_mutation = n_max_mutation
         self.kmer_dict = kmer_dict
+        self.min_count = min_count  # kmers counted less than min_count times are filtered out
         #self.kmer_dict = {k: v for k, v in sorted(self.kmer_dict.items(), key=lambda item: item[1], reverse=True)}
 
+        # if a masker (inimotif_util.Masker) is given, the sequences are masked in memory once per run and reused for
+        # kmer counting and motif scanning, the masked sequences are written to mask_out_file if it is given.
+        # masked_seq_list: the sequences of file_name already masked, e.g. by ChipSeqProcessor for all kmer lengths
+        self.masker = masker
+        self.mask_out_file = mask_out_file
+        self.masked_seq_list = masked_seq_list
+
         # make output directory
         # preproc results, figures are stored in this directory
         self.mkdir(out_dir)
@@ -40,43 +51,75 @@ class FileProcessor:
         self.motif_posdis_file = 'posdis.png'
         self.kmer_hamdis_file = 'hamdis.png'
         self.motif_cooccur_dis_file = 'cooccurdis.png'
+        self.metrics_file = 'metrics.json'
 
         # kmer counter and motif manager to be generated
         self.kmer_counter = None
         self.motif_manager = None
 
+        # timing and memory usage of each stage
+        self.metrics = StageMetrics()
+
     def run(self):
         # output general information
         print(f'Start processing {self.file_name}, kmer_len={self.kmer_len}')
+        self.metrics = StageMetrics()
+
+        seq_list = self.masked_seq_list
+        if seq_list is None and self.masker is not None:
+            with self.metrics.stage('masking') as st:
+                seq_list = read_masked_seqs(self.file_name, self.masker, self.mask_out_file)
+                st['n_seq'], st['n_base'] = len(seq_list), sum(len(seq) for seq in seq_list)
 
         # create kmer counts and motif manager
-        self.kmer_counter = KmerCounter(self.kmer_len, unique_kmer_in_seq_mode=self.unique_kmer_in_seq_mode, revcom_flag=self.revcom_flag)
-        self.kmer_counter.scan_file(self.file_name, file_type=self.file_type)
+        with self.metrics.stage('kmer counting') as st:
+            self.kmer_counter = KmerCounter(self.kmer_len, unique_kmer_in_seq_mode=self.unique_kmer_in_seq_mode, revcom_flag=self.revcom_flag,
+                                            min_count=self.min_count)
+            if seq_list is None:
+                self.kmer_counter.scan_file(self.file_name, file_type=self.file_type, top_kmers_flag=False)
+            else:
+                self.kmer_counter.scan_seqs(seq_list, top_kmers_flag=False)
+            st['n_seq'], st['n_base'] = self.kmer_counter.n_seq, self.kmer_counter.n_base
+        with self.metrics.stage('top kmers'):
+            self.kmer_counter.get_top_kmers()
         print('kmer counter has scaned input file')
 
-        self.motif_manager =  MotifManager(self.kmer_counter,self.consensus_seq, n_max_mutation=self.n_max_mutation, kmer_dict=self.kmer_dict, revcom_flag=self.revcom_flag)
-        self.motif_manager.scan_file(self.file_name)
+        with self.metrics.stage('motif scanning') as st:
+            self.motif_manager =  MotifManager(self.kmer_counter,self.consensus_seq, n_max_mutation=self.n_max_mutation, kmer_dict=self.kmer_dict, revcom_flag=self.revcom_flag)
+            if seq_list is None:
+                self.motif_manager.scan_file(self.file_name)
+            else:
+                self.motif_manager.scan_seqs(seq_list)
+            st['n_seq'], st['n_base'] = self.kmer_counter.n_seq, self.kmer_counter.n_base
         print('motif manager has scaned input file')
 
-        # make plots and save results
-        with open( self.gen_absolute_path(self.preproc_res_file), 'wb') as f:
-            pickle.dump(self, f)   # current FileProcessor be pickled
+        # make plots and save results, the masked sequences are not saved
+        self.masked_seq_list = None
+        with self.metrics.stage('save results'):
+            with open( self.gen_absolute_path(self.preproc_res_file), 'wb') as f:
+                pickle.dump(self, f)   # current FileProcessor be pickled
 
         self.mk_plots()
 
+        self.metrics.save_json(self.gen_absolute_path(self.metrics_file))
+
     def mk_plots(self):
         kc = self.kmer_counter
         mm = self.motif_manager
 
-        kc.mk_kmer_dis_plot(outfile=self.gen_absolute_path(self.kmer_hamdis_file))
+        with self.metrics.stage('plot kmer distribution'):
+            kc.mk_kmer_dis_plot(outfile=self.gen_absolute_path(self.kmer_hamdis_file))
 
-        mm.mk_logo_plot(mm.forward_motif_mat, outfile=self.gen_absolute_path(self.logo_forward_file))
+        with self.metrics.stage('plot logo'):
+            mm.mk_logo_plot(mm.forward_motif_mat, outfile=self.gen_absolute_path(self.logo_forward_file))
 
-        mm.mk_logo_plot(mm.revcom_motif_mat, outfile=self.gen_absolute_path(self.logo_revcom_file))
+            mm.mk_logo_plot(mm.revcom_motif_mat, outfile=self.gen_absolute_path(self.logo_revcom_file))
 
-        mm.mk_motif_posdis_plot(outfile=self.gen_absolute_path(self.motif_posdis_file))
+        with self.metrics.stage('plot position distribution'):
+            mm.mk_motif_posdis_plot(outfile=self.gen_absolute_path(self.motif_posdis_file))
 
-        mm.mk_bubble_plot(outfile=self.gen_absolute_path(self.motif_cooccur_dis_file))
+        with self.metrics.stage('plot co-occurrence'):
+            mm.mk_bubble_plot(outfile=self.gen_absolute_path(self.motif_cooccur_dis_file))
 
     # generate html file string for displaying figures etc.
     def gen_html_str(self, img_dir, title=None):
@@ -104,6 +147,13 @@ class FileProcessor:
             text(f'Consensus (revcom) [{tmpstr}]: {kc.revcom(mm.consensus_seq)}')
         with tag('p'):
             text(f'Number of maximum allowed mutations: {mm.n_max_mutation}')
+        filter_stats = kc.get_filter_stats()
+        if filter_stats:
+            with tag('p'):
+                text(f'Kmers with count < {filter_stats["min_count"]} filtered out: '
+                     f'about {filter_stats["n_filtered_distinct_est"]} distinct kmers '
+                     f'({filter_stats["n_filtered_kmer"]} of {filter_stats["n_total_kmer"]} kmers), '
+                     f'{filter_stats["n_kept_distinct"]} distinct kmers kept')
         with tag('p'):
             text(f'Total number of input sequences: {mm.n_seq}')
         with tag('p'):
@@ -172,14 +222,29 @@ class FileProcessor:
             display: inline-block;
             width: 100%;
         }
+        table.metrics {
+            margin-left: auto;
+            margin-right: auto;
+            border-collapse: collapse;
+        }
+        table.metrics th, table.metrics td {
+            border: 1px solid #999;
+            padding: 2px 8px;
+            text-align: right;
+        }
         """
         return style_str
 
 
+def read_masked_seqs(file_name, masker, mask_out_file=None):
+    # the sequences of a fasta file masked in memory, also written to mask_out_file if it is given
+    return [seq for _, seq in read_fasta_records(file_name, masker=masker, mask_out_file=mask_out_file)]
+
+
 class ChipSeqProcessor:
     def __init__(self, file_name=None, file_type="fasta", identifier='out', out_dir=".",
               min_kmer_len=0, max_kmer_len=0, unique_kmer_in_seq_mode=True, revcom_flag=True,
-              consensus_seq=None, n_max_mutation=2, kmer_dict=None):
+              consensus_seq=None, n_max_mutation=2, kmer_dict=None, min_count=None, masker=None, mask_out_file=None):
         assert len(out_dir)>0, "output directory must be non-empty string"
         if out_dir[-1]==os.sep:
             out_dir=out_dir[:-1]
@@ -200,6 +265,14 @@ class ChipSeqProcessor:
         self.consensus_seq = consensus_seq
         self.n_max_mutation = n_max_mutation
         self.kmer_dict = kmer_dict
+        self.min_count = min_count
+
+        # sequences are masked in memory once and reused for all kmer lengths
+        self.masker = masker
+        self.mask_out_file = mask_out_file
+
+        self.metrics_file = 'metrics.json'
+        self.metrics = StageMetrics()
 
         # make output directory
         if not os.path.exists(out_dir):
@@ -231,32 +304,46 @@ class ChipSeqProcessor:
                 for tmpstr in html_div_list:
                     doc.stag('hr')
                     doc.asis(tmpstr)
+                doc.stag('hr')
+                doc.asis(self.metrics.gen_html_str())
 
         # output html string
         html_str = indent(doc.getvalue(), indent_text = True) # will also indent the text directly contained between <tag> and </tag>
         return html_str
 
     def run(self):
+        self.metrics = StageMetrics()
         html_div_list = []
+        masked_seq_list = None
+        if self.masker is not None:
+            with self.metrics.stage('masking') as st:
+                masked_seq_list = read_masked_seqs(self.file_name, self.masker, self.mask_out_file)
+                st['n_seq'], st['n_base'] = len(masked_seq_list), sum(len(seq) for seq in masked_seq_list)
         # run for different kmers
         for kmer_len in range(self.min_kmer_len, self.max_kmer_len+1):
             stem_dir = f'k{kmer_len}'
             out_dir = self.out_dir + os.sep + stem_dir
             fp = FileProcessor(file_name=self.file_name, file_type=self.file_type, out_dir=out_dir,
               kmer_len=kmer_len, unique_kmer_in_seq_mode=self.unique_kmer_in_seq_mode, revcom_flag=self.revcom_flag,
-              consensus_seq=self.consensus_seq, n_max_mutation=self.n_max_mutation, kmer_dict=self.kmer_dict)
+              consensus_seq=self.consensus_seq, n_max_mutation=self.n_max_mutation, kmer_dict=self.kmer_dict,
+              min_count=self.min_count, masker=self.masker, masked_seq_list=masked_seq_list)
             fp.run()
+            self.metrics.add_run(stem_dir, fp.metrics)
             html_div_list.append(fp.gen_html_str('./'+stem_dir))
 
-        html_str = self.gen_html(html_div_list)
-        outfile = self.out_dir + os.sep + self.identifier + '.html'
-        with open(outfile,'w') as out_fh:
-            out_fh.write(html_str)
+        with self.metrics.stage('html generation'):
+            html_str = self.gen_html(html_div_list)
+            outfile = self.out_dir + os.sep + self.identifier + '.html'
+            with open(outfile,'w') as out_fh:
+                out_fh.write(html_str)
+
+        self.metrics.save_json(self.out_dir + os.sep + self.metrics_file)
 
 class SelexSeqProcessor:
     def __init__(self, file_name_arr=None, file_type="fasta", identifier='out', out_dir=".",
               min_kmer_len=0, max_kmer_len=0, min_selex_round=0, max_selex_round=0,
-              unique_kmer_in_seq_mode=True, revcom_flag=True, consensus_seq=None, n_max_mutation=2, kmer_dict=None):
+              unique_kmer_in_seq_mode=True, revcom_flag=True, consensus_seq=None, n_max_mutation=2, kmer_dict=None,
+              min_count=None):
         assert len(out_dir)>0, "output directory must be non-empty string"
         if out_dir[-1]==os.sep:
             out_dir=out_dir[:-1]
@@ -280,9 +367,13 @@ class SelexSeqProcessor:
         self.consensus_seq = consensus_seq
         self.n_max_mutation = n_max_mutation
         self.kmer_dict = kmer_dict
+        self.min_count = min_count
 
         self.trend_figure_dir = 'trend_figure'
 
+        self.metrics_file = 'metrics.json'
+        self.metrics = StageMetrics()
+
         # make output directory
         FileProcessor.mkdir(out_dir)
 
@@ -290,6 +381,7 @@ class SelexSeqProcessor:
         FileProcessor.mkdir(self.out_dir + os.sep + self.trend_figure_dir)
 
     def run(self):
+        self.metrics = StageMetrics()
         html_div_k_list = [[] for _ in range(self.max_kmer_len+1)]
         html_div_r_list = [[] for _ in range(self.max_selex_round+1)]
         # run for different kmers
@@ -300,33 +392,39 @@ class SelexSeqProcessor:
                 out_dir = self.out_dir + os.sep + stem_dir
                 fp = FileProcessor(file_name=file_name, file_type=self.file_type, out_dir=out_dir,
                     kmer_len=kmer_len, unique_kmer_in_seq_mode=self.unique_kmer_in_seq_mode, revcom_flag=self.revcom_flag,
-                    consensus_seq=self.consensus_seq, n_max_mutation=self.n_max_mutation, kmer_dict=self.kmer_dict)
+                    consensus_seq=self.consensus_seq, n_max_mutation=self.n_max_mutation, kmer_dict=self.kmer_dict,
+                    min_count=self.min_count)
                 fp.run()
+                self.metrics.add_run(stem_dir, fp.metrics)
                 html_div_k_list[kmer_len].append(fp.gen_html_str('./'+stem_dir, title=f'Round={i_round} K={kmer_len}'))
                 selex_res.append(fp)
                 
             # generate kmer trend figures
             trend_fig_file = self.out_dir + os.sep + self.trend_figure_dir + os.sep + f'k{kmer_len}.png'
-            self.mk_kmer_trend_fig(selex_res, trend_fig_file)
+            with self.metrics.stage('plot kmer trend'):
+                self.mk_kmer_trend_fig(selex_res, trend_fig_file)
             
         for kmer_len in range(self.min_kmer_len, self.max_kmer_len+1):
             k_list = html_div_k_list[kmer_len]
             for i_round,div in zip(range(self.min_selex_round, self.max_selex_round+1), k_list):
                 html_div_r_list[i_round].append(div)
 
-        # generate html for each round
-        for i_round in range(self.min_selex_round, self.max_selex_round+1):
-            html_str = self.gen_html_round(html_div_r_list[i_round], i_round)
-            outfile = self.out_dir + os.sep + self.identifier + f'_round_{i_round}.html'
-            with open(outfile,'w') as out_fh:
-                out_fh.write(html_str)
+        with self.metrics.stage('html generation'):
+            # generate html for each round
+            for i_round in range(self.min_selex_round, self.max_selex_round+1):
+                html_str = self.gen_html_round(html_div_r_list[i_round], i_round)
+                outfile = self.out_dir + os.sep + self.identifier + f'_round_{i_round}.html'
+                with open(outfile,'w') as out_fh:
+                    out_fh.write(html_str)
 
-        # generate html for each kmer_len
-        for kmer_len in range(self.min_kmer_len, self.max_kmer_len+1):
-            html_str = self.gen_html_k(html_div_k_list[kmer_len], kmer_len, f'./{self.trend_figure_dir}', f'k{kmer_len}.png')
-            outfile = self.out_dir + os.sep + self.identifier + f'_k_{kmer_len}.html'
-            with open(outfile,'w') as out_fh:
-                out_fh.write(html_str)
+            # generate html for each kmer_len
+            for kmer_len in range(self.min_kmer_len, self.max_kmer_len+1):
+                html_str = self.gen_html_k(html_div_k_list[kmer_len], kmer_len, f'./{self.trend_figure_dir}', f'k{kmer_len}.png')
+                outfile = self.out_dir + os.sep + self.identifier + f'_k_{kmer_len}.html'
+                with open(outfile,'w') as out_fh:
+                    out_fh.write(html_str)
+
+        self.metrics.save_json(self.out_dir + os.sep + self.metrics_file)
 
     # make kmer trend figure
     def mk_kmer_trend_fig(self, selex_round_res_list, outfile="selex_trend.png"):
@@ -479,6 +577,8 @@ class SelexSeqProcessor:
                     text('SELEX kmer trend figure')
                 with tag('div'):
                     doc.stag('img', klass="hamdis", src=trend_fig_dir+'/'+trend_fig_name, alt=trend_fig_name,  onclick=f"window.open('{trend_fig_dir}/{trend_fig_name}', '_blank');")
+                doc.stag('hr')
+                doc.asis(self.metrics.gen_html_str())
 
         # output html string
         html_str = indent(doc.getvalue(), indent_text = True) # will also indent the text directly contained between <tag> and </tag>
@@ -510,6 +610,8 @@ class SelexSeqProcessor:
                 for tmpstr in html_div_list:
                     doc.stag('hr')
                     doc.asis(tmpstr)
+                doc.stag('hr')
+                doc.asis(self.metrics.gen_html_str())
 
         # output html string
         html_str = indent(doc.getvalue(), indent_text = True) # will also indent the text directly contained between <tag> and </tag>
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Description: lightweight per-stage timing and memory instrumentation for IniMotif runs
+"""
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+from yattag import Doc, indent
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def get_peak_rss():
+    # peak resident set size of the current process in MB, None if not available
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes on macOS, kilobytes on Linux
+        return peak / 2**20
+    return peak / 2**10
+
+
+class StageMetrics:
+    """
+    record wall time, cpu time, peak memory and throughput of the stages of a run
+
+    Attributes:
+        stages: list of dictionaries, one for each stage in the order they were run
+        runs: dictionary of sub run name -> StageMetrics, e.g. the FileProcessor runs of a ChipSeqProcessor
+    """
+    def __init__(self):
+        self.stages = []
+        self.runs = {}
+
+    @contextmanager
+    def stage(self, name, n_seq=None, n_base=None):
+        """
+        time a stage, the yielded dictionary can be updated with n_seq and n_base inside the with block
+
+        with metrics.stage('kmer counting') as st:
+            kc.scan_file(file_name)
+            st['n_seq'] = kc.n_seq
+        """
+        st = {'stage': name, 'n_seq': n_seq, 'n_base': n_base}
+        wall_st, cpu_st = time.perf_counter(), time.process_time()
+        try:
+            yield st
+        finally:
+            st['wall_time'] = time.perf_counter() - wall_st
+            st['cpu_time'] = time.process_time() - cpu_st
+            st['peak_rss_mb'] = get_peak_rss()
+            st['seq_per_sec'] = st['n_seq']/st['wall_time'] if st['n_seq'] and st['wall_time']>0 else None
+            st['base_per_sec'] = st['n_base']/st['wall_time'] if st['n_base'] and st['wall_time']>0 else None
+            self.stages.append(st)
+
+    def add_run(self, name, metrics):
+        self.runs[name] = metrics
+
+    def total_time(self):
+        # total wall time and cpu time of all stages, including the sub runs
+        wall_time = sum(st['wall_time'] for st in self.stages)
+        cpu_time = sum(st['cpu_time'] for st in self.stages)
+        for metrics in self.runs.values():
+            tmp_wall, tmp_cpu = metrics.total_time()
+            wall_time += tmp_wall
+            cpu_time += tmp_cpu
+        return wall_time, cpu_time
+
+    # sum the stages with the same name over this run and all sub runs
+    def summarize(self):
+        summary = {}
+        def add_stage(st):
+            if st['stage'] not in summary:
+                summary[st['stage']] = {'stage': st['stage'], 'n_call': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                        'peak_rss_mb': None, 'n_seq': None, 'n_base': None}
+            res = summary[st['stage']]
+            res['n_call'] += 1
+            res['wall_time'] += st['wall_time']
+            res['cpu_time'] += st['cpu_time']
+            for key in ('n_seq', 'n_base'):
+                if st[key] is not None:
+                    res[key] = (res[key] or 0) + st[key]
+            if st['peak_rss_mb'] is not None:
+                res['peak_rss_mb'] = max(res['peak_rss_mb'] or 0, st['peak_rss_mb'])
+
+        def add_metrics(metrics):
+            for st in metrics.stages:
+                add_stage(st)
+            for sub_metrics in metrics.runs.values():
+                add_metrics(sub_metrics)
+
+        add_metrics(self)
+        for res in summary.values():
+            res['seq_per_sec'] = res['n_seq']/res['wall_time'] if res['n_seq'] and res['wall_time']>0 else None
+            res['base_per_sec'] = res['n_base']/res['wall_time'] if res['n_base'] and res['wall_time']>0 else None
+        return list(summary.values())
+
+    def to_dict(self):
+        wall_time, cpu_time = self.total_time()
+        return {'total_wall_time': wall_time, 'total_cpu_time': cpu_time, 'peak_rss_mb': get_peak_rss(),
+                'stages': self.stages,
+                'runs': {name: metrics.to_dict() for name, metrics in self.runs.items()}}
+
+    def save_json(self, out_file):
+        with open(out_file, 'w') as fh:
+            json.dump(self.to_dict(), fh, indent=2)
+
+    # generate html table summarizing the stages
+    def gen_html_str(self, title='Run time summary'):
+        def fmt(val, ndigits=2):
+            if val is None:
+                return '-'
+            if isinstance(val, float):
+                return f'{val:,.{ndigits}f}'
+            return f'{val:,}'
+
+        doc, tag, text = Doc().tagtext()
+        with tag('h2'):
+            text(title)
+        wall_time, cpu_time = self.total_time()
+        with tag('p'):
+            text(f'Total wall time: {wall_time:.2f}s, total CPU time: {cpu_time:.2f}s, peak memory: {fmt(get_peak_rss(), 1)}MB')
+        with tag('table', klass='metrics'):
+            with tag('tr'):
+                for col in ['Stage', 'Calls', 'Wall time (s)', 'CPU time (s)', 'Peak RSS (MB)',
+                            'Sequences', 'Bases', 'Sequences/s', 'Bases/s']:
+                    with tag('th'):
+                        text(col)
+            for res in self.summarize():
+                with tag('tr'):
+                    for val in [res['stage'], res['n_call'], fmt(res['wall_time']), fmt(res['cpu_time']),
+                                fmt(res['peak_rss_mb'], 1), fmt(res['n_seq']), fmt(res['n_base']),
+                                fmt(res['seq_per_sec'], 0), fmt(res['base_per_sec'], 0)]:
+                        with tag('td'):
+                            text(str(val))
+        html_str = indent(doc.getvalue(), indent_text = True)
+        return html_str
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Description: count-min sketch of kmer hashes, used to drop rare (e.g. singleton) kmers before they enter the exact
+kmer count table
+"""
+import numpy as np
+
+
+class CountMinSketch:
+    """
+    count-min sketch of kmer hashes. The estimated count of a kmer is never lower than its true count, such that
+    filtering by the estimate does not drop any kmer whose true count reaches the threshold.
+
+    Attributes:
+        width: number of counters in each row, rounded up to a power of 2
+        depth: number of rows, each row uses a different hash function
+        conservative: conservative update, only increase the counters that are at the current estimate, which
+            reduces the overestimation of rare kmers
+        table: counter table, np.ndarray of shape (depth, width)
+        n_total: total count added to the sketch
+    """
+    def __init__(self, width=2**22, depth=4, conservative=False, seed=0):
+        assert width > 1 and depth > 0
+        self.n_bit = int(np.ceil(np.log2(width)))
+        self.width = 1 << self.n_bit
+        self.depth = depth
+        self.conservative = conservative
+        self.table = np.zeros((depth, self.width), dtype=np.uint32)
+        self.n_total = 0
+
+        # odd multipliers and offsets of the multiply-shift hash functions
+        rng = np.random.default_rng(seed)
+        self.mul_arr = rng.integers(1, 2**63, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.add_arr = rng.integers(0, 2**63, size=depth, dtype=np.uint64)
+
+    def get_index(self, kh_arr: np.ndarray) -> np.ndarray:
+        # counter index of each kmer hash in each row, shape (depth, len(kh_arr))
+        kh_arr = np.array(kh_arr, dtype=np.uint64)
+        ind_arr = np.empty((self.depth, len(kh_arr)), dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            # splitmix64 finalizer, kmer hashes are far from random, e.g. all kmers of a short length are dense
+            kh_arr ^= kh_arr >> np.uint64(30)
+            kh_arr *= np.uint64(0xbf58476d1ce4e5b9)
+            kh_arr ^= kh_arr >> np.uint64(27)
+            kh_arr *= np.uint64(0x94d049bb133111eb)
+            kh_arr ^= kh_arr >> np.uint64(31)
+            for i in range(self.depth):
+                np.multiply(kh_arr, self.mul_arr[i], out=ind_arr[i])
+                ind_arr[i] += self.add_arr[i]
+        ind_arr >>= np.uint64(64 - self.n_bit)
+        return ind_arr.astype(np.intp)
+
+    def add(self, kh_arr: np.ndarray, cnt_arr=None):
+        """
+        add kmers to the sketch
+        Args:
+            kh_arr: kmer hash array, unique if conservative update is used
+            cnt_arr: count of each kmer, 1 if None
+        """
+        if cnt_arr is None:
+            cnt_arr = np.ones(len(kh_arr), dtype=np.uint32)
+        cnt_arr = np.asarray(cnt_arr, dtype=np.uint32)
+        ind_arr = self.get_index(kh_arr)
+        self.n_total += int(cnt_arr.sum(dtype=np.int64))
+        if self.conservative:
+            new_cnt_arr = self.table[np.arange(self.depth)[:, None], ind_arr].min(axis=0) + cnt_arr
+            for i in range(self.depth):
+                np.maximum.at(self.table[i], ind_arr[i], new_cnt_arr)
+        else:
+            for i in range(self.depth):
+                np.add.at(self.table[i], ind_arr[i], cnt_arr)
+
+    def query(self, kh_arr: np.ndarray) -> np.ndarray:
+        # estimated count of each kmer, an upper bound of the true count
+        ind_arr = self.get_index(kh_arr)
+        return self.table[np.arange(self.depth)[:, None], ind_arr].min(axis=0)
+
+    def estimate_distinct(self) -> int:
+        # estimate the number of distinct kmers added by linear counting on the fraction of empty counters
+        n_zero = np.count_nonzero(self.table == 0, axis=1)
+        if np.any(n_zero == 0):
+            print(f"Count-min sketch of width {self.width} is full, the number of distinct kmers is underestimated")
+        n_zero = np.maximum(n_zero, 1)
+        return int(round(np.mean(-self.width * np.log(n_zero / self.width))))
+
+
+def get_filter_stats(sketch: CountMinSketch, min_count: int, n_total_kmer: int, n_kept_distinct: int,
+                     n_kept_kmer: int):
+    """
+    summarize the kmers removed by the min_count filter
+    Args:
+        sketch: count-min sketch, all distinct kmers must have been added to it
+        min_count: minimum count of a kept kmer
+        n_total_kmer: total count of all kmers
+        n_kept_distinct: number of distinct kmers kept
+        n_kept_kmer: total count of the kmers kept
+    Returns:
+        a dictionary of the filter statistics, the numbers of distinct kmers are estimated
+    """
+    n_filtered_kmer = max(n_total_kmer - n_kept_kmer, 0)
+    # each filtered distinct kmer accounts for at least one filtered kmer
+    n_filtered_distinct = min(max(sketch.estimate_distinct() - n_kept_distinct, 0), n_filtered_kmer)
+    return {'min_count': min_count, 'n_total_kmer': n_total_kmer, 'n_kept_kmer': n_kept_kmer,
+            'n_filtered_kmer': n_filtered_kmer, 'n_distinct_kmer_est': n_kept_distinct + n_filtered_distinct,
+            'n_kept_distinct': n_kept_distinct, 'n_filtered_distinct_est': n_filtered_distinct}
@@ -1,13 +1,118 @@
-import re
-from Bio import SeqIO
+import bisect
 import gzip
-from Bio.Seq import Seq
+import os
+import re
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from inimotif_core import KmerCounter
+from inimotif_io import format_fasta, read_fasta_batches
+from inimotif_hits import iter_fasta_hits, get_motif_spec, write_hits
+from kmer_count_async import MISSING_VAL, dna2arr, get_seq_hash_arr
 from yattag import Doc,indent
-from windows import gen_full_win_list
+from windows import gen_label_win_list, paint_intervals
 import warnings
 
 
+def seq2arr(in_str):
+    # ascii codes of a sequence string as a numpy uint8 array
+    return np.frombuffer(in_str.encode("ascii", "replace"), dtype=np.uint8)
+
+
+def has_border(unit_arr):
+    # if a proper prefix of the unit equals its suffix, e.g. "AA", "ATA", "ATAT", copies of such a unit can overlap
+    period = len(unit_arr)
+    return any(np.array_equal(unit_arr[:i], unit_arr[period - i:]) for i in range(1, period))
+
+
+def find_tandem_runs(seq_arr, unit_arr, n_min_rep, n_max_rep=None, blocked_arr=None):
+    """
+    find the matches of the regular expression (unit){n_min_rep,n_max_rep} as found by re.sub, i.e. leftmost,
+    non-overlapping and greedy
+    Args:
+        seq_arr: ascii codes of the sequence
+        unit_arr: ascii codes of the repeat unit
+        n_min_rep: minimum number of copies
+        n_max_rep: maximum number of copies of one match, a longer run is split into several matches
+        blocked_arr: if given, a boolean array of the positions no copy may overlap, e.g. the positions masked by "N"
+            before the expression is matched
+    Returns:
+        start and end positions of the matches
+    """
+    period = len(unit_arr)
+    n_pos = len(seq_arr) - period + 1
+    if n_pos <= 0 or period == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # match_arr[i]: a copy of the unit starts at position i
+    match_arr = np.ones(n_pos, dtype=bool)
+    for i in range(period):
+        match_arr &= seq_arr[i:i + n_pos] == unit_arr[i]
+    if blocked_arr is not None:
+        cum_arr = np.concatenate([[0], np.cumsum(blocked_arr, dtype=np.int64)])
+        match_arr &= cum_arr[period:period + n_pos] == cum_arr[:n_pos]
+    n_min_rep = max(n_min_rep, 1)
+
+    # tandem copies start at i, i+period, i+2*period, ..., a column for each position modulo period,
+    # the last row is False such that each column ends with a break
+    n_row = -(-n_pos // period) + 1
+    chain_arr = np.zeros(n_row * period, dtype=bool)
+    chain_arr[:n_pos] = match_arr
+    chain_arr = chain_arr.reshape(n_row, period).T.reshape(-1).view(np.int8)
+    diff_arr = np.diff(chain_arr, prepend=np.int8(0))
+    st_arr = np.flatnonzero(diff_arr == 1)
+    n_rep_arr = np.flatnonzero(diff_arr == -1) - st_arr
+    keep_inds = n_rep_arr >= n_min_rep
+    st_arr = st_arr[keep_inds] % n_row * period + st_arr[keep_inds] // n_row
+    n_rep_arr = n_rep_arr[keep_inds]
+
+    if not has_border(unit_arr):
+        # copies of the unit never overlap, such that the runs of different columns are disjoint and each run is
+        # matched from its start, split into matches of n_max_rep copies
+        if n_max_rep:
+            res_arr = n_rep_arr % n_max_rep
+            n_rep_arr = n_rep_arr - np.where(res_arr < n_min_rep, res_arr, 0)
+        return st_arr, st_arr + n_rep_arr * period
+
+    # runs of different columns may overlap, scan from left to right like the regular expression.
+    # Every copy followed by at least n_min_rep-1 copies in its run is a candidate start of a match
+    n_cand_arr = n_rep_arr - n_min_rep + 1
+    offset_arr = np.arange(n_cand_arr.sum()) - np.repeat(np.cumsum(n_cand_arr) - n_cand_arr, n_cand_arr)
+    cand_arr = np.repeat(st_arr, n_cand_arr) + offset_arr * period
+    cand_rep_arr = np.repeat(n_rep_arr, n_cand_arr) - offset_arr
+    inds = np.argsort(cand_arr, kind="stable")
+    cand_list, cand_rep_list = cand_arr[inds].tolist(), cand_rep_arr[inds].tolist()
+    res_st_list, res_ed_list = [], []
+    i_cand = 0
+    while i_cand < len(cand_list):
+        st = cand_list[i_cand]
+        n_rep = min(cand_rep_list[i_cand], n_max_rep) if n_max_rep else cand_rep_list[i_cand]
+        res_st_list.append(st)
+        res_ed_list.append(st + n_rep * period)
+        i_cand = bisect.bisect_left(cand_list, st + n_rep * period, i_cand + 1)
+    return np.array(res_st_list, dtype=np.int64), np.array(res_ed_list, dtype=np.int64)
+
+
+def find_kmer_hits(hash_arr, sorted_kh_arr):
+    # positions of the kmers whose hash is in sorted_kh_arr
+    if len(sorted_kh_arr) == 0:
+        return np.zeros(0, dtype=np.int64)
+    pos_arr = np.searchsorted(sorted_kh_arr, hash_arr)
+    np.minimum(pos_arr, len(sorted_kh_arr) - 1, out=pos_arr)
+    return np.flatnonzero(sorted_kh_arr[pos_arr] == hash_arr)
+
+
+def get_primitive_unit_lut(period):
+    # lut[h] is True if the unit of hash h (period bases) is not a repeat of a shorter unit, e.g. "CA" but not "AA"
+    h_arr = np.arange(4 ** period, dtype=np.int64)
+    lut = np.ones(4 ** period, dtype=bool)
+    for d in range(1, period):
+        if period % d == 0:
+            # a unit is a repeat of its first d bases if it equals its rotation by d bases
+            rot_arr = ((h_arr << 2 * d) | (h_arr >> 2 * (period - d))) & (4 ** period - 1)
+            lut &= rot_arr != h_arr
+    return lut
+
+
 # a pattern for matching DNA repeats
 class RepeatPattern:
     def __init__(self, seq, n_min_rep, revcom_flag=True, n_max_rep=None):
@@ -16,6 +121,9 @@ class RepeatPattern:
         seq = seq.upper()
         n_min_rep = int(n_min_rep)
         
+        self.seq = seq
+        self.n_min_rep = n_min_rep
+        self.n_max_rep = n_max_rep
         if n_max_rep is None:
             n_max_rep = ''
         self.forward_pattern = re.compile(f'({seq}){{{n_min_rep},{n_max_rep}}}')
@@ -23,6 +131,7 @@ class RepeatPattern:
         if self.revcom_flag:
             kmer_counter = KmerCounter(len(seq))
             revcom_seq = kmer_counter.revcom(seq)
+            self.revcom_seq = revcom_seq
             self.revcom_pattern = re.compile(f'({revcom_seq}){{{n_min_rep},{n_max_rep}}}')
     
     def mask(self, in_str):
@@ -33,6 +142,83 @@ class RepeatPattern:
             in_str = re.sub(self.revcom_pattern, myrepl, in_str)
         return in_str
 
+# short tandem repeats of any unit up to a given period
+class TandemRepeatPattern:
+    """
+    runs of at least n_min_rep tandem copies of any unit of period 1 to max_period, e.g. microsatellites.
+    For each period p, the encoded sequence is compared with itself shifted by p bases, a run of n_min_rep copies is
+    a stretch of at least (n_min_rep-1)*p matching positions. The whole run is masked, including a trailing
+    partial copy of the unit. A run is reported at its shortest period only, e.g. "AAAAAA" is a run of "A" but
+    not of "AA".
+
+    Attributes:
+        n_min_rep: minimum number of copies, at least 2
+        max_period: maximum length of the repeat unit
+        unit_list: if given, only runs of these units are found, a unit also matches its rotations (e.g. "CA" and
+            "AC") and, if revcom_flag is True, the rotations of its reverse complement
+        unit_lut_list: unit_lut_list[p][h] is True if a run of the unit of period p with hash h is found
+    """
+    def __init__(self, n_min_rep, max_period=6, unit_list=None, revcom_flag=True):
+        n_min_rep = int(n_min_rep)
+        assert n_min_rep >= 2, f'n_min_rep={n_min_rep} should be at least 2'
+        assert 1 <= max_period <= 10, f'max_period={max_period} should be 1-10'
+        self.n_min_rep = n_min_rep
+        self.max_period = max_period
+        self.revcom_flag = revcom_flag
+        self.unit_list = None if unit_list is None else [unit.upper() for unit in unit_list]
+
+        self.unit_lut_list = [None]
+        for period in range(1, max_period + 1):
+            lut = get_primitive_unit_lut(period)
+            if self.unit_list is not None:
+                lut = np.zeros_like(lut)
+            self.unit_lut_list.append(lut)
+        for unit in self.unit_list or []:
+            period = len(unit)
+            assert 1 <= period <= max_period, f'repeat unit {unit} should be 1-{max_period} bases'
+            kc = KmerCounter(period)
+            if not get_primitive_unit_lut(period)[kc.kmer2hash(unit)]:
+                raise Exception(f'repeat unit {unit} is a repeat of a shorter unit')
+            seq_list = [unit, kc.revcom(unit)] if revcom_flag else [unit]
+            for seq in seq_list:
+                for i in range(period):
+                    self.unit_lut_list[period][kc.kmer2hash(seq[i:] + seq[:i])] = True
+
+    def find_runs(self, in_str):
+        # start and end positions of the tandem repeat runs, runs of different periods may overlap
+        code_arr = dna2arr(in_str)[:-1]
+        st_list, ed_list = [], []
+        for period in range(1, self.max_period + 1):
+            lut = self.unit_lut_list[period]
+            if len(code_arr) < 2 * period or not lut.any():
+                continue
+            # match_arr[i]: base i equals base i+period
+            match_arr = (code_arr[:-period] == code_arr[period:]) & (code_arr[period:] != MISSING_VAL)
+            diff_arr = np.diff(match_arr.view(np.int8), prepend=np.int8(0), append=np.int8(0))
+            st_arr = np.flatnonzero(diff_arr == 1)
+            ed_arr = np.flatnonzero(diff_arr == -1)
+            keep_inds = ed_arr - st_arr >= (self.n_min_rep - 1) * period
+            st_arr, ed_arr = st_arr[keep_inds], ed_arr[keep_inds]
+
+            # the unit is the first period bases of a run
+            unit_hash_arr = np.zeros(len(st_arr), dtype=np.int64)
+            for i in range(period):
+                unit_hash_arr = (unit_hash_arr << 2) | code_arr[st_arr + i]
+            keep_inds = lut[unit_hash_arr]
+            st_list.append(st_arr[keep_inds])
+            ed_list.append(ed_arr[keep_inds] + period)
+        if not st_list:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(st_list), np.concatenate(ed_list)
+
+    def mask(self, in_str):
+        st_arr, ed_arr = self.find_runs(in_str)
+        if len(st_arr) == 0:
+            return in_str
+        out_arr = seq2arr(in_str).copy()
+        out_arr[paint_intervals(st_arr, ed_arr, len(out_arr))] = ord('N')
+        return out_arr.tobytes().decode("ascii")
+
 class Motif:
     def __init__(self, seq, n_max_mutation=0, revcom_flag=True):
         assert n_max_mutation<len(seq), f'n_max_mutation={n_max_mutation} is smaller than seq length {len(seq)}!'
@@ -47,6 +233,7 @@ class Motif:
         self.n_max_mutation = n_max_mutation
         
         forward_seq_hash = kc.kmer2hash(seq)
+        self.forward_hash = forward_seq_hash
         self.forward_hamball = kc.get_hamming_ball(forward_seq_hash,n_max_mutation)
         
         self.revcom_flag = revcom_flag
@@ -55,6 +242,10 @@ class Motif:
             self.is_palindrome = forward_seq_hash==revcom_seq_hash
             self.revcom_seq = kc.hash2kmer(revcom_seq_hash)
             self.revcom_hamball = kc.get_hamming_ball(revcom_seq_hash,n_max_mutation)
+        
+        # sorted hashes of all kmers matching the motif, used by the vectorized masking
+        hamball = self.forward_hamball | self.revcom_hamball if revcom_flag else self.forward_hamball
+        self.hamball_arr = np.sort(np.array(list(hamball), dtype=kc.dtype))
     
     def __str__(self):
         if not self.revcom_flag:
@@ -65,109 +256,204 @@ class Motif:
             return f'{self.seq} (Forward) {self.revcom_seq} (Revcom) n_max_mutation={self.n_max_mutation}'
     
     def mask(self, in_str):
-        in_str_list = [c for c in in_str]
-        len_str = len(in_str)
-        k = self.kc.k
-
-        i=0
-        prev_hash = self.kc.dtype(-1)
-        while(i<=len_str-k):
-            tmpstr = in_str[i:i+k]
-            # omit a kmer if it contains "N"
-            if "N" in tmpstr:
-                i += 1 + max([pos for pos,char in enumerate(tmpstr) if char == 'N'])
-                prev_hash = self.kc.dtype(-1)
-                continue
-            if prev_hash==self.kc.dtype(-1):
-                tmphash = self.kc.kmer2hash(tmpstr)
-            # reuse hash in previous position
-            else:
-                tmphash = (prev_hash<< self.kc.dtype(2) ) & self.kc.mask
-                tmphash += self.kc.base[ in_str[i+k-1] ]
-            prev_hash = tmphash
-            forward_flag = tmphash in self.forward_hamball
-            revcom_flag = self.revcom_flag and (tmphash in self.revcom_hamball)
-            if forward_flag or revcom_flag:
-                # prev_hash = self.kc.dtype(-1)
-                for ii in range(i,i+k):
-                    in_str_list[ii] = 'N' 
-                # i += k
-                # continue
-            i += 1
-        return "".join(in_str_list)
+        # hits are painted into a coverage mask by a difference array, which is applied to the sequence at once
+        st_arr = find_kmer_hits(get_seq_hash_arr(in_str, self.kc.k), self.hamball_arr)
+        if len(st_arr) == 0:
+            return in_str
+        out_arr = seq2arr(in_str).copy()
+        out_arr[paint_intervals(st_arr, st_arr + self.kc.k, len(out_arr))] = ord('N')
+        return out_arr.tobytes().decode("ascii")
     
     # scan motif in input string and report its locations
-    def scan(self, in_str):
-        pos_list = []
-        len_str = len(in_str)
-        k = self.kc.k
-
-        i=0
-        prev_hash = self.kc.dtype(-1)
-        while(i<=len_str-k):
-            tmpstr = in_str[i:i+k]
-            # omit a kmer if it contains "N"
-            if "N" in tmpstr:
-                i += 1 + max([pos for pos,char in enumerate(tmpstr) if char == 'N'])
-                prev_hash = self.kc.dtype(-1)
-                continue
-            if prev_hash==self.kc.dtype(-1):
-                tmphash = self.kc.kmer2hash(tmpstr)
-            # reuse hash in previous position
+    def scan(self, in_str, hash_arr=None):
+        # hash_arr: kmer hashes of in_str, see get_seq_hash_arr, shared by motifs of the same length
+        if hash_arr is None:
+            hash_arr = get_seq_hash_arr(in_str, self.kc.k)
+        return find_kmer_hits(hash_arr, self.hamball_arr).tolist()
+    
+    # the motif as scanned by iter_fasta_hits, identified by its sequence
+    def get_spec(self):
+        return get_motif_spec(self.seq, self.kc, self.forward_hash, self.n_max_mutation, self.revcom_flag)
+
+class MaskPlan:
+    """
+    all patterns of a Masker compiled into one masking pass. The repeat units are found by a vectorized run
+    detection on the sequence, the motifs are grouped by length and found by one hash pass per length. The runs and
+    hits of all patterns are painted into one boolean mask, which is applied to the sequence once.
+
+    Attributes:
+        rep_list: list of (unit, revcom unit or None, n_min_rep, n_max_rep) of the repeat patterns
+        tandem_list: list of TandemRepeatPattern
+        motif_dict: motif length -> sorted hashes of the hamming balls of all motifs of this length
+    """
+    def __init__(self, pattern_list):
+        rep_set = set()
+        motif_dict = {}
+        self.tandem_list = []
+        for pat in pattern_list:
+            if isinstance(pat, RepeatPattern):
+                # a palindromic unit finds no further match on the reverse strand
+                revcom_seq = pat.revcom_seq if pat.revcom_flag and pat.revcom_seq != pat.seq else None
+                rep_set.add((pat.seq, revcom_seq, pat.n_min_rep, pat.n_max_rep))
+            elif isinstance(pat, TandemRepeatPattern):
+                self.tandem_list.append(pat)
+            elif isinstance(pat, Motif):
+                motif_dict.setdefault(pat.kc.k, []).append(pat.hamball_arr)
             else:
-                tmphash = (prev_hash<< self.kc.dtype(2) ) & self.kc.mask
-                tmphash += self.kc.base[ in_str[i+k-1] ]
-            prev_hash = tmphash
-            forward_flag = tmphash in self.forward_hamball
-            revcom_flag = self.revcom_flag and (tmphash in self.revcom_hamball)
-            if forward_flag or revcom_flag:
-                # prev_hash = self.kc.dtype(-1)
-                pos_list.append(i)
-                # i += k
-                # continue
-            i += 1
-        return pos_list
+                raise Exception(f"Unknown masking pattern {type(pat)}")
+        self.rep_list = [(seq2arr(seq), None if revcom_seq is None else seq2arr(revcom_seq), n_min_rep, n_max_rep)
+                         for seq, revcom_seq, n_min_rep, n_max_rep in sorted(rep_set, key=str)]
+        self.motif_dict = {k: np.unique(np.concatenate(kh_arr_list)) for k, kh_arr_list in sorted(motif_dict.items())}
+
+    def get_mask(self, in_str):
+        # boolean mask of the positions of in_str covered by any pattern, in_str should be upper case
+        seq_arr = seq2arr(in_str)
+        st_list, ed_list = [], []
+        for unit_arr, revcom_unit_arr, n_min_rep, n_max_rep in self.rep_list:
+            st_arr, ed_arr = find_tandem_runs(seq_arr, unit_arr, n_min_rep, n_max_rep)
+            st_list.append(st_arr)
+            ed_list.append(ed_arr)
+            if revcom_unit_arr is not None:
+                # as RepeatPattern.mask, the reverse complement is matched after the forward matches are masked
+                st_arr, ed_arr = find_tandem_runs(seq_arr, revcom_unit_arr, n_min_rep, n_max_rep,
+                                                  blocked_arr=paint_intervals(st_arr, ed_arr, len(seq_arr)))
+                st_list.append(st_arr)
+                ed_list.append(ed_arr)
+        for pat in self.tandem_list:
+            st_arr, ed_arr = pat.find_runs(in_str)
+            st_list.append(st_arr)
+            ed_list.append(ed_arr)
+        for k, kh_arr in self.motif_dict.items():
+            st_arr = find_kmer_hits(get_seq_hash_arr(in_str, k), kh_arr)
+            st_list.append(st_arr)
+            ed_list.append(st_arr + k)
+        if not st_list:
+            return np.zeros(len(seq_arr), dtype=bool)
+        return paint_intervals(np.concatenate(st_list), np.concatenate(ed_list), len(seq_arr))
+
+    def mask(self, in_str):
+        mask_arr = self.get_mask(in_str)
+        if not mask_arr.any():
+            return in_str
+        out_arr = seq2arr(in_str).copy()
+        out_arr[mask_arr] = ord('N')
+        return out_arr.tobytes().decode("ascii")
+
 
 class Masker:
+    """
+    mask repeats and motifs in sequences by "N"
+
+    All patterns are compiled into one MaskPlan and matched against the input sequence independently, a base is
+    masked if it is covered by any pattern. Earlier versions applied the patterns one after another, such that a
+    pattern did not match across the bases masked by an earlier pattern, e.g. a motif overlapping a masked repeat
+    was kept. A single repeat pattern is matched as by RepeatPattern.mask: the leftmost non-overlapping greedy runs of
+    the unit, then the runs of its reverse complement outside of them.
+    """
     def __init__(self):
         self.pattern_list = []
+        self.plan = None
     
     def clear(self):
         self.pattern_list = []
+        self.plan = None
     
     # add repetitive pattern    
     def add_reppat(self, seq, n_min_rep, revcom_flag):
         self.pattern_list.append( RepeatPattern(seq, n_min_rep, revcom_flag) )
+        self.plan = None
+    
+    # add all short tandem repeats up to max_period, optionally only of the units in unit_list
+    def add_tandem_repeats(self, n_min_rep, max_period=6, unit_list=None, revcom_flag=True):
+        self.pattern_list.append( TandemRepeatPattern(n_min_rep, max_period, unit_list, revcom_flag) )
+        self.plan = None
     
     # add motif
     def add_motif(self, seq, n_max_mutation, revcom_flag):
         self.pattern_list.append( Motif(seq, n_max_mutation, revcom_flag) )
+        self.plan = None
+    
+    def get_plan(self):
+        # compile the patterns once, until a pattern is added
+        if self.plan is None:
+            self.plan = MaskPlan(self.pattern_list)
+        return self.plan
         
     def mask(self,in_str):
         in_str = in_str.upper()
-        for pat in self.pattern_list:
-            in_str = pat.mask(in_str)
-        return in_str
+        return self.get_plan().mask(in_str)
+    
+    def mask_list(self, seq_list):
+        # mask many sequences in one pass, joined by a newline, which no pattern matches across
+        return self.mask("\n".join(seq_list)).split("\n")
     
-    def mask_file(self,input_fasta_file_name, out_file=None):
+    def mask_file(self, input_fasta_file_name, out_file=None, n_workers=None, executor_type="process",
+                  batch_size=2**22, line_width=60):
+        """
+        mask all sequences of a fasta file. A reader streams batches of records, a pool of workers masks the batches
+        and the masked records are written in the input order as plain fasta text.
+        Args:
+            input_fasta_file_name: input fasta file, may be gzip compressed
+            out_file: output fasta file, gzip compressed if it ends with ".gz", {input_fasta_file_name}.mask.fasta
+                if None
+            n_workers: number of batches masked concurrently, number of cpus if None, 1 masks on the main thread
+            executor_type: mask the batches in a "process" or "thread" pool
+            batch_size: number of bases of a batch of records
+            line_width: number of bases in each line of the output, 0 writes each sequence in one line
+        """
         if out_file is None:
             out_file = f'{input_fasta_file_name}.mask.fasta'
-            
-        foh = open(out_file,'w')
-        if input_fasta_file_name.endswith(".gz"):
-            fh = gzip.open(input_fasta_file_name,"rt")
-        else:
-            fh = open(input_fasta_file_name, "r")
-            
-        for rec in SeqIO.parse(fh,"fasta"):
-            tmpstr = self.mask(str(rec.seq))
-            rec.seq = Seq(tmpstr)
-            SeqIO.write(rec,foh,'fasta')
-        
-        foh.close()
-        fh.close()
-        
-        
+        assert executor_type in ("process", "thread"), f'Unknown executor_type={executor_type}'
+        n_workers = n_workers if n_workers else os.cpu_count()
+        self.get_plan()  # compile once, the workers get the compiled plan
+
+        open_func = gzip.open if out_file.endswith(".gz") else open
+        with open_func(out_file, 'wt') as foh:
+            if n_workers == 1:
+                for batch in read_fasta_batches(input_fasta_file_name, batch_size):
+                    foh.write(mask_fasta_batch(self, batch, line_width))
+                return
+
+            if executor_type == "process":
+                # the masker is sent to each worker process once, only the batches are sent with the tasks
+                executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_mask_worker, initargs=(self,))
+                task_func, task_args = _mask_fasta_batch_worker, ()
+            else:
+                executor = ThreadPoolExecutor(max_workers=n_workers)
+                task_func, task_args = mask_fasta_batch, (self,)
+            with executor:
+                # at most 2*n_workers batches in flight, results are written in the order of submission
+                pending = deque()
+                for batch in read_fasta_batches(input_fasta_file_name, batch_size):
+                    pending.append(executor.submit(task_func, *task_args, batch, line_width))
+                    if len(pending) >= 2 * n_workers:
+                        foh.write(pending.popleft().result())
+                while pending:
+                    foh.write(pending.popleft().result())
+
+
+def mask_fasta_batch(masker, batch, line_width=60):
+    # mask a batch of records and return the fasta text, runs in the worker pool
+    seq_list = masker.mask_list([seq for _, seq in batch])
+    return ''.join(format_fasta(title, seq, line_width) for (title, _), seq in zip(batch, seq_list))
+
+
+# masker of a worker process of Masker.mask_file, set once by the initializer of the process pool
+_WORKER_MASKER = None
+
+
+def _init_mask_worker(masker):
+    global _WORKER_MASKER
+    _WORKER_MASKER = masker
+
+
+def _mask_fasta_batch_worker(batch, line_width=60):
+    return mask_fasta_batch(_WORKER_MASKER, batch, line_width)
+
+
+# colors of the motifs in the html output of MotifScanner, overlaps of motifs are green
+MOTIF_COLORS = ['red', 'blue', 'orange', 'purple', 'brown', 'magenta', 'teal', 'olive', 'navy', 'maroon']
+
 
 class MotifScanner:
     def __init__(self):
@@ -180,9 +466,36 @@ class MotifScanner:
         self.motif_list.append( Motif(seq, n_max_mutation, revcom_flag) )
         
     def scan(self, in_str):
-        res_list = [m.scan(in_str) for m in self.motif_list]  # nested list
+        # each distinct motif length is hashed once
+        hash_dict = {}
+        res_list = []
+        for m in self.motif_list:
+            if m.kc.k not in hash_dict:
+                hash_dict[m.kc.k] = get_seq_hash_arr(in_str, m.kc.k)
+            res_list.append(m.scan(in_str, hash_dict[m.kc.k]))
+        return res_list  # nested list
+    
+    def scan_list(self, seq_list):
+        # scan many sequences in one pass, joined by "N", which no motif matches across.
+        # Returns a nested list for each sequence, see scan
+        seq_st_arr = np.cumsum([0] + [len(seq) + 1 for seq in seq_list[:-1]], dtype=np.int64)
+        res_list = [[] for _ in seq_list]
+        for pos_list in self.scan("N".join(seq_list)):
+            pos_arr = np.array(pos_list, dtype=np.int64)
+            i_seq_arr = np.searchsorted(seq_st_arr, pos_arr, side='right') - 1
+            split_inds = np.searchsorted(i_seq_arr, np.arange(1, len(seq_list)))
+            for res, sub_pos_arr in zip(res_list, np.split(pos_arr - seq_st_arr[i_seq_arr], split_inds)):
+                res.append(sub_pos_arr.tolist())
         return res_list
     
+    def iter_hits(self, input_fasta_file_name):
+        # generator of the hits (MotifHit) of all motifs in a fasta file, see inimotif_hits
+        return iter_fasta_hits(input_fasta_file_name, [m.get_spec() for m in self.motif_list])
+    
+    def export_hits(self, input_fasta_file_name, out_file, file_format=None):
+        # write the hits as BED or TSV lines while scanning, returns the number of hits, see HitWriter
+        return write_hits(self.iter_hits(input_fasta_file_name), out_file, file_format)
+    
     def _get_style_str(self):
         style_str = """
         body {
@@ -192,30 +505,23 @@ class MotifScanner:
             word-break: break-all;
             white-space: normal;
         }
-        motif1{
-            color: red;
-        }
-        motif2{
-            color: blue;
-        }
-        overlap{
+        """
+        for i in range(len(self.motif_list)):
+            style_str += f"""motif{i+1}{{
+            color: {MOTIF_COLORS[i % len(MOTIF_COLORS)]};
+        }}
+        """
+        style_str += """overlap{
             color: green;
         }
         """
         return style_str
     
     def scan_file(self, input_fasta_file_name, out_file="motif_scan.html"):
-        if len(self.motif_list)>2:
-            self.motif_list = self.motif_list[0:2]
-            warnings.warn('Currently only support scanning first two motifs')
         if not out_file.endswith(".html"):
             out_file += ".html"
             warnings.warn(f'add html suffix to out_file="{out_file}"')
         
-        if input_fasta_file_name.endswith(".gz"):
-            fh = gzip.open(input_fasta_file_name,"rt")
-        else:
-            fh = open(input_fasta_file_name, "r")
         style_str = self._get_style_str()
         doc, tag, text = Doc().tagtext()
         doc.asis('<!DOCTYPE html>')
@@ -238,41 +544,40 @@ class MotifScanner:
                         with tag(f'motif{i+1}'):
                             text(f'motif {i+1}: {str(motif)}')
                             doc.stag('br')
-                for rec in SeqIO.parse(fh,"fasta"):
-                    tmpseq = str(rec.seq).upper()
-                    m1_pos_list,m2_pos_list = self.scan(tmpseq)
-                    if not m1_pos_list and not m2_pos_list:
-                        continue
-                    
-                    win_list,win_type_list = gen_full_win_list(m1_pos_list, m2_pos_list,
-                                                                len(self.motif_list[0].seq),len(self.motif_list[1].seq), len(tmpseq))
-
-                    with tag('p'):
-                        # output header
-                        text(">"+rec.id)
-                        # output line break
-                        doc.stag('br')
-                        # output sequence
-                        for win,win_type in zip(win_list, win_type_list):
-                            if win_type==0:
-                                text(tmpseq[win[0]:win[1]])
-                            elif win_type==1:
-                                with tag('motif1'):
-                                    text(tmpseq[win[0]:win[1]])
-                            elif win_type==2:
-                                with tag('motif2'):
-                                    text(tmpseq[win[0]:win[1]])
-                            elif win_type==3:
-                                with tag('overlap'):
-                                    text(tmpseq[win[0]:win[1]])
-                            else:
-                                warnings.warn(f'Unkown win_type={win_type}')
-        fh.close()
+                kmer_len_list = [len(m.seq) for m in self.motif_list]
+                for batch in read_fasta_batches(input_fasta_file_name):
+                    seq_list = [seq.upper() for _, seq in batch]
+                    for (title, _), tmpseq, pos_list_list in zip(batch, seq_list, self.scan_list(seq_list)):
+                        if not any(pos_list_list):
+                            continue
+                        self._add_html_seq(doc, title.split(None, 1)[0] if title else '', tmpseq, pos_list_list,
+                                           kmer_len_list)
 
         html_str = indent(doc.getvalue(), indent_text = True) # will also indent the text directly contained between <tag> and </tag>
         with open(out_file,'w') as out_fh:
             out_fh.write(html_str)
 
+    def _add_html_seq(self, doc, seq_id, tmpseq, pos_list_list, kmer_len_list):
+        # add a sequence to the html document, colored by the motifs covering each window
+        tag, text = doc.tag, doc.text
+        win_list,label_list = gen_label_win_list(pos_list_list, kmer_len_list, len(tmpseq))
+        with tag('p'):
+            # output header
+            text(">"+seq_id)
+            # output line break
+            doc.stag('br')
+            # output sequence
+            for win,label in zip(win_list, label_list):
+                motif_ind_list = [i for i in range(len(self.motif_list)) if label >> i & 1]
+                if not motif_ind_list:
+                    text(tmpseq[win[0]:win[1]])
+                elif len(motif_ind_list)==1:
+                    with tag(f'motif{motif_ind_list[0]+1}'):
+                        text(tmpseq[win[0]:win[1]])
+                else:
+                    with tag('overlap', title=' '.join(f'motif{i+1}' for i in motif_ind_list)):
+                        text(tmpseq[win[0]:win[1]])
+
     
 if __name__=="__main__":
     # in_str = 'AAAAAAAAAAACGTGCCCCCGTGGGGGCGTGAAAACACGCCCCCACGTTTTCACGTTTTCACG'
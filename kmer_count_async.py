@@ -1,14 +1,22 @@
 import asyncio
+import multiprocessing
+import threading
 import numpy as np
 from Bio import SeqIO
-import gzip
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Callable
 import os
-import pickle
-import taichi as ti
-from itertools import chain
-from typing import List
+import json
+import shutil
+import importlib.util
+from typing import List, Tuple
+from inimotif_sketch import CountMinSketch, get_filter_stats
+from inimotif_io import open_seq_file
+from kmer_count_db import KmerCountDB, get_kmer_count_db_file, write_kmer_count_db
 
 """
 Author: Lu Cheng, @chengl7
@@ -19,11 +27,17 @@ Description: kmer counting script
 
 MISSING_VAL = 255
 
-ti.init(arch=ti.cuda, default_ip=ti.i64)
-if ti.cfg.arch == ti.cuda:
-    print("GPU is available")
-else:
-    print("GPU is not available")
+# compute backend, "numpy", "taichi-cpu", "taichi-gpu" or "auto" (taichi-cpu if taichi is installed, otherwise numpy)
+BACKEND_ENV = "INIMOTIF_BACKEND"
+# number of threads of the taichi-cpu backend, all cores if not set
+NUM_THREADS_ENV = "INIMOTIF_NUM_THREADS"
+
+# index of the chunks under the chunk directory, file name, size and number of sequences of each chunk
+CHUNK_INDEX_FILE = "chunk_index.json"
+
+# sequences longer than a chunk are split into pieces overlapping by MAX_KMER_LEN-1 bases by default,
+# such that kmers up to this length crossing a piece boundary are counted exactly once
+MAX_KMER_LEN = 31
 
 
 # create a directory if not exist
@@ -45,19 +59,27 @@ def rm_files(chunk_dir="./chunks"):
                 os.remove(file_path)
 
 
+def read_chunk_index(chunk_dir="./chunks"):
+    # list of chunk records {"file": "chunk_0.npy", "size": ..., "n_seq": ..., "overlap": ..., "cont_pos": [...]}
+    # in the order of chunks, see convert_input_chunks
+    index_file = os.path.join(chunk_dir, CHUNK_INDEX_FILE)
+    if not os.path.exists(index_file):
+        return []
+    with open(index_file, "r") as fh:
+        return json.load(fh)["chunks"]
+
+
+def write_chunk_index(chunk_dir, chunk_list, dtype=np.uint8):
+    with open(os.path.join(chunk_dir, CHUNK_INDEX_FILE), "w") as fh:
+        json.dump({"dtype": np.dtype(dtype).name, "chunks": chunk_list}, fh, indent=2)
+
+
 def get_chunk_file_paths(chunk_dir="./chunks"):
     assert os.path.exists(chunk_dir)
-    files = [file for file in os.listdir(chunk_dir) if file.endswith(".pkl")]
-    files = sorted(files, key=lambda x: int(x.split("_")[1][:-4]))
-    files = [os.path.join(chunk_dir, file) for file in files]
+    files = [os.path.join(chunk_dir, chunk["file"]) for chunk in read_chunk_index(chunk_dir)]
     return files
 
 
-def get_taichi_dtype(np_dtype: np.uint32):
-    dict = {np.uint8: ti.uint8, np.uint16: ti.uint16, np.uint32: ti.uint32, np.uint64: ti.uint64}
-    return dict[np_dtype]
-
-
 class Buffer:
     def __init__(self, buffer_size: int = 2 ** 26, dtype=np.uint8, id=None):
         # 2**26 bytes are 64MB, 2**30 bytes are 1GB
@@ -68,6 +90,60 @@ class Buffer:
         self.data_to_write = None
         self.is_full = False
         self.id = None
+        # start positions of the pieces continuing a split sequence, each starts with overlap bases of the
+        # previous piece, the kmers inside these bases are already counted in the previous piece
+        self.cont_pos_list = []
+        self.overlap = 0
+
+    @classmethod
+    def load_chunk(cls, file_path: str, id=None, cont_pos_list=None, overlap=0):
+        """
+        load a chunk written by save_chunk as a read only memory map, the data are paged in on demand
+        Args:
+            file_path: path of the .npy chunk file
+            id: chunk id
+            cont_pos_list: start positions of the continuation pieces of split sequences, see convert_input_chunks
+            overlap: number of bases a continuation piece overlaps with the previous piece
+        Returns:
+            a full Buffer object whose buffer is the memory mapped array
+        """
+        arr = np.load(file_path, mmap_mode="r")
+        buffer = cls.__new__(cls)
+        buffer.buffer_size = len(arr)
+        buffer.dtype = arr.dtype.type
+        buffer.buffer = arr
+        buffer.pointer = len(arr)
+        buffer.data_to_write = None
+        buffer.is_full = True
+        buffer.id = id
+        buffer.cont_pos_list = list(cont_pos_list) if cont_pos_list else []
+        buffer.overlap = overlap
+        return buffer
+
+    def append_seq_batch(self, seq_list: List[str], soft_mask=False) -> int:
+        """
+        encode DNA strings into the buffer, each sequence is followed by a separator (MISSING_VAL).
+        The sequences are joined with a separator and encoded through the lookup table in one pass.
+        Args:
+            seq_list: list of DNA strings
+            soft_mask: if lower case bases are treated as missing values
+        Returns:
+            number of sequences appended, the first ones that fit into the buffer
+        """
+        assert self.buffer.dtype == np.uint8
+        end_pos_arr = np.cumsum([len(seq) + 1 for seq in seq_list])
+        n_seq = int(np.searchsorted(end_pos_arr, self.buffer_size - self.pointer, side="right"))
+        if n_seq == 0:
+            return 0
+        data_size = int(end_pos_arr[n_seq - 1])
+        # "\n" is not a base, it is encoded as MISSING_VAL
+        encode_dna("\n".join(seq_list[:n_seq]) + "\n", self.buffer[self.pointer:self.pointer + data_size], soft_mask)
+        self.pointer += data_size
+        return n_seq
+
+    def save_chunk(self, file_path: str):
+        # save the valid part of the buffer as a raw .npy file
+        np.save(file_path, self.buffer[:self.pointer])
 
     def append(self, data: np.uint8):
         # append input data into the buffer, return flag of success
@@ -93,6 +169,7 @@ class Buffer:
         self.data_to_write = None
         self.is_full = False
         self.id = None
+        self.cont_pos_list = []
 
 
 class MaxSizeQueue:
@@ -123,39 +200,258 @@ class MaxSizeQueue:
         return self.queue.empty()
 
 
-def dna2arr(dna_str, dtype=np.uint8) -> np.ndarray:
+class ArrayPool:
+    """
+    thread safe pool of preallocated arrays, reused across chunks and kmer lengths.
+    Each array is a raw byte array sized for size elements of at least itemsize bytes, e.g. itemsize=8 for the largest
+    hash dtype, such that it can be viewed as the hash array of any kmer length. At most max_arrays arrays are live,
+    get blocks until one is returned.
+
+    with pool.get(buffer.pointer, np.uint32) as hash_arr:
+        ...
+    """
+    def __init__(self, max_arrays=None, itemsize=8):
+        self.max_arrays = max_arrays if max_arrays else os.cpu_count()
+        self.itemsize = itemsize
+        self.n_arrays = 0  # number of allocated arrays, free and in use
+        self.free_list = []
+        self.cond = threading.Condition()
+
+    def _acquire(self, nbytes):
+        with self.cond:
+            while True:
+                fit_inds = [i for i, arr in enumerate(self.free_list) if len(arr) >= nbytes]
+                if fit_inds:
+                    return self.free_list.pop(min(fit_inds, key=lambda i: len(self.free_list[i])))
+                if self.n_arrays < self.max_arrays:
+                    self.n_arrays += 1
+                    break
+                if self.free_list:
+                    # only smaller arrays are free, replace one by a larger array
+                    self.free_list.pop()
+                    break
+                self.cond.wait()
+        # allocate outside of the lock, large allocations are slow
+        return np.empty(nbytes, dtype=np.uint8)
+
+    def _release(self, arr):
+        with self.cond:
+            if self.n_arrays > self.max_arrays:
+                self.n_arrays -= 1
+            else:
+                self.free_list.append(arr)
+            self.cond.notify()
+
+    @contextmanager
+    def get(self, size: int, dtype=np.uint64):
+        # an array of size elements of dtype, returned to the pool at the end of the with block
+        arr = self._acquire(max(size, 1) * max(self.itemsize, np.dtype(dtype).itemsize))
+        try:
+            yield arr[:size * np.dtype(dtype).itemsize].view(dtype)
+        finally:
+            self._release(arr)
+
+    def set_max_arrays(self, max_arrays: int):
+        with self.cond:
+            self.max_arrays = max_arrays
+            while self.free_list and self.n_arrays > self.max_arrays:
+                self.free_list.pop()
+                self.n_arrays -= 1
+            self.cond.notify_all()
+
+    def clear(self):
+        # release the memory of the free arrays
+        with self.cond:
+            self.n_arrays -= len(self.free_list)
+            self.free_list = []
+            self.cond.notify_all()
+
+
+# pools of hash arrays and scratch arrays of this process, see get_array_pool
+ARRAY_POOLS = {}
+# bytes per element of the arrays of a pool, hash arrays hold any hash dtype, scratch arrays are sized by their dtype
+ARRAY_POOL_ITEMSIZE = {"hash": 8, "scratch": 1}
+ARRAY_POOLS_LOCK = threading.Lock()
+
+
+def get_array_pool(name="hash") -> ArrayPool:
+    """
+    get the array pool of this process
+    Args:
+        name: "hash" for kmer hash arrays, "scratch" for temporary arrays of the compute backends
+    """
+    with ARRAY_POOLS_LOCK:
+        if name not in ARRAY_POOLS:
+            ARRAY_POOLS[name] = ArrayPool(itemsize=ARRAY_POOL_ITEMSIZE.get(name, 8))
+        return ARRAY_POOLS[name]
+
+
+def clear_array_pools():
+    for pool in ARRAY_POOLS.values():
+        pool.clear()
+
+
+# lookup tables from ascii code to base code, A-0, C-1, G-2, T-3, all other characters (N, IUPAC codes,
+# separators) are MISSING_VAL. Lower case bases are the same as upper case bases, or MISSING_VAL for soft masking.
+def gen_base_lut(soft_mask=False) -> np.ndarray:
+    lut = np.full(256, MISSING_VAL, dtype=np.uint8)
+    for i, b in enumerate("ACGT"):
+        lut[ord(b)] = i
+        if not soft_mask:
+            lut[ord(b.lower())] = i
+    return lut
+
+
+BASE_LUT = gen_base_lut(soft_mask=False)
+SOFT_MASK_BASE_LUT = gen_base_lut(soft_mask=True)
+
+
+def encode_dna(dna_str, out: np.ndarray, soft_mask=False):
+    # encode a DNA string into out through the lookup table, out should have the length of dna_str
+    raw = np.frombuffer(dna_str.encode("ascii", "replace"), dtype=np.uint8)
+    np.take(SOFT_MASK_BASE_LUT if soft_mask else BASE_LUT, raw, out=out)
+
+
+def dna2arr(dna_str, dtype=np.uint8, soft_mask=False) -> np.ndarray:
     """
     convert an input DNA string to numpy uint8 array, with a missing value appended
     Args:
-        dna_str: a DNA sequence, all letters should be upper case
+        dna_str: a DNA sequence, upper or lower case
         dtype: data type for storing DNA string
+        soft_mask: if lower case bases are treated as missing values
     Returns:
         a numpy array
     """
-    res = np.empty(len(dna_str) + 1, dtype=dtype)
-    base_map = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
-    for i, b in enumerate(dna_str):
-        res[i] = base_map.get(b, MISSING_VAL)
+    res = np.empty(len(dna_str) + 1, dtype=np.uint8)
+    encode_dna(dna_str, res[:-1], soft_mask)
     res[-1] = MISSING_VAL  # add a separator to the end of the string
-    return res
+    return res.astype(dtype, copy=False)
 
 
-def read_dnaseq_file(file_name, file_type="fasta") -> np.ndarray:
+def get_seq_hash_arr(in_str, kmer_len):
+    # hash of each kmer of the sequence, the invalid hash for kmers containing a base other than ACGT
+    code_arr = dna2arr(in_str)
+    hash_dtype = get_hash_dtype(kmer_len)
+    hash_arr = np.empty(len(code_arr), dtype=hash_dtype)
+    # the scratch array is freed after use rather than kept in the pool of the counting workers
+    scratch_arr = np.empty(2 * max(len(code_arr) - kmer_len, 0), dtype=bool)
+    get_backend("numpy").kmer2hash(code_arr, len(code_arr), kmer_len, hash_arr, get_invalid_hash(hash_dtype),
+                                   MISSING_VAL, scratch_arr=scratch_arr)
+    return hash_arr[:max(len(in_str) - kmer_len + 1, 0)]
+
+
+def read_seq_str_file(file_name, file_type="fasta"):
     """
-    file_name: input DNA sequence file name
-    file_type: fasta, fastq,
+    read the sequences of the input file as strings
+    file_name: input DNA sequence file name, gzip or BGZF compressed files are detected, see open_seq_file
+    file_type: fasta, fastq, other formats supported by Bio.SeqIO are parsed by SeqIO.parse
     """
 
     def read_stream(fh):
-        for rec in SeqIO.parse(fh, file_type):
-            yield dna2arr(str(rec.seq).upper())
+        if file_type == "fasta":
+            for _, seq in SimpleFastaParser(fh):
+                yield seq
+        elif file_type == "fastq":
+            for _, seq, _ in FastqGeneralIterator(fh):
+                yield seq
+        else:
+            for rec in SeqIO.parse(fh, file_type):
+                yield str(rec.seq)
 
-    if file_name.endswith(".gz"):
-        with gzip.open(file_name, "rt") as fh:
-            yield from read_stream(fh)
-    else:
-        with open(file_name, "r") as fh:
-            yield from read_stream(fh)
+    with open_seq_file(file_name) as fh:
+        yield from read_stream(fh)
+
+
+def read_fasta_pieces(fh, max_piece_len: int):
+    """
+    read the sequences of a fasta file handle like SimpleFastaParser, but a record longer than max_piece_len is
+    yielded in pieces of max_piece_len bases while it is read, such that a whole chromosome is never kept in memory
+    Returns:
+        generator of (sequence piece, continuation flag), the flag is True if the piece continues the previous one
+    """
+    line_list = []
+    n_base = 0
+    cont_flag = False
+    in_record = False
+    for line in fh:
+        if line[0] == ">":
+            if in_record:
+                yield "".join(line_list), cont_flag
+            line_list, n_base, cont_flag, in_record = [], 0, False, True
+            continue
+        if not in_record:  # text before the first record
+            continue
+        line = line.rstrip().replace(" ", "")
+        line_list.append(line)
+        n_base += len(line)
+        if n_base >= max_piece_len:
+            seq = "".join(line_list)
+            for st in range(0, len(seq) - max_piece_len + 1, max_piece_len):
+                yield seq[st:st + max_piece_len], cont_flag
+                cont_flag = True
+            seq = seq[len(seq) - len(seq) % max_piece_len:]
+            line_list, n_base = [seq], len(seq)
+    # the remaining piece of a record which ends exactly at a piece boundary is empty
+    if in_record and (n_base > 0 or not cont_flag):
+        yield "".join(line_list), cont_flag
+
+
+def read_seq_pieces(file_name, file_type="fasta", max_piece_len=2 ** 26):
+    """
+    read the sequences of the input file as strings of at most max_piece_len bases, longer sequences are split
+    Returns:
+        generator of (sequence piece, continuation flag), the flag is True if the piece continues the previous one
+    """
+    if file_type == "fasta":
+        with open_seq_file(file_name) as fh:
+            yield from read_fasta_pieces(fh, max_piece_len)
+        return
+
+    for seq in read_seq_str_file(file_name, file_type):
+        yield seq[:max_piece_len], False
+        for st in range(max_piece_len, len(seq), max_piece_len):
+            yield seq[st:st + max_piece_len], True
+
+
+def read_dnaseq_file(file_name, file_type="fasta", soft_mask=False) -> np.ndarray:
+    """
+    file_name: input DNA sequence file name
+    file_type: fasta, fastq,
+    soft_mask: if lower case bases are treated as missing values
+    """
+    for seq in read_seq_str_file(file_name, file_type):
+        yield dna2arr(seq, soft_mask=soft_mask)
+
+
+def read_dnaseq_batches(file_name, file_type="fasta", batch_size=10000):
+    # read the sequences of the input file as lists of strings of size batch_size
+    batch = []
+    for seq in read_seq_str_file(file_name, file_type):
+        batch.append(seq)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_seq_piece_batches(file_name, file_type="fasta", max_piece_len=2 ** 26, batch_size=10000,
+                           max_batch_bases=None):
+    # read the sequence pieces of the input file, see read_seq_pieces, as lists of pieces and continuation flags.
+    # A batch has at most batch_size pieces, and if max_batch_bases is given, less than
+    # max_batch_bases + max_piece_len bases
+    seq_list, cont_list = [], []
+    n_base = 0
+    for seq, cont_flag in read_seq_pieces(file_name, file_type, max_piece_len):
+        seq_list.append(seq)
+        cont_list.append(cont_flag)
+        n_base += len(seq)
+        if len(seq_list) == batch_size or (max_batch_bases and n_base >= max_batch_bases):
+            yield seq_list, cont_list
+            seq_list, cont_list = [], []
+            n_base = 0
+    if seq_list:
+        yield seq_list, cont_list
 
 
 # get the hash dtype for given kmer length
@@ -174,62 +470,170 @@ def gen_hash_mask(k: int, dtype: Callable[[int], np.dtype]):
     return mask
 
 
-@ti.func
-def revcom_hash_uint32(in_hash: ti.u32,
-                       mask: ti.u32,
-                       twobit_mask: ti.u32,
-                       k: int):
-    com_hash = mask - in_hash  # complement hash
-    ret_hash = twobit_mask & com_hash
-    for i in range(k - 1):
-        ret_hash = ret_hash << 2
-        com_hash = com_hash >> 2
-        ret_hash += twobit_mask & com_hash
-    return ret_hash
+# count the set bits of each element of an unsigned integer array
+def popcount(arr: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(arr).astype(np.uint8)
+    byte_cnt = POPCOUNT_TABLE[arr.view(np.uint8)]
+    return byte_cnt.reshape(len(arr), arr.itemsize).sum(axis=1, dtype=np.uint8)
 
 
-@ti.func
-def revcom_hash_uint64(in_hash: ti.u64,
-                       mask: ti.u64,
-                       twobit_mask: ti.u64,
-                       k: int):
-    com_hash = mask - in_hash  # complement hash
-    ret_hash = twobit_mask & com_hash
-    for i in range(k - 1):
-        ret_hash = ret_hash << 2
-        com_hash = com_hash >> 2
-        ret_hash += twobit_mask & com_hash
-    return ret_hash
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 
 
-@ti.kernel
-def revcom_hash_kernel_uint32(in_hash_arr: ti.types.ndarray(dtype=ti.u32),
-                              out_hash_arr: ti.types.ndarray(dtype=ti.u32),
-                              mask_arr: ti.types.ndarray(dtype=ti.u32),
-                              kmer_len: int, in_hash_arr_size: int):
-    for i in range(in_hash_arr_size):
-        out_hash_arr[i] = revcom_hash_uint32(in_hash_arr[i], mask_arr[0], mask_arr[1], kmer_len)
+class NumpyBackend:
+    """
+    vectorized numpy implementation of the kmer kernels, no extra dependency and no initialization
+    """
+    name = "numpy"
+
+    def kmer2hash(self, arr: np.ndarray, arr_size: int, kmer_len: int, hash_arr: np.ndarray, invalid_hash, missing_val,
+                  scratch_arr=None):
+        # hash_arr[i] is the hash of arr[i:i+kmer_len], invalid_hash if the kmer contains missing_val or
+        # i+kmer_len >= arr_size, same as the taichi kernel
+        # scratch_arr: bool array of at least 2*(arr_size-kmer_len) elements, taken from the scratch pool if None
+        n_valid = max(arr_size - kmer_len, 0)
+        if scratch_arr is None and n_valid > 0:
+            with get_array_pool("scratch").get(2 * n_valid, dtype=bool) as scratch_arr:
+                self.kmer2hash(arr, arr_size, kmer_len, hash_arr, invalid_hash, missing_val, scratch_arr)
+            return
+        hash_dtype = hash_arr.dtype.type
+        hash_arr[n_valid:arr_size] = invalid_hash
+        if n_valid == 0:
+            return
+        kh = hash_arr[:n_valid]
+        kh[:] = 0
+        shift = hash_dtype(2)
+        invalid_flag, tmp_flag = scratch_arr[:n_valid], scratch_arr[n_valid:2 * n_valid]
+        invalid_flag[:] = False
+        for i in range(kmer_len):
+            tmp_arr = arr[i:i + n_valid]
+            np.left_shift(kh, shift, out=kh)
+            np.bitwise_or(kh, tmp_arr, out=kh)
+            np.equal(tmp_arr, missing_val, out=tmp_flag)
+            np.logical_or(invalid_flag, tmp_flag, out=invalid_flag)
+        kh[invalid_flag] = invalid_hash
+
+    def hamming_dist(self, kh_arr: np.ndarray, consensus_kh_arr: np.ndarray, kmer_len: int, ham_dist_arr: np.ndarray):
+        hash_dtype = kh_arr.dtype.type
+        xor_arr = np.bitwise_xor(kh_arr, consensus_kh_arr[0])
+        # a base differs if any of its two bits differs, collect these flags at the lower bit of each base
+        xor_arr |= xor_arr >> hash_dtype(1)
+        xor_arr &= hash_dtype(int("01" * kmer_len, 2))
+        ham_dist_arr[:] = popcount(xor_arr)
+
+    def min_hamming_dist(self, kh_arr: np.ndarray, kh_len: int, consensus_kh_arr: np.ndarray, kmer_len: int,
+                         min_dist_arr: np.ndarray):
+        # minimum Hamming distance between the sub-kmers of kh_arr at all offsets and all consensuses,
+        # each sub-kmer array is extracted once and compared with all consensuses in the short hash type
+        hash_dtype = kh_arr.dtype.type
+        sub_hash_dtype = get_hash_dtype(kmer_len)
+        mask = hash_dtype((1 << 2 * kmer_len) - 1)
+        base_mask = sub_hash_dtype(int("01" * kmer_len, 2))
+        consensus_kh_arr = consensus_kh_arr.astype(sub_hash_dtype)
+        min_dist_arr[:] = kmer_len
+        tmp_arr = np.empty_like(kh_arr)
+        sub_kh_arr = np.empty(len(kh_arr), dtype=sub_hash_dtype)
+        xor_arr = np.empty_like(sub_kh_arr)
+        shift_arr = np.empty_like(sub_kh_arr)
+        for offset in range(kh_len - kmer_len + 1):
+            np.right_shift(kh_arr, hash_dtype(2 * offset), out=tmp_arr)
+            tmp_arr &= mask
+            sub_kh_arr[:] = tmp_arr
+            for consensus_kh in consensus_kh_arr:
+                np.bitwise_xor(sub_kh_arr, consensus_kh, out=xor_arr)
+                # a base differs if any of its two bits differs, collect these flags at the lower bit of each base
+                np.right_shift(xor_arr, sub_hash_dtype(1), out=shift_arr)
+                xor_arr |= shift_arr
+                xor_arr &= base_mask
+                np.minimum(min_dist_arr, popcount(xor_arr), out=min_dist_arr)
+
+    def revcom_hash(self, in_hash_arr: np.ndarray, mask_arr: np.ndarray, kmer_len: int, out_hash_arr: np.ndarray):
+        hash_dtype = in_hash_arr.dtype.type
+        mask, twobit_mask = mask_arr[0], mask_arr[1]
+        com_hash = mask - in_hash_arr  # complement hash
+        out_hash_arr[:] = 0
+        shift = hash_dtype(2)
+        for _ in range(kmer_len):
+            np.left_shift(out_hash_arr, shift, out=out_hash_arr)
+            out_hash_arr |= com_hash & twobit_mask
+            np.right_shift(com_hash, shift, out=com_hash)
+
+
+class TaichiBackend:
+    """
+    taichi implementation of the kmer kernels, taichi is imported and initialized on first use.
+    The taichi runtime is not thread safe, kernel launches are serialized, each kernel uses all threads itself.
+    Attributes:
+        arch: "cpu" or "gpu"
+        n_threads: maximum number of cpu threads, all cores if None
+    """
+    _lock = threading.Lock()
 
+    def __init__(self, arch="cpu", n_threads=None):
+        self.arch = arch
+        self.n_threads = n_threads
+        self.name = f"taichi-{arch}"
 
-@ti.kernel
-def revcom_hash_kernel_uint64(in_hash_arr: ti.types.ndarray(dtype=ti.u64),
-                              out_hash_arr: ti.types.ndarray(dtype=ti.u64),
-                              mask_arr: ti.types.ndarray(dtype=ti.u64),
-                              kmer_len: int, in_hash_arr_size: int):
-    for i in range(in_hash_arr_size):
-        out_hash_arr[i] = revcom_hash_uint64(in_hash_arr[i], mask_arr[0], mask_arr[1], kmer_len)
+    def _init(self):
+        import kmer_count_taichi
+        kmer_count_taichi.init_taichi(self.arch, self.n_threads)
+        return kmer_count_taichi
 
+    def kmer2hash(self, arr: np.ndarray, arr_size: int, kmer_len: int, hash_arr: np.ndarray, invalid_hash, missing_val):
+        with self._lock:
+            self._init().kmer2hash(arr, arr_size, kmer_len, hash_arr, invalid_hash, missing_val)
 
-def get_revcom_hash_arr(in_hash_arr: np.ndarray, kmer_len: int):
+    def hamming_dist(self, kh_arr: np.ndarray, consensus_kh_arr: np.ndarray, kmer_len: int, ham_dist_arr: np.ndarray):
+        with self._lock:
+            self._init().hamming_dist(kh_arr, consensus_kh_arr, kmer_len, ham_dist_arr)
+
+    def min_hamming_dist(self, kh_arr: np.ndarray, kh_len: int, consensus_kh_arr: np.ndarray, kmer_len: int,
+                         min_dist_arr: np.ndarray):
+        with self._lock:
+            self._init().min_hamming_dist(kh_arr, kh_len, consensus_kh_arr, kmer_len, min_dist_arr)
+
+    def revcom_hash(self, in_hash_arr: np.ndarray, mask_arr: np.ndarray, kmer_len: int, out_hash_arr: np.ndarray):
+        with self._lock:
+            self._init().revcom_hash_arr(in_hash_arr, mask_arr, kmer_len, out_hash_arr)
+
+
+def get_backend(backend=None):
+    """
+    get the compute backend for the kmer kernels
+    Args:
+        backend: a backend object, or its name "numpy", "taichi-cpu", "taichi-gpu", "auto".
+            If None, the name is read from the environment variable INIMOTIF_BACKEND, default "auto".
+            "auto" selects taichi-cpu if taichi is installed, otherwise numpy.
+            The number of threads of taichi-cpu is read from INIMOTIF_NUM_THREADS.
+    Returns:
+        a NumpyBackend or TaichiBackend object
+    """
+    if backend is not None and not isinstance(backend, str):
+        return backend
+    if backend is None:
+        backend = os.environ.get(BACKEND_ENV, "auto")
+    if backend == "auto":
+        backend = "taichi-cpu" if importlib.util.find_spec("taichi") is not None else "numpy"
+
+    if backend == "numpy":
+        return NumpyBackend()
+    elif backend == "taichi-cpu":
+        n_threads = os.environ.get(NUM_THREADS_ENV)
+        return TaichiBackend("cpu", int(n_threads) if n_threads else None)
+    elif backend == "taichi-gpu":
+        return TaichiBackend("gpu")
+    else:
+        raise Exception(f"Unknown backend={backend}, should be numpy, taichi-cpu, taichi-gpu or auto.")
+
+
+def get_revcom_hash_arr(in_hash_arr: np.ndarray, kmer_len: int, backend=None):
     hash_dtype = get_hash_dtype(kmer_len)
     mask_arr = np.array([(1 << 2 * kmer_len) - 1, 3], dtype=hash_dtype) # mask and twobit_mask
 
+    in_hash_arr = np.ascontiguousarray(in_hash_arr, dtype=hash_dtype)
     out_hash_arr = np.empty_like(in_hash_arr)
-    hash_arr_size = len(in_hash_arr)
-    if hash_dtype == np.uint32:
-        revcom_hash_kernel_uint32(in_hash_arr, out_hash_arr, mask_arr, kmer_len, hash_arr_size)
-    elif hash_dtype == np.uint64:
-        revcom_hash_kernel_uint64(in_hash_arr, out_hash_arr, mask_arr, kmer_len, hash_arr_size)
+    get_backend(backend).revcom_hash(in_hash_arr, mask_arr, kmer_len, out_hash_arr)
     return out_hash_arr
 
 
@@ -283,211 +687,470 @@ def get_invalid_hash(dtype: Callable[[int], np.dtype]):
 #     hash_arr[st_pos] = kh
 #     return kh
 
-@ti.func
-def cal_ham_dist_uint32(hash1: ti.u32, hash2: ti.u32, kmer_len: int):
-    xor_result = hash1 ^ hash2
-    twobit_mask = ti.cast(3, ti.u32)
-    hamming_dist = 0
-    for _ in range(kmer_len):
-        cmp_res = xor_result & twobit_mask
-        hamming_dist += cmp_res != 0
-        xor_result >>= 2
-    return hamming_dist
-
-
-@ti.kernel
-def cal_ham_dist_kernel_uint32(hash_arr: ti.types.ndarray(dtype=ti.u32),
-                               target_hash: ti.types.ndarray(dtype=ti.u32),
-                               ham_dist_arr: ti.types.ndarray(dtype=ti.u8),
-                               hash_arr_size: int,
-                               kmer_len: int):
-    for i in range(hash_arr_size):
-        ham_dist_arr[i] = ti.cast(cal_ham_dist_uint32(hash_arr[i], target_hash[0], kmer_len), ti.u8)
-
-
-@ti.func
-def cal_ham_dist_uint64(hash1: ti.u64, hash2: ti.u64, kmer_len: int):
-    xor_result = hash1 ^ hash2
-    twobit_mask = ti.cast(3, ti.u64)
-    hamming_dist = 0
-    for _ in range(kmer_len):
-        cmp_res = xor_result & twobit_mask
-        hamming_dist += cmp_res != 0
-        xor_result >>= 2
-    return hamming_dist
-
-
-@ti.kernel
-def cal_ham_dist_kernel_uint64(hash_arr: ti.types.ndarray(dtype=ti.u64),
-                               target_hash: ti.types.ndarray(dtype=ti.u64),
-                               ham_dist_arr: ti.types.ndarray(dtype=ti.u8),
-                               hash_arr_size: int,
-                               kmer_len: int):
-    for i in range(hash_arr_size):
-        ham_dist_arr[i] = ti.cast(cal_ham_dist_uint64(hash_arr[i], target_hash[0], kmer_len), ti.u8)
-
-
-@ti.func
-def kmer2hash_taichi_uint32(arr: ti.types.ndarray(dtype=ti.u8), arr_size: int, st_pos: int, k: int,
-                            hash_arr: ti.types.ndarray(dtype=ti.u32),
-                            invalid_hash: ti.types.u32,
-                            missing_val: ti.types.u32):
-    # hash_arr[st_pos] = invalid_hash
-    invalid_hash_flag = 0
-    if st_pos + k >= arr_size:
-        invalid_hash_flag = 1
-
-    kh = ti.u32(0)
-    for i in range(k):
-        if arr[st_pos + i] == missing_val:
-            invalid_hash_flag = 1
-        kh = kh << 2
-        kh += arr[st_pos + i]
-    hash_arr[st_pos] = kh
-
-    if invalid_hash_flag > 0:
-        hash_arr[st_pos] = invalid_hash
-
-
-@ti.kernel
-def kmer2hash_kernel_uint32(arr: ti.types.ndarray(dtype=ti.u8), arr_size: int, k: int,
-                            hash_arr: ti.types.ndarray(dtype=ti.u32),
-                            invalid_hash_arr: ti.types.ndarray(dtype=ti.u32),
-                            missing_val_arr: ti.types.ndarray(dtype=ti.u8)):
-    for i in range(arr_size):
-        kmer2hash_taichi_uint32(arr, arr_size, i, k, hash_arr, invalid_hash_arr[0], missing_val_arr[0])
-
-
-@ti.func
-def kmer2hash_taichi_uint64(arr: ti.types.ndarray(dtype=ti.u8), arr_size: int, st_pos: int, k: int,
-                            hash_arr: ti.types.ndarray(dtype=ti.u64), invalid_hash: ti.u64,
-                            missing_val: ti.u8):
-    # hash_arr[st_pos] = invalid_hash
-    invalid_hash_flag = 0
-    if st_pos + k >= arr_size:
-        invalid_hash_flag = 1
-
-    kh = ti.u64(0)
-    for i in range(k):
-        if arr[st_pos + i] == missing_val:
-            invalid_hash_flag = 1
-        kh = kh << 2
-        kh += arr[st_pos + i]
-    hash_arr[st_pos] = kh
-
-    if invalid_hash_flag > 0:
-        hash_arr[st_pos] = invalid_hash
-
-
-@ti.kernel
-def kmer2hash_kernel_uint64(arr: ti.types.ndarray(dtype=ti.u8), arr_size: int, k: int,
-                            hash_arr: ti.types.ndarray(dtype=ti.u64),
-                            invalid_hash_arr: ti.types.ndarray(dtype=ti.u64),
-                            missing_val_arr: ti.types.ndarray(dtype=ti.u8)):
-    for i in range(arr_size):
-        kmer2hash_taichi_uint64(arr, arr_size, i, k, hash_arr, invalid_hash_arr[0], missing_val_arr[0])
-
-
-async def comp_kmer_hash_taichi(buffer: Buffer, kmer_len: int) -> Counter:
+async def comp_kmer_hash_taichi(buffer: Buffer, kmer_len: int, backend=None) -> Tuple[np.ndarray, np.ndarray]:
     """
     Compute kmer hash for each kmer from the input buffer, get the
     Args:
         buffer: a Buffer object that contain DNA sequences, A-0, C-1,
         kmer_len: length of kmer
-    Returns: a numpy array
+        backend: compute backend, see get_backend
+    Returns: sorted unique kmer hash array and the corresponding count array
     """
 
     # await asyncio.sleep(np.random.rand()) # simulation of a time-consuming job
 
-    missing_val = buffer.dtype(MISSING_VAL)
-    missing_val_arr = np.array([missing_val])
+    return count_buffer_kmers(buffer, kmer_len, backend)
+
+
+# count kmers of a chunk file, run by the workers of count_kmer_producer_consumer_chunk
+def count_chunk_file_kmers(file_path: str, i_chunk: int, kmer_len: int, backend=None,
+                           cont_pos_list=None, overlap=0) -> Tuple[np.ndarray, np.ndarray]:
+    buffer = Buffer.load_chunk(file_path, id=i_chunk, cont_pos_list=cont_pos_list, overlap=overlap)
+    return count_buffer_kmers(buffer, kmer_len, backend)
+
+
+# count kmers of all given lengths of a chunk file, the chunk is loaded only once
+def count_chunk_file_multi_kmers(file_path: str, i_chunk: int, kmer_len_list: List[int], backend=None,
+                                 cont_pos_list=None, overlap=0) -> List[Tuple[np.ndarray, np.ndarray]]:
+    buffer = Buffer.load_chunk(file_path, id=i_chunk, cont_pos_list=cont_pos_list, overlap=overlap)
+    return [count_buffer_kmers(buffer, kmer_len, backend) for kmer_len in kmer_len_list]
 
+
+def invalidate_overlap_kmers(buffer: Buffer, kmer_len: int, hash_arr: np.ndarray, invalid_hash):
+    """
+    invalidate the kmers lying inside the overlap at the start of each continuation piece, they are counted in the
+    previous piece. These are the first overlap+1-kmer_len kmers of the piece. Kmers longer than overlap+1 crossing
+    a piece boundary can not be counted.
+    """
+    n_invalid = buffer.overlap + 1 - kmer_len
+    if not buffer.cont_pos_list or n_invalid <= 0:
+        return
+    inds = (np.array(buffer.cont_pos_list)[:, None] + np.arange(n_invalid)).ravel()
+    hash_arr[inds[inds < buffer.pointer]] = invalid_hash
+
+
+def count_buffer_kmers(buffer: Buffer, kmer_len: int, backend=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    count kmers of a buffer, synchronous version of comp_kmer_hash_taichi.
+    The hash array is taken from the hash array pool and sorted in place.
+    Returns: sorted unique kmer hash array and the corresponding count array
+    """
     hash_dtype = get_hash_dtype(kmer_len)
     invalid_hash = get_invalid_hash(hash_dtype)
-    invalid_hash_arr = np.array([invalid_hash])
 
-    hash_arr = np.empty(buffer.buffer_size, dtype=hash_dtype)
-    if hash_dtype == np.uint32:
-        kmer2hash_kernel_uint32(buffer.buffer, buffer.pointer, kmer_len, hash_arr, invalid_hash_arr, missing_val_arr)
-    elif hash_dtype == np.uint64:
-        kmer2hash_kernel_uint64(buffer.buffer, buffer.pointer, kmer_len, hash_arr, invalid_hash_arr, missing_val_arr)
-    else:
-        raise Exception(f"Unknown kmer hash type hash_dtype={hash_dtype}")
+    with get_array_pool("hash").get(buffer.pointer, hash_dtype) as hash_arr:
+        get_backend(backend).kmer2hash(buffer.buffer, buffer.pointer, kmer_len, hash_arr, invalid_hash, MISSING_VAL)
+        invalidate_overlap_kmers(buffer, kmer_len, hash_arr, invalid_hash)
 
-    unique_hash, counts = np.unique(hash_arr[0:buffer.pointer], return_counts=True)
-    inds = unique_hash != invalid_hash
-    unique_hash = unique_hash[inds]
-    counts = counts[inds]
-    hash_counts_dict = Counter(dict(zip(unique_hash, counts)))
+        hash_arr.sort()
+        # invalid hash is the largest value, invalid kmers are at the end
+        hash_arr = hash_arr[:np.searchsorted(hash_arr, invalid_hash)]
+        st_inds = np.flatnonzero(hash_arr[1:] != hash_arr[:-1]) + 1
+        st_inds = np.concatenate(([0], st_inds)) if len(hash_arr) > 0 else st_inds
+        unique_hash = hash_arr[st_inds]  # a copy, hash_arr goes back to the pool
+        counts = np.diff(np.append(st_inds, len(hash_arr)))
 
-    return hash_counts_dict
+    return unique_hash, counts
+
+
+def merge_kmer_counts(res_list: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    merge kmer counts, counts of the same kmer hash are summed
+    Args:
+        res_list: list of (kmer hash array, count array) pairs, kmer hashes of each pair are sorted and unique
+    Returns:
+        sorted unique kmer hash array and the corresponding count array
+    """
+    if len(res_list) == 1:
+        return res_list[0]
+    kh_arr = np.concatenate([kh for kh, _ in res_list])
+    cnt_arr = np.concatenate([cnt for _, cnt in res_list])
+    # stable sort detects the sorted runs of the inputs
+    inds = np.argsort(kh_arr, kind="stable")
+    kh_arr = kh_arr[inds]
+    cnt_arr = cnt_arr[inds]
+    if len(kh_arr) == 0:
+        return kh_arr, cnt_arr
+    st_inds = np.concatenate(([0], np.flatnonzero(kh_arr[1:] != kh_arr[:-1]) + 1))
+    return kh_arr[st_inds], np.add.reduceat(cnt_arr, st_inds)
+
+
+class KmerCountAggregator:
+    """
+    sum the kmer counts of chunks. Chunk results are kept pending and merged once they are as large as the merged
+    result, such that each kmer is merged O(log(n_chunk)) times.
+    """
+    def __init__(self, sketch=None, min_count=None):
+        self.res = None
+        self.pending_list = []  # chunk results not merged yet
+        self.n_pending = 0
+        # kmers whose estimated count in the sketch is below min_count are dropped before merging
+        self.sketch = sketch
+        self.min_count = min_count
+
+    def add(self, chunk_res: Tuple[np.ndarray, np.ndarray]):
+        if self.sketch is not None:
+            kh_arr, cnt_arr = chunk_res
+            keep_inds = self.sketch.query(kh_arr) >= self.min_count
+            chunk_res = (kh_arr[keep_inds], cnt_arr[keep_inds])
+        self.pending_list.append(chunk_res)
+        self.n_pending += len(chunk_res[0])
+        if self.res is None or self.n_pending >= len(self.res[0]):
+            self.res = self.result()
+            self.pending_list = []
+            self.n_pending = 0
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        return merge_kmer_counts(([self.res] if self.res else []) + self.pending_list)
+
+
+class SketchAggregator:
+    """
+    add the kmer counts of chunks to a count-min sketch, the first pass of counting with min_count
+    """
+    def __init__(self, sketch: CountMinSketch):
+        self.sketch = sketch
+
+    def add(self, chunk_res: Tuple[np.ndarray, np.ndarray]):
+        self.sketch.add(*chunk_res)
+
+    def result(self) -> CountMinSketch:
+        return self.sketch
+
+
+def kmer_counts_to_counter(kh_arr: np.ndarray, cnt_arr: np.ndarray) -> Counter:
+    # convert kmer count arrays into a Counter object, key is hash, value is count
+    return Counter(dict(zip(kh_arr.tolist(), cnt_arr.tolist())))
+
+
+def counter_to_kmer_counts(kmer_hash_counter: Counter, kmer_len: int) -> Tuple[np.ndarray, np.ndarray]:
+    # convert a Counter object into sorted kmer hash array and count array
+    kh_arr = np.fromiter(kmer_hash_counter.keys(), dtype=get_hash_dtype(kmer_len), count=len(kmer_hash_counter))
+    cnt_arr = np.fromiter(kmer_hash_counter.values(), dtype=np.int64, count=len(kmer_hash_counter))
+    inds = np.argsort(kh_arr)
+    return kh_arr[inds], cnt_arr[inds]
+
+
+def remove_old_kmer_counts(counts_dir: str, kmer_len: int):
+    # remove the count tables of kmer length kmer_len in the formats used before the kmer count database
+    for name in (f"k_{kmer_len}.npz", f"k_{kmer_len}_hash.npy", f"k_{kmer_len}_count.npy"):
+        old_file = os.path.join(counts_dir, name)
+        if os.path.exists(old_file):
+            os.remove(old_file)
+
+
+def save_kmer_counts(counts_dir: str, kmer_len: int, kh_arr: np.ndarray, cnt_arr: np.ndarray):
+    # save the sorted kmer hash array and count array as kmer count database k_#.kdb, see kmer_count_db
+    write_kmer_count_db(get_kmer_count_db_file(counts_dir, kmer_len), kmer_len, kh_arr, cnt_arr)
+    remove_old_kmer_counts(counts_dir, kmer_len)
+
+
+def save_filter_stats(counts_dir: str, kmer_len: int, stats: dict):
+    # save the statistics of the min_count filter as k_#_filter.json
+    print(f"k={kmer_len}: {stats['n_kept_distinct']} distinct kmers with count >= {stats['min_count']} kept, "
+          f"about {stats['n_filtered_distinct_est']} distinct kmers ({stats['n_filtered_kmer']} kmers) filtered out")
+    with open(os.path.join(counts_dir, f"k_{kmer_len}_filter.json"), "w") as fh:
+        json.dump(stats, fh, indent=2)
+
+
+def open_kmer_count_db(out_dir: str, kmer_len: int) -> KmerCountDB:
+    # open the kmer count database of kmer length kmer_len under out_dir/kmer_counts for queries
+    return KmerCountDB(get_kmer_count_db_file(os.path.join(out_dir, "kmer_counts"), kmer_len))
+
+
+def load_kmer_counts(out_dir: str, kmer_len: int) -> Tuple[np.ndarray, np.ndarray]:
+    # load the kmer count arrays saved by count_kmer or count_chunk_kmers, the arrays of the kmer count database are
+    # memory mapped. Count tables saved in the earlier .npz / .npy formats are also read.
+    counts_dir = os.path.join(out_dir, "kmer_counts")
+    if os.path.exists(get_kmer_count_db_file(counts_dir, kmer_len)):
+        return open_kmer_count_db(out_dir, kmer_len).to_arrays()
+    npz_file = os.path.join(counts_dir, f"k_{kmer_len}.npz")
+    if not os.path.exists(npz_file):
+        return (np.load(os.path.join(counts_dir, f"k_{kmer_len}_hash.npy"), mmap_mode="r"),
+                np.load(os.path.join(counts_dir, f"k_{kmer_len}_count.npy"), mmap_mode="r"))
+    with np.load(npz_file) as data:
+        return data["kmer_hash"], data["count"]
+
+
+def reduce_kmer_counts(kh_arr: np.ndarray, cnt_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # sum the counts of the same kmer hash, kmer hashes need not be sorted or unique
+    inds = np.argsort(kh_arr, kind="stable")
+    kh_arr = kh_arr[inds]
+    cnt_arr = cnt_arr[inds]
+    if len(kh_arr) == 0:
+        return kh_arr, cnt_arr
+    st_inds = np.concatenate(([0], np.flatnonzero(kh_arr[1:] != kh_arr[:-1]) + 1))
+    return kh_arr[st_inds], np.add.reduceat(cnt_arr, st_inds)
+
+
+# memory of an in-memory reduction of kmer counts in bytes per (hash, count) pair, input, sort indices and output
+def get_bytes_per_kmer_count(hash_dtype):
+    return 4 * (np.dtype(hash_dtype).itemsize + 8)
+
+
+class KmerBucketWriter:
+    """
+    aggregator of the partitioned counting, appends the chunk counts to on-disk bucket files.
+    A kmer goes to the bucket given by the highest bits of its hash (its prefix), such that the buckets are
+    disjoint and bucket i only contains hashes smaller than bucket i+1.
+    Attributes:
+        bucket_dir: directory of the bucket files bucket_#.kh and bucket_#.cnt
+        kmer_len: kmer length
+        n_buckets: number of buckets, a power of 2
+        shift: a hash goes to bucket hash >> shift
+    """
+    def __init__(self, bucket_dir: str, kmer_len: int, n_buckets: int):
+        assert n_buckets & (n_buckets - 1) == 0, "number of buckets should be a power of 2"
+        self.bucket_dir = bucket_dir
+        self.kmer_len = kmer_len
+        self.n_buckets = n_buckets
+        self.hash_dtype = get_hash_dtype(kmer_len)
+        self.shift = 2 * kmer_len - (n_buckets.bit_length() - 1)
+        assert self.shift >= 0, f"n_buckets={n_buckets} is larger than the number of kmers 4**{kmer_len}"
+        mk_dir(bucket_dir)
+
+    def get_bucket_files(self, i_bucket):
+        return (os.path.join(self.bucket_dir, f"bucket_{i_bucket}.kh"),
+                os.path.join(self.bucket_dir, f"bucket_{i_bucket}.cnt"))
+
+    def add(self, chunk_res: Tuple[np.ndarray, np.ndarray]):
+        kh_arr, cnt_arr = chunk_res
+        # chunk hashes are sorted, each bucket is a contiguous slice
+        bucket_st_arr = np.arange(self.n_buckets + 1, dtype=np.uint64) << np.uint64(self.shift)
+        pos_arr = np.searchsorted(kh_arr.astype(np.uint64, copy=False), bucket_st_arr)
+        for i_bucket in np.flatnonzero(pos_arr[1:] > pos_arr[:-1]):
+            st, ed = pos_arr[i_bucket], pos_arr[i_bucket + 1]
+            kh_file, cnt_file = self.get_bucket_files(i_bucket)
+            with open(kh_file, "ab") as fh:
+                kh_arr[st:ed].tofile(fh)
+            with open(cnt_file, "ab") as fh:
+                cnt_arr[st:ed].astype(np.int64, copy=False).tofile(fh)
+
+    def result(self):
+        return self
+
+
+def read_raw_array(file_name, dtype) -> np.ndarray:
+    # memory map a raw binary array file, an empty array if the file does not exist or is empty
+    if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode="r")
+
+
+def reduce_kmer_bucket(kh_file: str, cnt_file: str, hash_dtype, shift: int, max_entries: int, out_fh_pair):
+    """
+    sum the counts of a bucket file and append the sorted counts to the output files. A bucket with more than
+    max_entries (hash, count) pairs is split into sub-buckets by the next bits of the hashes, recursively.
+    Args:
+        kh_file, cnt_file: raw binary files of hashes and counts of the bucket
+        hash_dtype: hash dtype
+        shift: bits below the bucket prefix, the hashes of a bucket only differ in the lowest shift bits
+        max_entries: maximum number of (hash, count) pairs reduced in memory
+        out_fh_pair: file handles of the output hash and count files
+    """
+    kh_arr = read_raw_array(kh_file, hash_dtype)
+    cnt_arr = read_raw_array(cnt_file, np.int64)
+    n_entries = len(kh_arr)
+    if n_entries == 0:
+        return
+
+    if n_entries <= max_entries:
+        kh_arr, cnt_arr = reduce_kmer_counts(np.array(kh_arr), np.array(cnt_arr))
+        kh_arr.tofile(out_fh_pair[0])
+        cnt_arr.tofile(out_fh_pair[1])
+        return
+
+    if shift == 0:
+        # all hashes of the bucket are the same kmer
+        cnt = sum(int(cnt_arr[st:st + max_entries].sum()) for st in range(0, n_entries, max_entries))
+        kh_arr[:1].tofile(out_fh_pair[0])
+        np.array([cnt], dtype=np.int64).tofile(out_fh_pair[1])
+        return
+
+    # split into sub-buckets, reading the bucket in blocks of max_entries
+    n_bits = min(4, shift)
+    sub_shift = shift - n_bits
+    sub_dir = kh_file + ".split"
+    sub_writer_list = [(os.path.join(sub_dir, f"bucket_{i}.kh"), os.path.join(sub_dir, f"bucket_{i}.cnt"))
+                       for i in range(2 ** n_bits)]
+    mk_dir(sub_dir)
+    sub_mask = np.uint64(2 ** n_bits - 1)
+    for st in range(0, n_entries, max_entries):
+        tmp_kh_arr = np.array(kh_arr[st:st + max_entries])
+        tmp_cnt_arr = np.array(cnt_arr[st:st + max_entries])
+        sub_id_arr = (tmp_kh_arr.astype(np.uint64) >> np.uint64(sub_shift)) & sub_mask
+        inds = np.argsort(sub_id_arr, kind="stable")
+        pos_arr = np.searchsorted(sub_id_arr[inds], np.arange(2 ** n_bits + 1))
+        for i_sub in np.flatnonzero(pos_arr[1:] > pos_arr[:-1]):
+            sub_inds = inds[pos_arr[i_sub]:pos_arr[i_sub + 1]]
+            with open(sub_writer_list[i_sub][0], "ab") as fh:
+                tmp_kh_arr[sub_inds].tofile(fh)
+            with open(sub_writer_list[i_sub][1], "ab") as fh:
+                tmp_cnt_arr[sub_inds].tofile(fh)
+    del kh_arr, cnt_arr
+
+    for sub_kh_file, sub_cnt_file in sub_writer_list:
+        reduce_kmer_bucket(sub_kh_file, sub_cnt_file, hash_dtype, sub_shift, max_entries, out_fh_pair)
+    shutil.rmtree(sub_dir)
+
+
+def reduce_kmer_buckets(writer: KmerBucketWriter, counts_dir: str, max_entries: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    count each bucket independently and concatenate the bucket results into a sorted count table, saved as kmer
+    count database k_#.kdb under counts_dir
+    Returns: memory mapped kmer hash array and count array
+    """
+    kmer_len = writer.kmer_len
+    hash_dtype = writer.hash_dtype
+    tmp_kh_file = os.path.join(writer.bucket_dir, "res.kh")
+    tmp_cnt_file = os.path.join(writer.bucket_dir, "res.cnt")
+    with open(tmp_kh_file, "wb") as kh_fh, open(tmp_cnt_file, "wb") as cnt_fh:
+        for i_bucket in range(writer.n_buckets):
+            kh_file, cnt_file = writer.get_bucket_files(i_bucket)
+            reduce_kmer_bucket(kh_file, cnt_file, hash_dtype, writer.shift, max_entries, (kh_fh, cnt_fh))
+            for file_name in (kh_file, cnt_file):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    # copy the concatenated bucket results into the kmer count database, block by block
+    tmp_kh_arr = read_raw_array(tmp_kh_file, hash_dtype)
+    tmp_cnt_arr = read_raw_array(tmp_cnt_file, np.int64)
+    write_kmer_count_db(get_kmer_count_db_file(counts_dir, kmer_len), kmer_len, tmp_kh_arr, tmp_cnt_arr,
+                        block_size=max_entries)
+    del tmp_kh_arr, tmp_cnt_arr
+    os.remove(tmp_kh_file)
+    os.remove(tmp_cnt_file)
+    remove_old_kmer_counts(counts_dir, kmer_len)
+    return KmerCountDB(get_kmer_count_db_file(counts_dir, kmer_len)).to_arrays()
 
 
 # producer
-async def chunk_reader(chunk_dir: str, task_queue: MaxSizeQueue):
-    file_paths = get_chunk_file_paths(chunk_dir)
-    for i_chunk, file_path in enumerate(file_paths):
-        with open(file_path, "rb") as fh:
-            buffer = pickle.load(fh)
-            await task_queue.put(buffer)
+async def chunk_reader(chunk_dir: str, task_queue: MaxSizeQueue, n_consumers: int = 1):
+    # put (chunk id, chunk file path, continuation positions, overlap) into the task queue, the chunks are loaded by
+    # the consumers
+    for i_chunk, chunk in enumerate(read_chunk_index(chunk_dir)):
+        file_path = os.path.join(chunk_dir, chunk["file"])
+        await task_queue.put((i_chunk, file_path, chunk.get("cont_pos", []), chunk.get("overlap", 0)))
 
-    # Signal the consumer that no more items will be produced
-    await task_queue.put(None)
+    # Signal the consumers that no more items will be produced
+    for _ in range(n_consumers):
+        await task_queue.put(None)
 
 
-def convert_input_chunks(fasta_file: str, buffer, out_dir="./chunks"):
-    def write_chunk(i_chunk, chunk):
-        filename = f"{out_dir}/chunk_{i_chunk}.pkl"
-        with open(filename, "wb") as fh:
-            pickle.dump(chunk, fh)
+def convert_input_chunks(fasta_file: str, buffer, out_dir="./chunks", file_type="fasta", soft_mask=False,
+                         max_kmer_len=MAX_KMER_LEN):
+    """
+    split the input sequences into chunks of at most buffer.buffer_size, each chunk is saved as chunk_#.npy
+    together with an index file listing the size and number of sequences of each chunk.
+    Sequences are read and encoded in batches. A sequence longer than the free space of a chunk that does not fit
+    into an empty chunk (e.g. a chromosome) is read in pieces and split over chunks. Each continuation piece starts
+    with the last max_kmer_len-1 bases of the previous piece, the start positions of continuation pieces in each
+    chunk are saved in the index ("cont_pos", "overlap"), such that kmers up to max_kmer_len crossing a boundary are
+    counted exactly once, see invalidate_overlap_kmers.
+    """
+    chunk_list = []
+    overlap = max_kmer_len - 1
+    if buffer.buffer_size <= 2 * (overlap + 1):
+        raise Exception(f"buffer_size={buffer.buffer_size} is too small for max_kmer_len={max_kmer_len}.")
+
+    def write_chunk(i_chunk, chunk, n_seq):
+        filename = f"chunk_{i_chunk}.npy"
+        chunk.save_chunk(os.path.join(out_dir, filename))
+        chunk_list.append({"file": filename, "size": chunk.pointer, "n_seq": n_seq, "overlap": overlap,
+                           "cont_pos": chunk.cont_pos_list})
+
+    def add_overlap(seq_list, cont_list, prev_seq):
+        # prefix the continuation pieces with the end of the previous piece
+        for i in range(len(seq_list)):
+            if cont_list[i]:
+                seq_list[i] = prev_seq[len(prev_seq) - overlap:] + seq_list[i]
+            prev_seq = seq_list[i]
+        return prev_seq
 
     out_dir = os.path.normpath(out_dir)
     out_dir = out_dir.rstrip(os.path.sep)
     mk_dir(out_dir)
     i_chunk = 0
-    for arr in read_dnaseq_file(fasta_file):
-        flag = buffer.append(arr)
-        if not flag:
-            data_to_write = buffer.data_to_write
-            buffer.data_to_write = None
+    n_seq = 0  # number of sequences starting in the current chunk
+    prev_seq = ""
+    # a batch holds less than two chunks of bases, such that the memory does not grow with the input
+    for seq_list, cont_list in read_seq_piece_batches(fasta_file, file_type, max_piece_len=buffer.buffer_size,
+                                                      max_batch_bases=buffer.buffer_size):
+        prev_seq = add_overlap(seq_list, cont_list, prev_seq)
+        while seq_list:
+            st_pos = buffer.pointer
+            n_appended = buffer.append_seq_batch(seq_list, soft_mask)
+            if any(cont_list[:n_appended]):
+                st_pos_arr = st_pos + np.cumsum([0] + [len(seq) + 1 for seq in seq_list[:n_appended - 1]])
+                buffer.cont_pos_list += [int(pos) for pos, cont in zip(st_pos_arr, cont_list) if cont]
+            n_seq += n_appended - sum(cont_list[:n_appended])
+            seq_list = seq_list[n_appended:]
+            cont_list = cont_list[n_appended:]
+            if not seq_list:
+                break
+
+            # the next sequence does not fit into an empty chunk, fill the chunk with its head, the rest is continued
+            # in the next chunk
+            n_head = buffer.buffer_size - buffer.pointer - 1
+            if len(seq_list[0]) + 1 > buffer.buffer_size and n_head > overlap:
+                st_pos = buffer.pointer
+                buffer.append_seq_batch([seq_list[0][:n_head]], soft_mask)
+                if cont_list[0]:
+                    buffer.cont_pos_list.append(st_pos)
+                else:
+                    n_seq += 1
+                seq_list[0] = seq_list[0][n_head - overlap:]
+                cont_list[0] = True
+
+            # buffer is full
             buffer.id = i_chunk
-            write_chunk(i_chunk, buffer)
+            write_chunk(i_chunk, buffer, n_seq)
 
             i_chunk += 1
             buffer.flush()
-            buffer.append(data_to_write)
+            n_seq = 0
 
     if buffer.pointer > 0:
         buffer.id = i_chunk
-        write_chunk(i_chunk, buffer)
+        write_chunk(i_chunk, buffer, n_seq)
+
+    write_chunk_index(out_dir, chunk_list, buffer.dtype)
 
 
 # consumer of task queue
-async def kmer_counter_chunk(task_queue: MaxSizeQueue, res_queue: MaxSizeQueue, kmer_len: int):
+async def kmer_counter_chunk(task_queue: MaxSizeQueue, res_queue: MaxSizeQueue, kmer_len_list: List[int],
+                             backend=None, executor=None):
+    loop = asyncio.get_running_loop()
     while True:
-        buffer = await task_queue.get()
-        if buffer is None:
+        task = await task_queue.get()
+        if task is None:
             await res_queue.put(None)
-            print("All tasks have finished.")
             return None
 
-        # process a task
-        print(f"Processing chunk id={buffer.id}")
-        # tmp_counter = await comp_kmer_hash(buffer, kmer_len)
-        tmp_counter = await comp_kmer_hash_taichi(buffer, kmer_len)
-        await res_queue.put(tmp_counter)
+        # process a task, hashing runs in the executor such that the event loop keeps loading and merging chunks
+        i_chunk, file_path, cont_pos_list, overlap = task
+        print(f"Processing chunk id={i_chunk}")
+        tmp_res = await loop.run_in_executor(executor, count_chunk_file_multi_kmers, file_path, i_chunk,
+                                             kmer_len_list, backend, cont_pos_list, overlap)
+        await res_queue.put(tmp_res)
 
 
-# consumer of result queue
-async def sum_counting_res(res_queue: MaxSizeQueue):
-    res_counter = Counter()
+# consumer of result queue, chunk results are lists of counts of n_kmer_len kmer lengths
+async def sum_counting_res(res_queue: MaxSizeQueue, n_producers: int = 1, n_kmer_len: int = 1,
+                           aggregator_list=None):
+    # aggregator_list: an aggregator with methods add and result for each kmer length, KmerCountAggregator by default
+    if aggregator_list is None:
+        aggregator_list = [KmerCountAggregator() for _ in range(n_kmer_len)]
     while True:
-        counter = await res_queue.get()
+        chunk_res = await res_queue.get()
         # await asyncio.sleep(np.random.rand())  # simulation of a time-consuming job
-        if counter is None:
-            return res_counter
-        else:
-            res_counter += counter
+        if chunk_res is None:
+            n_producers -= 1
+            if n_producers > 0:
+                continue
+            return [aggregator.result() for aggregator in aggregator_list]
+        for aggregator, res in zip(aggregator_list, chunk_res):
+            aggregator.add(res)
 
 
 # async def comp_kmer_hash(buffer: Buffer, kmer_len: int) -> Counter:
@@ -518,20 +1181,66 @@ async def sum_counting_res(res_queue: MaxSizeQueue):
 #     return hash_counts_dict
 
 
-async def count_kmer_producer_consumer_chunk(chunk_dir: str, kmer_len: int, q_size: int = 10):
+def get_executor(n_workers=None, executor_type="thread"):
+    """
+    get the executor for hashing chunks
+    Args:
+        n_workers: number of workers, number of cpus if None
+        executor_type: "thread" or "process", numpy releases the GIL in the vectorized operations such that threads
+            already run in parallel, processes avoid the GIL completely but each process initializes its own backend
+    """
+    n_workers = n_workers if n_workers else os.cpu_count()
+    if executor_type == "thread":
+        return ThreadPoolExecutor(max_workers=n_workers)
+    elif executor_type == "process":
+        # spawn new processes, forking a process in which taichi has already started its threads can deadlock
+        return ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        raise Exception(f"Unknown executor_type={executor_type}, should be thread or process.")
+
+
+async def count_kmer_producer_consumer_chunk(chunk_dir: str, kmer_len, q_size: int = 10, backend=None,
+                                             n_workers=None, executor_type="thread", aggregator_list=None):
+    """
+    count kmers of the chunks, n_workers consumers hash chunks concurrently in a thread or process pool
+    Args:
+        kmer_len: a kmer length, or a list of kmer lengths that are all counted while a chunk is loaded
+        aggregator_list: aggregators of the chunk counts for each kmer length, KmerCountAggregator by default
+    Returns: sorted unique kmer hash array and the corresponding count array, a list of them if kmer_len is a list
+    """
+    multi_k_flag = isinstance(kmer_len, (list, tuple, range))
+    kmer_len_list = list(kmer_len) if multi_k_flag else [kmer_len]
+    n_workers = n_workers if n_workers else os.cpu_count()
     task_queue = MaxSizeQueue(maxsize=q_size)
     res_queue = MaxSizeQueue(maxsize=q_size)
 
     assert os.path.exists(chunk_dir) and len(get_chunk_file_paths(chunk_dir)) > 0
 
-    producer_task = asyncio.create_task(chunk_reader(chunk_dir, task_queue))
-    consumer_task = asyncio.create_task(kmer_counter_chunk(task_queue, res_queue, kmer_len))
-    sum_task = asyncio.create_task(sum_counting_res(res_queue))
-
-    await asyncio.gather(producer_task, consumer_task, sum_task)
-
-    res_counter = sum_task.result()
-    return res_counter
+    backend = get_backend(backend)
+    # one hash array and one scratch array per worker, peak memory is
+    # n_workers * chunk size * (8 bytes of hashes + 2 bytes of scratch flags)
+    for pool_name in ("hash", "scratch"):
+        get_array_pool(pool_name).set_max_arrays(n_workers)
+    with get_executor(n_workers, executor_type) as executor:
+        producer_task = asyncio.create_task(chunk_reader(chunk_dir, task_queue, n_workers))
+        consumer_tasks = [asyncio.create_task(kmer_counter_chunk(task_queue, res_queue, kmer_len_list, backend,
+                                                                 executor))
+                          for _ in range(n_workers)]
+        sum_task = asyncio.create_task(sum_counting_res(res_queue, n_workers, len(kmer_len_list), aggregator_list))
+        all_tasks = [producer_task, *consumer_tasks, sum_task]
+
+        try:
+            await asyncio.gather(*all_tasks)
+        except BaseException:
+            # a worker failed, cancel the other tasks, otherwise they wait on the queues forever
+            for task in all_tasks:
+                task.cancel()
+            await asyncio.gather(*all_tasks, return_exceptions=True)
+            raise
+    print("All tasks have finished.")
+
+    res_list = sum_task.result()
+    return res_list if multi_k_flag else res_list[0]
 
 
 def proc_input(input_fasta_file: str, out_dir=".", buffer_size=2 ** 26):
@@ -542,7 +1251,7 @@ def proc_input(input_fasta_file: str, out_dir=".", buffer_size=2 ** 26):
         out_dir: output directory
         buffer_size: size of the chunk, int, 2**26 bytes are 64MB, 2**30 bytes are 1GB, should be less equal than 2**31
 
-    Returns: write chunks as chunk_#.pkl pickle file under "chunks" directory
+    Returns: write chunks as chunk_#.npy files and the chunk index under "chunks" directory
     """
     assert os.path.exists(out_dir)
     assert 0 < buffer_size <= 2 ** 31
@@ -554,22 +1263,60 @@ def proc_input(input_fasta_file: str, out_dir=".", buffer_size=2 ** 26):
         mk_dir(chunk_dir)
 
     buffer = Buffer(buffer_size)
-    # convert input fasta file into pickle chunks
+    # convert input fasta file into .npy chunks
     convert_input_chunks(input_fasta_file, buffer, out_dir=chunk_dir)
 
 
-def count_chunk_kmers(kmer_len, out_dir=".", q_size=20):
+def count_chunk_kmers_min_count(chunk_dir: str, kmer_len_list, min_count: int, sketch_width=2**22, q_size=20,
+                                backend=None, n_workers=None, executor_type="thread"):
+    """
+    Count kmers of the chunks in two passes, keeping only kmers that occur at least min_count times. The first pass
+    adds the chunk counts to a count-min sketch, the second pass drops the kmers whose estimated count is below
+    min_count before they are aggregated, such that rare kmers never enter the exact count table.
+    Args:
+        chunk_dir: directory of the chunks
+        kmer_len_list: list of kmer lengths
+        min_count: minimum count of a kept kmer
+        sketch_width: number of counters in each row of the sketch, memory is 16 bytes per counter (4 rows)
+        q_size, backend, n_workers, executor_type: see count_kmer_producer_consumer_chunk
+    Returns:
+        a list of (kmer hash array, count array) and a list of filter statistics, one for each kmer length
+    """
+    sketch_list = asyncio.run(count_kmer_producer_consumer_chunk(
+        chunk_dir, kmer_len_list, q_size, backend, n_workers, executor_type,
+        aggregator_list=[SketchAggregator(CountMinSketch(sketch_width)) for _ in kmer_len_list]))
+    res_list = asyncio.run(count_kmer_producer_consumer_chunk(
+        chunk_dir, kmer_len_list, q_size, backend, n_workers, executor_type,
+        aggregator_list=[KmerCountAggregator(sketch, min_count) for sketch in sketch_list]))
+
+    # the sketch overestimates, the exact counts decide which kmers are kept
+    stats_list = []
+    for i, (sketch, (kh_arr, cnt_arr)) in enumerate(zip(sketch_list, res_list)):
+        keep_inds = cnt_arr >= min_count
+        res_list[i] = (kh_arr[keep_inds], cnt_arr[keep_inds])
+        stats_list.append(get_filter_stats(sketch, min_count, sketch.n_total, int(keep_inds.sum()),
+                                           int(cnt_arr[keep_inds].sum())))
+    return res_list, stats_list
+
+
+def count_chunk_kmers(kmer_len, out_dir=".", q_size=20, backend=None, as_counter=False,
+                      n_workers=None, executor_type="thread", min_count=None, sketch_width=2**22):
     """
     Count kmers in the chunks under "chunks" directory.
-    The output is a Counter object (dictionary) and saved as .pkl file under the "kmer_counts"
-    folder.
+    The output is a sorted kmer hash array and a count array, saved as kmer count database k_#.kdb under the
+    "kmer_counts" folder, see kmer_count_db.
     Args:
         kmer_len: kmer len, int, should be 3-31
         q_size: queue size for concurrent processing of chunks, int, maximum number of chunks loaded into memory
         out_dir: output directory
-        buffer_size: size of the chunk, int, 2**26 bytes are 64MB, 2**30 bytes are 1GB, should be less equal than 2**31
-
-    Returns: a Counter object (dictionary), key is hash, value is count
+        backend: compute backend, see get_backend
+        as_counter: return a Counter object (dictionary) instead of the arrays
+        n_workers: number of chunks hashed concurrently, number of cpus if None
+        executor_type: run the hashing in a "thread" or "process" pool
+        min_count: if given, only kmers counted at least min_count times are kept, see count_chunk_kmers_min_count
+        sketch_width: number of counters in each row of the count-min sketch used by min_count
+
+    Returns: kmer hash array and count array, or a Counter object (dictionary), key is hash, value is count
     """
     assert os.path.exists(out_dir)
     chunk_dir = os.path.join(out_dir, "chunks")
@@ -579,19 +1326,121 @@ def count_chunk_kmers(kmer_len, out_dir=".", q_size=20):
     mk_dir(counts_dir)
 
     # count kmers
-    res_counter = asyncio.run(count_kmer_producer_consumer_chunk(chunk_dir, kmer_len, q_size))
-    res_counter_file = f"k_{kmer_len}.pkl"
-    with open(os.path.join(counts_dir, res_counter_file), "wb") as fh:
-        pickle.dump(res_counter, fh)
+    if min_count and min_count > 1:
+        res_list, stats_list = count_chunk_kmers_min_count(chunk_dir, [kmer_len], min_count, sketch_width, q_size,
+                                                           backend, n_workers, executor_type)
+        kh_arr, cnt_arr = res_list[0]
+        save_filter_stats(counts_dir, kmer_len, stats_list[0])
+    else:
+        kh_arr, cnt_arr = asyncio.run(count_kmer_producer_consumer_chunk(chunk_dir, kmer_len, q_size, backend,
+                                                                         n_workers, executor_type))
+    save_kmer_counts(counts_dir, kmer_len, kh_arr, cnt_arr)
 
-    return res_counter
+    if as_counter:
+        return kmer_counts_to_counter(kh_arr, cnt_arr)
+    return kh_arr, cnt_arr
 
 
-def count_kmer(input_fasta_file: str, kmer_len, q_size=20, out_dir=".", buffer_size=2 ** 26, rm_chunks_flag=True):
+def count_chunk_multi_kmers(kmer_len_list, out_dir=".", q_size=20, backend=None,
+                            n_workers=None, executor_type="thread", min_count=None, sketch_width=2**22):
+    """
+    Count kmers of all given lengths in the chunks under "chunks" directory, each chunk is loaded once and hashed
+    for every kmer length. The counts of each kmer length are saved as kmer count database k_#.kdb under the
+    "kmer_counts" folder.
+    Args:
+        kmer_len_list: list of kmer lengths, each should be 3-31
+        q_size: queue size for concurrent processing of chunks, int, maximum number of chunks loaded into memory
+        out_dir: output directory
+        backend: compute backend, see get_backend
+        n_workers: number of chunks hashed concurrently, number of cpus if None
+        executor_type: run the hashing in a "thread" or "process" pool
+        min_count: if given, only kmers counted at least min_count times are kept, see count_chunk_kmers_min_count
+        sketch_width: number of counters in each row of the count-min sketch of each kmer length
+
+    Returns: a dictionary, kmer length -> (kmer hash array, count array)
+    """
+    assert os.path.exists(out_dir)
+    chunk_dir = os.path.join(out_dir, "chunks")
+    counts_dir = os.path.join(out_dir, "kmer_counts")
+
+    assert os.path.exists(chunk_dir)
+    mk_dir(counts_dir)
+
+    kmer_len_list = list(kmer_len_list)
+    if min_count and min_count > 1:
+        res_list, stats_list = count_chunk_kmers_min_count(chunk_dir, kmer_len_list, min_count, sketch_width, q_size,
+                                                           backend, n_workers, executor_type)
+        for kmer_len, stats in zip(kmer_len_list, stats_list):
+            save_filter_stats(counts_dir, kmer_len, stats)
+    else:
+        res_list = asyncio.run(count_kmer_producer_consumer_chunk(chunk_dir, kmer_len_list, q_size, backend,
+                                                                  n_workers, executor_type))
+    for kmer_len, (kh_arr, cnt_arr) in zip(kmer_len_list, res_list):
+        save_kmer_counts(counts_dir, kmer_len, kh_arr, cnt_arr)
+
+    return dict(zip(kmer_len_list, res_list))
+
+
+def count_chunk_kmers_partitioned(kmer_len, out_dir=".", max_memory_mb=1024, n_buckets=None, q_size=None,
+                                  backend=None, n_workers=None, executor_type="thread"):
+    """
+    Count kmers in the chunks under "chunks" directory with bounded memory, for kmer lengths whose distinct kmers
+    do not fit into memory. The sorted unique kmer counts of each chunk are split by the prefix of the hashes into
+    n_buckets bucket files under "kmer_buckets". Each bucket is then counted independently, a bucket larger than the
+    memory cap is split again by the next bits of the hashes. The bucket results are concatenated into a sorted
+    count table, saved as kmer count database k_#.kdb under the "kmer_counts" folder.
+    Args:
+        kmer_len: kmer len, int, should be 3-31
+        out_dir: output directory
+        max_memory_mb: memory cap of the bucket counting in MB. The hashing of the chunks additionally needs
+            about 2 * n_workers * chunk size * 8 bytes for the hash arrays plus the chunk results in the queue.
+        n_buckets: number of buckets, a power of 2, derived from the total chunk size and max_memory_mb if None
+        q_size: queue size for concurrent processing of chunks, n_workers if None
+        backend: compute backend, see get_backend
+        n_workers: number of chunks hashed concurrently, number of cpus if None
+        executor_type: run the hashing in a "thread" or "process" pool
+
+    Returns: memory mapped kmer hash array and count array
+    """
+    assert os.path.exists(out_dir)
+    chunk_dir = os.path.join(out_dir, "chunks")
+    counts_dir = os.path.join(out_dir, "kmer_counts")
+    bucket_dir = os.path.join(out_dir, "kmer_buckets", f"k_{kmer_len}")
+
+    assert os.path.exists(chunk_dir)
+    mk_dir(counts_dir)
+    if os.path.exists(bucket_dir):
+        shutil.rmtree(bucket_dir)
+
+    hash_dtype = get_hash_dtype(kmer_len)
+    max_entries = max(int(max_memory_mb * 2**20) // get_bytes_per_kmer_count(hash_dtype), 1)
+    if n_buckets is None:
+        # the number of kmers is at most the total size of the chunks
+        n_total = sum(chunk["size"] for chunk in read_chunk_index(chunk_dir))
+        n_buckets = 1
+        while n_buckets * max_entries < n_total and n_buckets < min(4 ** kmer_len, 4096):
+            n_buckets *= 2
+    n_workers = n_workers if n_workers else os.cpu_count()
+    q_size = q_size if q_size else n_workers
+
+    writer = KmerBucketWriter(bucket_dir, kmer_len, n_buckets)
+    asyncio.run(count_kmer_producer_consumer_chunk(chunk_dir, kmer_len, q_size, backend, n_workers, executor_type,
+                                                   aggregator_list=[writer]))
+    clear_array_pools()
+    kh_arr, cnt_arr = reduce_kmer_buckets(writer, counts_dir, max_entries)
+    shutil.rmtree(bucket_dir)
+
+    return kh_arr, cnt_arr
+
+
+def count_kmer(input_fasta_file: str, kmer_len, q_size=20, out_dir=".", buffer_size=2 ** 26, rm_chunks_flag=True,
+               backend=None, as_counter=False, n_workers=None, executor_type="thread", max_memory_mb=None,
+               min_count=None, sketch_width=2**22):
     """
-    Count kmers of the input fasta file, which will be converted to chunks saved as .pkl file in folder "chunks" under
-    the output directory. The output is a Counter object (dictionary) and saved as .pkl file under the "kmer_counts"
-    folder.
+    Count kmers of the input fasta file, which will be converted to chunks saved as .npy file in folder "chunks" under
+    the output directory. The output is a sorted kmer hash array and a count array, saved as kmer count database k_#.kdb
+    under the "kmer_counts" folder. If max_memory_mb is given, kmers are counted out of core by
+    count_chunk_kmers_partitioned.
     Args:
         input_fasta_file: path to input fasta file, str
         kmer_len: kmer len, int, should be 3-31
@@ -599,11 +1448,19 @@ def count_kmer(input_fasta_file: str, kmer_len, q_size=20, out_dir=".", buffer_s
         out_dir: output directory
         buffer_size: size of the chunk, int, 2**26 bytes are 64MB, 2**30 bytes are 1GB, should be less equal than 2**31
         rm_chunks_flag: remove all files under "chunks" folder, bool, True or False
-
-    Returns: a Counter object (dictionary), key is hash, value is count
+        backend: compute backend, see get_backend
+        as_counter: return a Counter object (dictionary) instead of the arrays
+        n_workers: number of chunks hashed concurrently, number of cpus if None
+        executor_type: run the hashing in a "thread" or "process" pool
+        max_memory_mb: memory cap of the partitioned counting in MB, None counts all kmers in memory
+        min_count: if given, only kmers counted at least min_count times are kept, see count_chunk_kmers_min_count
+        sketch_width: number of counters in each row of the count-min sketch used by min_count
+
+    Returns: kmer hash array and count array, or a Counter object (dictionary), key is hash, value is count
     """
     assert os.path.exists(out_dir)
     assert 0 < buffer_size <= 2 ** 31
+    assert max_memory_mb is None or not min_count, "min_count is not supported by the partitioned counting"
     chunk_dir = os.path.join(out_dir, "chunks")
     counts_dir = os.path.join(out_dir, "kmer_counts")
     mk_dir(chunk_dir)
@@ -612,86 +1469,103 @@ def count_kmer(input_fasta_file: str, kmer_len, q_size=20, out_dir=".", buffer_s
     if rm_chunks_flag:
         rm_files(chunk_dir)
         buffer = Buffer(buffer_size)
-        # convert input fasta file into pickle chunks
+        # convert input fasta file into .npy chunks
         convert_input_chunks(input_fasta_file, buffer, out_dir=chunk_dir)
 
     # count kmers
-    res_counter = asyncio.run(count_kmer_producer_consumer_chunk(chunk_dir, kmer_len, q_size))
-    res_counter_file = f"k_{kmer_len}.pkl"
-    with open(os.path.join(counts_dir, res_counter_file), "wb") as fh:
-        pickle.dump(res_counter, fh)
+    if max_memory_mb is not None:
+        kh_arr, cnt_arr = count_chunk_kmers_partitioned(kmer_len, out_dir, max_memory_mb=max_memory_mb,
+                                                        backend=backend, n_workers=n_workers,
+                                                        executor_type=executor_type)
+    else:
+        kh_arr, cnt_arr = count_chunk_kmers(kmer_len, out_dir, q_size, backend, n_workers=n_workers,
+                                            executor_type=executor_type, min_count=min_count,
+                                            sketch_width=sketch_width)
+        clear_array_pools()
 
-    return res_counter
+    if as_counter:
+        return kmer_counts_to_counter(kh_arr, cnt_arr)
+    return kh_arr, cnt_arr
 
 
-def merge_revcom(kmer_hash_counter: Counter, kmer_len: int, keep_lower_hash_flag=True):
+def merge_revcom_arr(kh_arr: np.ndarray, cnt_arr: np.ndarray, kmer_len: int, keep_lower_hash_flag=True,
+                     backend=None) -> Tuple[np.ndarray, np.ndarray]:
     """
-    merge reverse complements
+    merge reverse complements of kmer count arrays
     Args:
-        kmer_hash_counter: Counter object, dictionary, key is kmer's hash, value is its count
+        kh_arr: sorted unique kmer hash array
+        cnt_arr: count array
         kmer_len: kmer length
         keep_lower_hash_flag: if keeping the lower hash as the key when merging a pair of reverse complements
+        backend: compute backend, see get_backend
     Returns:
-        a counter object in which reverse complement counts are merged
+        sorted unique kmer hash array and count array, in which reverse complement counts are merged
     """
-    uniq_kmer_hash_arr = np.array(list(kmer_hash_counter.keys()))
-    revcom_uniq_kmer_hash_arr = get_revcom_hash_arr(uniq_kmer_hash_arr, kmer_len)
+    rc_kh_arr = get_revcom_hash_arr(kh_arr, kmer_len, backend)
+    kh_arr = np.asarray(kh_arr, dtype=rc_kh_arr.dtype)
+    cnt_arr = np.asarray(cnt_arr)
 
-    if keep_lower_hash_flag:
-        inds = np.where(uniq_kmer_hash_arr < revcom_uniq_kmer_hash_arr)[0]
-    else:
-        inds = np.where(uniq_kmer_hash_arr > revcom_uniq_kmer_hash_arr)[0]
+    # partner (reverse complement) lookup in the sorted hash array
+    pos_arr = np.searchsorted(kh_arr, rc_kh_arr)
+    pos_arr[pos_arr == len(kh_arr)] = 0
+    found_flag_arr = kh_arr[pos_arr] == rc_kh_arr if len(kh_arr) > 0 else np.zeros(0, dtype=bool)
 
-    kh_arr = uniq_kmer_hash_arr[inds]
-    cnt_arr = np.zeros_like(kh_arr, dtype=np.uint32)
+    keep_flag_arr = kh_arr < rc_kh_arr if keep_lower_hash_flag else kh_arr > rc_kh_arr
+    palindrome_flag_arr = kh_arr == rc_kh_arr
+    # kept kmers get the counts of their partners, partners without a kept kmer are renamed to the kept hash
+    res_cnt_arr = cnt_arr + np.where(found_flag_arr & keep_flag_arr, cnt_arr[pos_arr], 0)
+    orphan_flag_arr = ~keep_flag_arr & ~palindrome_flag_arr & ~found_flag_arr
 
-    for i, kh in enumerate(kh_arr):
-        orig_ind = inds[i]
-        rc_kh = revcom_uniq_kmer_hash_arr[orig_ind]
-        cnt_arr[i] = kmer_hash_counter[kh] + kmer_hash_counter.get(rc_kh, 0)
+    res_kh_arr = np.concatenate((kh_arr[keep_flag_arr | palindrome_flag_arr], rc_kh_arr[orphan_flag_arr]))
+    res_cnt_arr = np.concatenate((res_cnt_arr[keep_flag_arr | palindrome_flag_arr], cnt_arr[orphan_flag_arr]))
+    inds = np.argsort(res_kh_arr, kind="stable")
+    return res_kh_arr[inds], res_cnt_arr[inds]
 
-    palindrome_inds = np.where(uniq_kmer_hash_arr == revcom_uniq_kmer_hash_arr)[0]
-    palindrome_kh_arr = uniq_kmer_hash_arr[palindrome_inds]
-    palindrome_cnt_arr = np.zeros_like(palindrome_kh_arr, dtype=np.uint32)
-    for i, kh in enumerate(palindrome_kh_arr):
-        palindrome_cnt_arr[i] = kmer_hash_counter[kh]
 
-    res_counter = Counter(dict(zip(chain(kh_arr, palindrome_kh_arr), chain(cnt_arr, palindrome_cnt_arr))))
-    return res_counter
+def merge_revcom(kmer_hash_counter: Counter, kmer_len: int, keep_lower_hash_flag=True, backend=None):
+    """
+    merge reverse complements, Counter version of merge_revcom_arr
+    Args:
+        kmer_hash_counter: Counter object, dictionary, key is kmer's hash, value is its count
+        kmer_len: kmer length
+        keep_lower_hash_flag: if keeping the lower hash as the key when merging a pair of reverse complements
+        backend: compute backend, see get_backend
+    Returns:
+        a counter object in which reverse complement counts are merged
+    """
+    kh_arr, cnt_arr = counter_to_kmer_counts(kmer_hash_counter, kmer_len)
+    return kmer_counts_to_counter(*merge_revcom_arr(kh_arr, cnt_arr, kmer_len, keep_lower_hash_flag, backend))
 
 
-def cal_hamming_dist(kh_arr: np.ndarray, consensus_kh: np.uint64, kmer_len: int) -> np.ndarray:
+def cal_hamming_dist(kh_arr: np.ndarray, consensus_kh: np.uint64, kmer_len: int, backend=None) -> np.ndarray:
     """
     calculate the Hamming distances between each element in kh_arr and the consensus sequence
     Args:
         kh_arr: kmer hash array
         consensus_kh: kmer hash of the consensus sequence
         kmer_len: kmer length
+        backend: compute backend, see get_backend
     Returns:
         Hamming distance array, np.ndarray object
     """
-    ham_dist_arr = np.empty_like(kh_arr, dtype=np.uint8)
     hash_dtype = get_hash_dtype(kmer_len)
+    kh_arr = np.ascontiguousarray(kh_arr, dtype=hash_dtype)
+    ham_dist_arr = np.empty_like(kh_arr, dtype=np.uint8)
     consensus_kh_arr = np.array([consensus_kh], dtype=hash_dtype)
-    hash_arr_size = len(kh_arr)
 
-    if hash_dtype == np.uint32:
-        cal_ham_dist_kernel_uint32(kh_arr, consensus_kh_arr, ham_dist_arr, hash_arr_size, kmer_len)
-    elif hash_dtype == np.uint64:
-        cal_ham_dist_kernel_uint64(kh_arr, consensus_kh_arr, ham_dist_arr, hash_arr_size, kmer_len)
-    else:
-        raise Exception(f"Unknown kmer hash type hash_dtype={hash_dtype}")
+    get_backend(backend).hamming_dist(kh_arr, consensus_kh_arr, kmer_len, ham_dist_arr)
     return ham_dist_arr
 
 
-def get_hamming_ball(kh_arr: np.ndarray, consensus_kh: np.uint64, kmer_len: int, max_ham_dist: int) -> np.ndarray:
-    dist_arr = cal_hamming_dist(kh_arr, consensus_kh, kmer_len)
+def get_hamming_ball(kh_arr: np.ndarray, consensus_kh: np.uint64, kmer_len: int, max_ham_dist: int,
+                     backend=None) -> np.ndarray:
+    dist_arr = cal_hamming_dist(kh_arr, consensus_kh, kmer_len, backend)
     hamming_ball_arr = kh_arr[dist_arr <= max_ham_dist]
     return hamming_ball_arr
 
 
 def is_motif(kh_arr: np.ndarray, consensus_kh: np.uint64,
-             kmer_len: int, max_ham_dist: int, revcom_flag=False) -> np.ndarray:
+             kmer_len: int, max_ham_dist: int, revcom_flag=False, backend=None) -> np.ndarray:
     """
     check if each kmer is a motif kmer given in kh_arr
     Args:
@@ -700,61 +1574,111 @@ def is_motif(kh_arr: np.ndarray, consensus_kh: np.uint64,
         kmer_len: kmer length
         max_ham_dist: maximum Hamming distance to the consensus, inclusive
         revcom_flag: if distance to the reverse complement of the consensus should be considered
+        backend: compute backend, see get_backend
     Returns:
         a logical np.ndarray
     """
-    dist_arr = cal_hamming_dist(kh_arr, consensus_kh, kmer_len)
+    dist_arr = cal_hamming_dist(kh_arr, consensus_kh, kmer_len, backend)
 
     if not revcom_flag:
         return dist_arr <= max_ham_dist
 
     rc_hash = revcom_hash(consensus_kh, kmer_len)
-    rc_dist_arr = cal_hamming_dist(kh_arr, rc_hash, kmer_len)
+    rc_dist_arr = cal_hamming_dist(kh_arr, rc_hash, kmer_len, backend)
 
     return np.logical_or(dist_arr <= max_ham_dist, rc_dist_arr <= max_ham_dist)
 
 
-def contain_motif(kh_arr: np.ndarray, kh_len: int,
-                  consensus_kh: np.uint64, consensus_kh_len: int, max_ham_dist: int,
-                  revcom_flag=False):
+def cal_min_hamming_dist(kh_arr: np.ndarray, kh_len: int, consensus_kh, consensus_kh_len: int,
+                         revcom_flag=False, backend=None) -> np.ndarray:
+    """
+    calculate the minimum Hamming distance between the sub-kmers at all offsets of each kmer in kh_arr and
+    one or several consensuses, in one pass over kh_arr
+    Args:
+        kh_arr: kmer hash array, kmer length kh_len
+        kh_len: kmer length of kh_arr
+        consensus_kh: consensus kmer hash, or a list/array of consensus kmer hashes
+        consensus_kh_len: kmer length of the consensuses
+        revcom_flag: if distances to the reverse complements of the consensuses should be considered
+        backend: compute backend, see get_backend
+    Returns:
+        minimum Hamming distance array, np.uint8
+    """
     assert kh_len >= consensus_kh_len
+    hash_dtype = get_hash_dtype(kh_len)
+    kh_arr = np.ascontiguousarray(kh_arr, dtype=hash_dtype)
+    consensus_kh_arr = np.atleast_1d(np.asarray(consensus_kh, dtype=get_hash_dtype(consensus_kh_len)))
+    if revcom_flag:
+        consensus_kh_arr = np.concatenate((consensus_kh_arr,
+                                           get_revcom_hash_arr(consensus_kh_arr, consensus_kh_len, backend)))
+    # the kernel works in the hash type of kh_arr
+    consensus_kh_arr = np.unique(consensus_kh_arr).astype(hash_dtype)
 
-    hash_dtype = get_hash_dtype(consensus_kh_len)
-    motif_flag_arr = np.full_like(kh_arr, False, dtype=bool)
-    mask = hash_dtype((1 << 2 * consensus_kh_len) - 1)
+    min_dist_arr = np.empty(len(kh_arr), dtype=np.uint8)
+    if len(kh_arr) > 0:
+        get_backend(backend).min_hamming_dist(kh_arr, kh_len, consensus_kh_arr, consensus_kh_len, min_dist_arr)
+    return min_dist_arr
 
-    for offset in range(kh_len - consensus_kh_len + 1):
-        tmp_kh_arr = np.right_shift(kh_arr, 2 * offset)
-        tmp_kh_arr = np.bitwise_and(tmp_kh_arr, mask)
-        tmp_kh_arr = tmp_kh_arr.astype(hash_dtype)
-        motif_flag_arr = np.logical_or(motif_flag_arr, is_motif(tmp_kh_arr, consensus_kh, consensus_kh_len,
-                                                                max_ham_dist=max_ham_dist, revcom_flag=revcom_flag))
-    return motif_flag_arr
 
+def contain_motif(kh_arr: np.ndarray, kh_len: int,
+                  consensus_kh, consensus_kh_len: int, max_ham_dist: int,
+                  revcom_flag=False, backend=None):
+    """
+    check if each kmer contains a motif kmer at any offset
+    Args:
+        kh_arr: input kmer hash array to be checked
+        kh_len: kmer length of kh_arr
+        consensus_kh: consensus kmer hash, or a list/array of consensus kmer hashes
+        consensus_kh_len: kmer length of the consensuses
+        max_ham_dist: maximum Hamming distance to a consensus, inclusive
+        revcom_flag: if distances to the reverse complements of the consensuses should be considered
+        backend: compute backend, see get_backend
+    Returns:
+        a logical np.ndarray
+    """
+    min_dist_arr = cal_min_hamming_dist(kh_arr, kh_len, consensus_kh, consensus_kh_len, revcom_flag, backend)
+    return min_dist_arr <= max_ham_dist
 
-def convert_kh_counter(kmer_hash_counter: Counter, kmer_len: int, target_kmer_len: int) -> Counter:
+
+def convert_kh_arr(kh_arr: np.ndarray, cnt_arr: np.ndarray, kmer_len: int,
+                   target_kmer_len: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    convert kmer counts into counts of shorter target kmers, the count of a target kmer is the sum of the counts of
+    the kmers containing it over all offsets, divided by the number of offsets
+    Args:
+        kh_arr: kmer hash array
+        cnt_arr: count array
+        kmer_len: kmer length
+        target_kmer_len: target kmer length, less than kmer_len
+    Returns:
+        sorted unique target kmer hash array and count array, target kmers with zero count are removed
+    """
     assert kmer_len > target_kmer_len
     hash_dtype = get_hash_dtype(kmer_len)
-    kh_arr = np.array(list(kmer_hash_counter.keys()), dtype=hash_dtype)
-    kh_cnt_arr = np.array(list(kmer_hash_counter.values()), dtype=np.uint32)
+    kh_arr = np.asarray(kh_arr, dtype=hash_dtype)
+    cnt_arr = np.asarray(cnt_arr, dtype=np.int64)
 
-    valid_inds = kh_cnt_arr > 0
+    valid_inds = cnt_arr > 0
     kh_arr = kh_arr[valid_inds]
-    kh_cnt_arr = kh_cnt_arr[valid_inds]
+    cnt_arr = cnt_arr[valid_inds]
 
-    target_counter = Counter()
     target_hash_dtype = get_hash_dtype(target_kmer_len)
-    mask = target_hash_dtype((1 << 2 * target_kmer_len) - 1)
-
-    for i in range(kmer_len - target_kmer_len + 1):
-        target_kh_arr = np.bitwise_and(np.right_shift(kh_arr, 2 * i), mask).astype(target_hash_dtype)
-        target_counter += Counter(dict(zip(target_kh_arr, kh_cnt_arr)))
+    mask = hash_dtype((1 << 2 * target_kmer_len) - 1)
+    n_offset = kmer_len - target_kmer_len + 1
+    target_kh_arr = np.concatenate([np.bitwise_and(np.right_shift(kh_arr, hash_dtype(2 * i)), mask)
+                                    for i in range(n_offset)]).astype(target_hash_dtype)
+    target_kh_arr, target_cnt_arr = reduce_kmer_counts(target_kh_arr, np.tile(cnt_arr, n_offset))
 
     # each target kmer (not the boundary ones) are counted (kmer_len - target_kmer_len + 1) times
-    for k in target_counter:
-        target_counter[k] //= (kmer_len - target_kmer_len + 1)
+    target_cnt_arr //= n_offset
+    valid_inds = target_cnt_arr > 0
+    return target_kh_arr[valid_inds], target_cnt_arr[valid_inds]
 
-    return target_counter
+
+def convert_kh_counter(kmer_hash_counter: Counter, kmer_len: int, target_kmer_len: int) -> Counter:
+    # Counter version of convert_kh_arr
+    kh_arr, cnt_arr = counter_to_kmer_counts(kmer_hash_counter, kmer_len)
+    return kmer_counts_to_counter(*convert_kh_arr(kh_arr, cnt_arr, kmer_len, target_kmer_len))
 
 
 def test_convert_kh_arr():
@@ -970,7 +1894,7 @@ def test_producer_consumer_chunk():
     buffer_size = 100
 
     res_counter = count_kmer(input_fasta_file, kmer_len,
-                             q_size=q_size, out_dir=".", buffer_size=buffer_size, rm_chunks_flag=False)
+                             q_size=q_size, out_dir=".", buffer_size=buffer_size, rm_chunks_flag=False, as_counter=True)
     print(res_counter)
 
     from inimotif import KmerCounter
@@ -999,52 +1923,112 @@ def test_producer_consumer_chunk():
 
 
 def preprocess(input_fasta_file: str, min_kmer_len, max_kmer_len, out_dir=".",
-               q_size=20, buffer_size=2**26):
+               q_size=20, buffer_size=2**26, backend=None, n_workers=None, executor_type="thread",
+               multi_k_flag=True, min_count=None, sketch_width=2**22):
+    """
+    convert the input fasta file into chunks and count kmers of length min_kmer_len to max_kmer_len+4
+    Args:
+        multi_k_flag: load each chunk once and count all kmer lengths, otherwise read all chunks for each kmer length,
+            which needs less memory as only one kmer length is aggregated at a time
+        min_count: if given, only kmers counted at least min_count times are kept, see count_chunk_kmers_min_count
+        sketch_width: number of counters in each row of the count-min sketch of each kmer length
+    """
     assert min_kmer_len > 1
     assert max_kmer_len < 32 - 5
     # convert input fasta file into chunks
     proc_input(input_fasta_file, out_dir, buffer_size=buffer_size)
 
     # count kmers
-    for kmer_len in range(min_kmer_len, max_kmer_len+5):
-        count_chunk_kmers(kmer_len, out_dir, q_size=q_size)
+    backend = get_backend(backend)
+    kmer_len_list = list(range(min_kmer_len, max_kmer_len+5))
+    if multi_k_flag:
+        count_chunk_multi_kmers(kmer_len_list, out_dir, q_size=q_size, backend=backend,
+                                n_workers=n_workers, executor_type=executor_type,
+                                min_count=min_count, sketch_width=sketch_width)
+    else:
+        for kmer_len in kmer_len_list:
+            count_chunk_kmers(kmer_len, out_dir, q_size=q_size, backend=backend,
+                              n_workers=n_workers, executor_type=executor_type,
+                              min_count=min_count, sketch_width=sketch_width)
+    clear_array_pools()
 
 
-def find_motif(out_dir: str, kmer_len: int, top_k: int, high_kmer_len: int, max_ham_dist: int, revcom_mode=True) -> List:
+def find_motif(out_dir: str, kmer_len: int, top_k: int, high_kmer_len: int, max_ham_dist: int, revcom_mode=True,
+               backend=None) -> List:
+    """
+    find top_k consensus kmers iteratively. After a consensus is found, the high kmers containing the motif are
+    removed, and the kmer counts are derived from the remaining high kmers.
+    The high kmer table is kept as arrays with a live mask, the derived kmer counts are updated incrementally by
+    subtracting the contributions of the removed high kmers.
+    Args:
+        out_dir: output directory of preprocess, containing the kmer counts of kmer_len and high_kmer_len
+        kmer_len: kmer length of the consensus
+        top_k: number of consensuses
+        high_kmer_len: kmer length of the high kmers
+        max_ham_dist: maximum Hamming distance of motif kmers to the consensus, inclusive
+        revcom_mode: if reverse complements are merged
+        backend: compute backend, see get_backend
+    Returns:
+        list of consensus kmer hashes
+    """
+    backend = get_backend(backend)
     # find consensus
-    kmer_counts_file = os.path.join(out_dir, "kmer_counts", f"k_{kmer_len}.pkl")
-    with open(kmer_counts_file, "rb") as fh:
-        kh_counter = pickle.load(fh)
-
-    high_kmer_counts_file = os.path.join(out_dir, "kmer_counts", f"k_{high_kmer_len}.pkl")
-    with open(high_kmer_counts_file, "rb") as fh:
-        high_kh_counter = pickle.load(fh)
+    hash_dtype = get_hash_dtype(kmer_len)
+    high_hash_dtype = get_hash_dtype(high_kmer_len)
+    kh_arr, cnt_arr = load_kmer_counts(out_dir, kmer_len)
+    high_kh_arr, high_cnt_arr = load_kmer_counts(out_dir, high_kmer_len)
+    kh_arr, cnt_arr = np.asarray(kh_arr, dtype=hash_dtype), np.asarray(cnt_arr, dtype=np.int64)
+    high_kh_arr, high_cnt_arr = np.asarray(high_kh_arr, dtype=high_hash_dtype), np.asarray(high_cnt_arr, dtype=np.int64)
 
     if revcom_mode:
-        kh_counter = merge_revcom(kh_counter, kmer_len)  # merge reverse complements
-        high_kh_counter = merge_revcom(high_kh_counter, high_kmer_len)
+        kh_arr, cnt_arr = merge_revcom_arr(kh_arr, cnt_arr, kmer_len, backend=backend)  # merge reverse complements
+        high_kh_arr, high_cnt_arr = merge_revcom_arr(high_kh_arr, high_cnt_arr, high_kmer_len, backend=backend)
+
+    high_live_arr = high_cnt_arr > 0
+
+    # kmers at each offset of the high kmers, low_ind_arr[i, j] is the index in low_kh_arr of the kmer at offset i
+    # of high kmer j. A derived kmer count is the sum of high kmer counts over all offsets divided by n_offset.
+    n_offset = high_kmer_len - kmer_len + 1
+    mask = hash_dtype((1 << 2 * kmer_len) - 1)
+    sub_kh_arr = np.concatenate([np.bitwise_and(np.right_shift(high_kh_arr, high_hash_dtype(2 * i)), mask)
+                                 for i in range(n_offset)]).astype(hash_dtype)
+    low_kh_arr, low_ind_arr = np.unique(sub_kh_arr, return_inverse=True)
+    low_ind_arr = low_ind_arr.reshape(n_offset, len(high_kh_arr))
+    low_sum_arr = np.zeros(len(low_kh_arr), dtype=np.int64)
+    np.add.at(low_sum_arr, low_ind_arr[:, high_live_arr].ravel(), np.tile(high_cnt_arr[high_live_arr], n_offset))
+
+    # derived kmers are merged with their reverse complements, keeping the lower hash
+    if revcom_mode:
+        canon_kh_arr = np.minimum(low_kh_arr, get_revcom_hash_arr(low_kh_arr, kmer_len, backend))
+    else:
+        canon_kh_arr = low_kh_arr
+    canon_kh_arr, canon_ind_arr = np.unique(canon_kh_arr, return_inverse=True)
 
     res_conseq_kh_list = []
-    high_kh_arr = np.array(list(high_kh_counter.keys()))
-
     # take out top_k consensuses
     for i in range(top_k):
-        consensus_kh = kh_counter.most_common(1)[0][0]  # get consensus sequence
+        if i == 0:
+            if len(kh_arr) == 0:
+                break
+            consensus_kh = kh_arr[np.argmax(cnt_arr)]  # get consensus sequence
+        else:
+            canon_cnt_arr = np.bincount(canon_ind_arr, weights=low_sum_arr // n_offset, minlength=len(canon_kh_arr))
+            if len(canon_cnt_arr) == 0 or canon_cnt_arr.max() <= 0:
+                break
+            consensus_kh = canon_kh_arr[np.argmax(canon_cnt_arr)]
 
         # do something here, check if filtering criterion is met
         res_conseq_kh_list.append(consensus_kh)
 
-        # remove this consenus motif from high kmer counter
-        high_motif_flag_arr = contain_motif(high_kh_arr, high_kmer_len, consensus_kh, kmer_len,
-                                       max_ham_dist=max_ham_dist, revcom_flag=revcom_mode)  # substring of high kmer might be revcom
-        for kh in high_kh_arr[high_motif_flag_arr]:
-            high_kh_counter[kh] = 0
-        high_kh_arr = high_kh_arr[np.logical_not(high_motif_flag_arr)]
-
-        # convert high_kh_counter to kmer counter, substring of high kmer might be revcom, need to merge
-        kh_counter = convert_kh_counter(high_kh_counter, high_kmer_len, kmer_len)
-        if revcom_mode:
-            kh_counter = merge_revcom(kh_counter, high_kmer_len)
+        # remove the high kmers containing this consensus motif, substring of high kmer might be revcom
+        live_ind_arr = np.flatnonzero(high_live_arr)
+        high_motif_flag_arr = contain_motif(high_kh_arr[live_ind_arr], high_kmer_len, consensus_kh, kmer_len,
+                                            max_ham_dist=max_ham_dist, revcom_flag=revcom_mode, backend=backend)
+        rm_ind_arr = live_ind_arr[high_motif_flag_arr]
+        high_live_arr[rm_ind_arr] = False
+
+        # subtract the contributions of the removed high kmers from the derived kmer counts
+        np.subtract.at(low_sum_arr, low_ind_arr[:, rm_ind_arr].ravel(), np.tile(high_cnt_arr[rm_ind_arr], n_offset))
 
     return res_conseq_kh_list
 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Description: on-disk kmer count database, one file k_#.kdb per kmer length.
+
+The file is a header followed by the sorted unique kmer hash array, the count array and a prefix index:
+
+    | magic (8 bytes) | json header, padded to HEADER_SIZE | hash array | count array | prefix index |
+
+Each array starts at a multiple of ALIGNMENT bytes, the offsets are given in the header. All arrays are memory
+mapped when the database is opened, such that opening takes milliseconds regardless of the table size.
+prefix_index[p] is the position of the first kmer whose highest prefix_bits bits are >= p, the kmers with prefix p
+are hash_arr[prefix_index[p]:prefix_index[p+1]].
+"""
+import json
+import os
+from collections import Counter
+from typing import Tuple
+
+import numpy as np
+
+
+KMER_COUNT_DB_MAGIC = b"KMERCDB1"
+HEADER_SIZE = 4096
+ALIGNMENT = 64
+# maximum number of bits of the prefix index, the index takes at most 8 * 2**MAX_PREFIX_BITS bytes
+MAX_PREFIX_BITS = 24
+
+
+def get_kmer_count_db_file(counts_dir: str, kmer_len: int) -> str:
+    return os.path.join(counts_dir, f"k_{kmer_len}.kdb")
+
+
+def get_prefix_bits(n_kmer: int, kmer_len: int) -> int:
+    # about 8 kmers per prefix on average
+    n_bits = int(np.ceil(np.log2(n_kmer + 1))) - 3
+    return int(min(max(n_bits, 0), 2 * kmer_len, MAX_PREFIX_BITS))
+
+
+def align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_kmer_count_db(file_name: str, kmer_len: int, kh_arr: np.ndarray, cnt_arr: np.ndarray, prefix_bits=None,
+                        block_size=2 ** 24):
+    """
+    write a kmer count database
+    Args:
+        file_name: output file, k_#.kdb
+        kmer_len: kmer length
+        kh_arr: sorted unique kmer hash array, may be memory mapped
+        cnt_arr: count array
+        prefix_bits: number of bits of the prefix index, derived from the number of kmers if None
+        block_size: the arrays are copied block by block, such that memory mapped inputs are not loaded at once
+    """
+    assert len(kh_arr) == len(cnt_arr)
+    n_kmer = len(kh_arr)
+    hash_dtype = np.dtype(kh_arr.dtype)
+    cnt_dtype = np.dtype(np.int64)
+    if prefix_bits is None:
+        prefix_bits = get_prefix_bits(n_kmer, kmer_len)
+    assert 0 <= prefix_bits <= 2 * kmer_len
+
+    hash_offset = HEADER_SIZE
+    count_offset = align(hash_offset + n_kmer * hash_dtype.itemsize)
+    index_offset = align(count_offset + n_kmer * cnt_dtype.itemsize)
+    n_index = (1 << prefix_bits) + 1
+    file_size = index_offset + n_index * 8
+
+    header = {"kmer_len": kmer_len, "n_kmer": n_kmer, "hash_dtype": hash_dtype.name, "count_dtype": cnt_dtype.name,
+              "prefix_bits": prefix_bits, "hash_offset": hash_offset, "count_offset": count_offset,
+              "index_offset": index_offset}
+    header_bytes = KMER_COUNT_DB_MAGIC + json.dumps(header).encode()
+    assert len(header_bytes) <= HEADER_SIZE
+
+    # write to a temporary file which replaces file_name at the end, such that arrays still memory mapped onto an
+    # existing file_name, e.g. by an earlier count of the same kmer length, are not changed
+    tmp_file = f"{file_name}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "wb") as fh:
+            fh.write(header_bytes)
+            fh.truncate(file_size)
+        if n_kmer > 0:
+            out_kh_arr = np.memmap(tmp_file, dtype=hash_dtype, mode="r+", offset=hash_offset, shape=(n_kmer,))
+            out_cnt_arr = np.memmap(tmp_file, dtype=cnt_dtype, mode="r+", offset=count_offset, shape=(n_kmer,))
+            for st in range(0, n_kmer, block_size):
+                out_kh_arr[st:st + block_size] = kh_arr[st:st + block_size]
+                out_cnt_arr[st:st + block_size] = cnt_arr[st:st + block_size]
+            out_kh_arr.flush()
+            out_cnt_arr.flush()
+            del out_kh_arr, out_cnt_arr
+
+        # prefix p starts at the first hash >= p << shift
+        index_arr = np.memmap(tmp_file, dtype=np.uint64, mode="r+", offset=index_offset, shape=(n_index,))
+        shift = 2 * kmer_len - prefix_bits
+        bound_arr = np.arange(n_index, dtype=np.uint64) << np.uint64(shift)
+        if hash_dtype == np.uint32:
+            # the last bound 1 << 2*kmer_len may not fit into the hash type, all hashes are smaller
+            index_arr[:-1] = np.searchsorted(kh_arr, bound_arr[:-1].astype(hash_dtype))
+            index_arr[-1] = n_kmer
+        else:
+            index_arr[:] = np.searchsorted(kh_arr, bound_arr)
+        index_arr.flush()
+        del index_arr
+
+        os.replace(tmp_file, file_name)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+class KmerCountDB:
+    """
+    read only kmer count database, see write_kmer_count_db for the format
+
+    db = KmerCountDB("out/kmer_counts/k_20.kdb")
+    db.get(kh), db.get_counts(kh_arr), db.prefix_range(prefix_kh, prefix_len), db.top_n(10)
+
+    Attributes:
+        kmer_len: kmer length
+        hash_arr: sorted unique kmer hash array, memory mapped
+        count_arr: count array, memory mapped
+        index_arr: prefix index, memory mapped
+        prefix_bits: number of bits of the prefix index
+    """
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        with open(file_name, "rb") as fh:
+            header_bytes = fh.read(HEADER_SIZE)
+        if header_bytes[:len(KMER_COUNT_DB_MAGIC)] != KMER_COUNT_DB_MAGIC:
+            raise Exception(f"{file_name} is not a kmer count database.")
+        header = json.loads(header_bytes[len(KMER_COUNT_DB_MAGIC):].rstrip(b"\x00").decode())
+        self.header = header
+        self.kmer_len = header["kmer_len"]
+        self.n_kmer = header["n_kmer"]
+        self.prefix_bits = header["prefix_bits"]
+        self.shift = 2 * self.kmer_len - self.prefix_bits
+        self.hash_dtype = np.dtype(header["hash_dtype"]).type
+
+        def load(dtype, offset, n):
+            # np.memmap does not support empty arrays
+            if n == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(file_name, dtype=dtype, mode="r", offset=offset, shape=(n,))
+
+        self.hash_arr = load(self.hash_dtype, header["hash_offset"], self.n_kmer)
+        self.count_arr = load(np.dtype(header["count_dtype"]), header["count_offset"], self.n_kmer)
+        self.index_arr = load(np.uint64, header["index_offset"], (1 << self.prefix_bits) + 1)
+
+    def __len__(self):
+        return self.n_kmer
+
+    def _get_pos(self, kh_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # position of each kmer hash in hash_arr and a flag if it is found
+        kh_arr = np.asarray(kh_arr, dtype=self.hash_dtype)
+        pos_arr = np.searchsorted(self.hash_arr, kh_arr)
+        found_arr = np.zeros(len(kh_arr), dtype=bool)
+        valid_inds = pos_arr < self.n_kmer
+        found_arr[valid_inds] = self.hash_arr[pos_arr[valid_inds]] == kh_arr[valid_inds]
+        return pos_arr, found_arr
+
+    def get(self, kh) -> int:
+        # count of a kmer hash, 0 if not found. The prefix index narrows the search to one prefix range
+        kh = int(kh)
+        if kh < 0 or kh >= 1 << 2 * self.kmer_len:
+            return 0
+        prefix = kh >> self.shift
+        st, ed = int(self.index_arr[prefix]), int(self.index_arr[prefix + 1])
+        pos = st + int(np.searchsorted(self.hash_arr[st:ed], self.hash_dtype(kh)))
+        if pos < ed and self.hash_arr[pos] == kh:
+            return int(self.count_arr[pos])
+        return 0
+
+    def __getitem__(self, kh) -> int:
+        return self.get(kh)
+
+    def __contains__(self, kh) -> bool:
+        return self.get(kh) > 0
+
+    def get_counts(self, kh_arr: np.ndarray) -> np.ndarray:
+        # counts of a batch of kmer hashes, 0 for the ones not found
+        kh_arr = np.asarray(kh_arr, dtype=self.hash_dtype)
+        # sorted queries access the memory mapped array in order
+        inds = np.argsort(kh_arr, kind="stable")
+        pos_arr, found_arr = self._get_pos(kh_arr[inds])
+        res_arr = np.zeros(len(kh_arr), dtype=np.int64)
+        res_arr[inds[found_arr]] = self.count_arr[pos_arr[found_arr]]
+        return res_arr
+
+    def hash_range(self, lo_kh, hi_kh) -> Tuple[int, int]:
+        # positions [st, ed) of the kmer hashes in [lo_kh, hi_kh)
+        lo_kh, hi_kh = int(lo_kh), min(int(hi_kh), 1 << 2 * self.kmer_len)
+        if lo_kh >= hi_kh:
+            return 0, 0
+        # narrow the search by the prefix index
+        st = int(self.index_arr[lo_kh >> self.shift])
+        ed = int(self.index_arr[((hi_kh - 1) >> self.shift) + 1])
+        sub_arr = self.hash_arr[st:ed]
+        return (st + int(np.searchsorted(sub_arr, self.hash_dtype(lo_kh))),
+                st + int(np.searchsorted(sub_arr, self.hash_dtype(hi_kh - 1), side="right")))
+
+    def prefix_range(self, prefix_kh, prefix_len: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        all kmers starting with a given prefix
+        Args:
+            prefix_kh: hash of the prefix sequence
+            prefix_len: length of the prefix sequence, at most kmer_len
+        Returns:
+            kmer hash array and count array of the kmers with this prefix, memory mapped
+        """
+        assert 0 <= prefix_len <= self.kmer_len
+        suffix_bits = 2 * (self.kmer_len - prefix_len)
+        st, ed = self.hash_range(int(prefix_kh) << suffix_bits, (int(prefix_kh) + 1) << suffix_bits)
+        return self.hash_arr[st:ed], self.count_arr[st:ed]
+
+    def top_n(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        # the n kmers with the highest counts, sorted by count in descending order, ties by hash
+        n = min(n, self.n_kmer)
+        if n == 0:
+            return np.zeros(0, dtype=self.hash_dtype), np.zeros(0, dtype=np.int64)
+        cnt_arr = np.asarray(self.count_arr)
+        min_cnt = -np.partition(-cnt_arr, n - 1)[n - 1]
+        # the hashes are sorted, kmers tied at the lowest count are taken by position
+        inds = np.flatnonzero(cnt_arr > min_cnt)
+        inds = np.concatenate([inds, np.flatnonzero(cnt_arr == min_cnt)[:n - len(inds)]])
+        inds = inds[np.lexsort((inds, -cnt_arr[inds]))]
+        return np.asarray(self.hash_arr[inds]), cnt_arr[inds]
+
+    def get_pair_counts(self, kh_arr: np.ndarray, backend=None) -> np.ndarray:
+        # summed counts of each kmer and its reverse complement, a palindrome is counted once
+        from kmer_count_async import get_revcom_hash_arr
+
+        kh_arr = np.asarray(kh_arr, dtype=self.hash_dtype)
+        rc_kh_arr = get_revcom_hash_arr(kh_arr, self.kmer_len, backend)
+        return self.get_counts(kh_arr) + np.where(rc_kh_arr != kh_arr, self.get_counts(rc_kh_arr), 0)
+
+    def to_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        # memory mapped kmer hash array and count array
+        return self.hash_arr, self.count_arr
+
+    def to_counter(self) -> Counter:
+        return Counter(dict(zip(np.asarray(self.hash_arr).tolist(), np.asarray(self.count_arr).tolist())))
@@ -0,0 +1,274 @@
+import numpy as np
+import taichi as ti
+
+"""
+Author: Lu Cheng, @chengl7
+Description: taichi kernels for kmer hashing, Hamming distances and reverse complements.
+This module is imported lazily by the compute backend in kmer_count_async.py, such that importing
+kmer_count_async does not import taichi or probe for a GPU.
+"""
+
+
+# (arch, n_threads) taichi was initialized with, None if not initialized
+_init_config = None
+
+
+def init_taichi(arch="cpu", n_threads=None):
+    """
+    initialize taichi, re-initialize only if arch or n_threads changed
+    Args:
+        arch: "cpu" or "gpu"
+        n_threads: maximum number of cpu threads, all cores if None
+    """
+    global _init_config
+    if _init_config == (arch, n_threads):
+        return
+    if arch == "gpu":
+        ti.init(arch=ti.gpu, default_ip=ti.i64, log_level=ti.WARN)
+        if ti.cfg.arch == ti.cpu:
+            print("GPU is not available, taichi falls back to CPU")
+    elif arch == "cpu":
+        if n_threads:
+            ti.init(arch=ti.cpu, default_ip=ti.i64, log_level=ti.WARN, cpu_max_num_threads=n_threads)
+        else:
+            ti.init(arch=ti.cpu, default_ip=ti.i64, log_level=ti.WARN)
+    else:
+        raise Exception(f"Unknown taichi arch={arch}, should be cpu or gpu.")
+    _init_config = (arch, n_threads)
+
+
+def get_taichi_dtype(np_dtype: np.uint32):
+    dict = {np.uint8: ti.uint8, np.uint16: ti.uint16, np.uint32: ti.uint32, np.uint64: ti.uint64}
+    return dict[np_dtype]
+
+
+@ti.func
+def revcom_hash_uint32(in_hash: ti.u32,
+                       mask: ti.u32,
+                       twobit_mask: ti.u32,
+                       k: int):
+    com_hash = mask - in_hash  # complement hash
+    ret_hash = twobit_mask & com_hash
+    for i in range(k - 1):
+        ret_hash = ret_hash << 2
+        com_hash = com_hash >> 2
+        ret_hash += twobit_mask & com_hash
+    return ret_hash
+
+
+@ti.func
+def revcom_hash_uint64(in_hash: ti.u64,
+                       mask: ti.u64,
+                       twobit_mask: ti.u64,
+                       k: int):
+    com_hash = mask - in_hash  # complement hash
+    ret_hash = twobit_mask & com_hash
+    for i in range(k - 1):
+        ret_hash = ret_hash << 2
+        com_hash = com_hash >> 2
+        ret_hash += twobit_mask & com_hash
+    return ret_hash
+
+
+@ti.kernel
+def revcom_hash_kernel_uint32(in_hash_arr: ti.types.ndarray(dtype=ti.u32),
+                              out_hash_arr: ti.types.ndarray(dtype=ti.u32),
+                              mask_arr: ti.types.ndarray(dtype=ti.u32),
+                              kmer_len: int, in_hash_arr_size: int):
+    for i in range(in_hash_arr_size):
+        out_hash_arr[i] = revcom_hash_uint32(in_hash_arr[i], mask_arr[0], mask_arr[1], kmer_len)
+
+
+@ti.kernel
+def revcom_hash_kernel_uint64(in_hash_arr: ti.types.ndarray(dtype=ti.u64),
+                              out_hash_arr: ti.types.ndarray(dtype=ti.u64),
+                              mask_arr: ti.types.ndarray(dtype=ti.u64),
+                              kmer_len: int, in_hash_arr_size: int):
+    for i in range(in_hash_arr_size):
+        out_hash_arr[i] = revcom_hash_uint64(in_hash_arr[i], mask_arr[0], mask_arr[1], kmer_len)
+
+
+@ti.func
+def cal_ham_dist_uint32(hash1: ti.u32, hash2: ti.u32, kmer_len: int):
+    xor_result = hash1 ^ hash2
+    twobit_mask = ti.cast(3, ti.u32)
+    hamming_dist = 0
+    for _ in range(kmer_len):
+        cmp_res = xor_result & twobit_mask
+        hamming_dist += cmp_res != 0
+        xor_result >>= 2
+    return hamming_dist
+
+
+@ti.kernel
+def cal_ham_dist_kernel_uint32(hash_arr: ti.types.ndarray(dtype=ti.u32),
+                               target_hash: ti.types.ndarray(dtype=ti.u32),
+                               ham_dist_arr: ti.types.ndarray(dtype=ti.u8),
+                               hash_arr_size: int,
+                               kmer_len: int):
+    for i in range(hash_arr_size):
+        ham_dist_arr[i] = ti.cast(cal_ham_dist_uint32(hash_arr[i], target_hash[0], kmer_len), ti.u8)
+
+
+@ti.func
+def cal_ham_dist_uint64(hash1: ti.u64, hash2: ti.u64, kmer_len: int):
+    xor_result = hash1 ^ hash2
+    twobit_mask = ti.cast(3, ti.u64)
+    hamming_dist = 0
+    for _ in range(kmer_len):
+        cmp_res = xor_result & twobit_mask
+        hamming_dist += cmp_res != 0
+        xor_result >>= 2
+    return hamming_dist
+
+
+@ti.kernel
+def cal_ham_dist_kernel_uint64(hash_arr: ti.types.ndarray(dtype=ti.u64),
+                               target_hash: ti.types.ndarray(dtype=ti.u64),
+                               ham_dist_arr: ti.types.ndarray(dtype=ti.u8),
+                               hash_arr_size: int,
+                               kmer_len: int):
+    for i in range(hash_arr_size):
+        ham_dist_arr[i] = ti.cast(cal_ham_dist_uint64(hash_arr[i], target_hash[0], kmer_len), ti.u8)
+
+
+@ti.kernel
+def min_ham_dist_kernel_uint32(hash_arr: ti.types.ndarray(dtype=ti.u32),
+                               consensus_hash_arr: ti.types.ndarray(dtype=ti.u32),
+                               min_dist_arr: ti.types.ndarray(dtype=ti.u8),
+                               hash_arr_size: int, n_consensus: int, n_offset: int, kmer_len: int):
+    mask = ti.cast((1 << 2 * kmer_len) - 1, ti.u32)
+    for i in range(hash_arr_size):
+        min_dist = kmer_len
+        sub_hash = hash_arr[i]
+        for _ in range(n_offset):
+            for j in range(n_consensus):
+                min_dist = ti.min(min_dist, cal_ham_dist_uint32(sub_hash & mask, consensus_hash_arr[j], kmer_len))
+            sub_hash >>= 2
+        min_dist_arr[i] = ti.cast(min_dist, ti.u8)
+
+
+@ti.kernel
+def min_ham_dist_kernel_uint64(hash_arr: ti.types.ndarray(dtype=ti.u64),
+                               consensus_hash_arr: ti.types.ndarray(dtype=ti.u64),
+                               min_dist_arr: ti.types.ndarray(dtype=ti.u8),
+                               hash_arr_size: int, n_consensus: int, n_offset: int, kmer_len: int):
+    mask = ti.cast((1 << 2 * kmer_len) - 1, ti.u64)
+    for i in range(hash_arr_size):
+        min_dist = kmer_len
+        sub_hash = hash_arr[i]
+        for _ in range(n_offset):
+            for j in range(n_consensus):
+                min_dist = ti.min(min_dist, cal_ham_dist_uint64(sub_hash & mask, consensus_hash_arr[j], kmer_len))
+            sub_hash >>= 2
+        min_dist_arr[i] = ti.cast(min_dist, ti.u8)
+
+
+@ti.func
+def kmer2hash_taichi_uint32(arr: ti.types.ndarray(dtype=ti.u8), arr_size: int, st_pos: int, k: int,
+                            hash_arr: ti.types.ndarray(dtype=ti.u32),
+                            invalid_hash: ti.types.u32,
+                            missing_val: ti.types.u32):
+    # hash_arr[st_pos] = invalid_hash
+    invalid_hash_flag = 0
+    if st_pos + k >= arr_size:
+        invalid_hash_flag = 1
+
+    kh = ti.u32(0)
+    for i in range(k):
+        if arr[st_pos + i] == missing_val:
+            invalid_hash_flag = 1
+        kh = kh << 2
+        kh += arr[st_pos + i]
+    hash_arr[st_pos] = kh
+
+    if invalid_hash_flag > 0:
+        hash_arr[st_pos] = invalid_hash
+
+
+@ti.kernel
+def kmer2hash_kernel_uint32(arr: ti.types.ndarray(dtype=ti.u8), arr_size: int, k: int,
+                            hash_arr: ti.types.ndarray(dtype=ti.u32),
+                            invalid_hash_arr: ti.types.ndarray(dtype=ti.u32),
+                            missing_val_arr: ti.types.ndarray(dtype=ti.u8)):
+    for i in range(arr_size):
+        kmer2hash_taichi_uint32(arr, arr_size, i, k, hash_arr, invalid_hash_arr[0], missing_val_arr[0])
+
+
+@ti.func
+def kmer2hash_taichi_uint64(arr: ti.types.ndarray(dtype=ti.u8), arr_size: int, st_pos: int, k: int,
+                            hash_arr: ti.types.ndarray(dtype=ti.u64), invalid_hash: ti.u64,
+                            missing_val: ti.u8):
+    # hash_arr[st_pos] = invalid_hash
+    invalid_hash_flag = 0
+    if st_pos + k >= arr_size:
+        invalid_hash_flag = 1
+
+    kh = ti.u64(0)
+    for i in range(k):
+        if arr[st_pos + i] == missing_val:
+            invalid_hash_flag = 1
+        kh = kh << 2
+        kh += arr[st_pos + i]
+    hash_arr[st_pos] = kh
+
+    if invalid_hash_flag > 0:
+        hash_arr[st_pos] = invalid_hash
+
+
+@ti.kernel
+def kmer2hash_kernel_uint64(arr: ti.types.ndarray(dtype=ti.u8), arr_size: int, k: int,
+                            hash_arr: ti.types.ndarray(dtype=ti.u64),
+                            invalid_hash_arr: ti.types.ndarray(dtype=ti.u64),
+                            missing_val_arr: ti.types.ndarray(dtype=ti.u8)):
+    for i in range(arr_size):
+        kmer2hash_taichi_uint64(arr, arr_size, i, k, hash_arr, invalid_hash_arr[0], missing_val_arr[0])
+
+
+def kmer2hash(arr: np.ndarray, arr_size: int, kmer_len: int, hash_arr: np.ndarray, invalid_hash, missing_val):
+    hash_dtype = hash_arr.dtype.type
+    missing_val_arr = np.array([missing_val], dtype=np.uint8)
+    invalid_hash_arr = np.array([invalid_hash], dtype=hash_dtype)
+    if hash_dtype == np.uint32:
+        kmer2hash_kernel_uint32(arr, arr_size, kmer_len, hash_arr, invalid_hash_arr, missing_val_arr)
+    elif hash_dtype == np.uint64:
+        kmer2hash_kernel_uint64(arr, arr_size, kmer_len, hash_arr, invalid_hash_arr, missing_val_arr)
+    else:
+        raise Exception(f"Unknown kmer hash type hash_dtype={hash_dtype}")
+
+
+def hamming_dist(kh_arr: np.ndarray, consensus_kh_arr: np.ndarray, kmer_len: int, ham_dist_arr: np.ndarray):
+    hash_dtype = kh_arr.dtype.type
+    hash_arr_size = len(kh_arr)
+    if hash_dtype == np.uint32:
+        cal_ham_dist_kernel_uint32(kh_arr, consensus_kh_arr, ham_dist_arr, hash_arr_size, kmer_len)
+    elif hash_dtype == np.uint64:
+        cal_ham_dist_kernel_uint64(kh_arr, consensus_kh_arr, ham_dist_arr, hash_arr_size, kmer_len)
+    else:
+        raise Exception(f"Unknown kmer hash type hash_dtype={hash_dtype}")
+
+
+def min_hamming_dist(kh_arr: np.ndarray, kh_len: int, consensus_kh_arr: np.ndarray, kmer_len: int,
+                     min_dist_arr: np.ndarray):
+    hash_dtype = kh_arr.dtype.type
+    hash_arr_size = len(kh_arr)
+    n_offset = kh_len - kmer_len + 1
+    if hash_dtype == np.uint32:
+        min_ham_dist_kernel_uint32(kh_arr, consensus_kh_arr, min_dist_arr, hash_arr_size, len(consensus_kh_arr),
+                                   n_offset, kmer_len)
+    elif hash_dtype == np.uint64:
+        min_ham_dist_kernel_uint64(kh_arr, consensus_kh_arr, min_dist_arr, hash_arr_size, len(consensus_kh_arr),
+                                   n_offset, kmer_len)
+    else:
+        raise Exception(f"Unknown kmer hash type hash_dtype={hash_dtype}")
+
+
+def revcom_hash_arr(in_hash_arr: np.ndarray, mask_arr: np.ndarray, kmer_len: int, out_hash_arr: np.ndarray):
+    hash_dtype = in_hash_arr.dtype.type
+    hash_arr_size = len(in_hash_arr)
+    if hash_dtype == np.uint32:
+        revcom_hash_kernel_uint32(in_hash_arr, out_hash_arr, mask_arr, kmer_len, hash_arr_size)
+    elif hash_dtype == np.uint64:
+        revcom_hash_kernel_uint64(in_hash_arr, out_hash_arr, mask_arr, kmer_len, hash_arr_size)
+    else:
+        raise Exception(f"Unknown kmer hash type hash_dtype={hash_dtype}")
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Description: run_batch with worker processes that die, run by python -m pytest test_inimotif_cli.py
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import inimotif_cli
+
+
+def fake_run_dataset(dataset):
+    # a data set named "die*" kills its worker process like the OOM killer, the others are done
+    if dataset['identifier'].startswith('die'):
+        os._exit(1)
+    return {'identifier': dataset['identifier'], 'type': dataset['type'], 'out_dir': dataset['out_dir'],
+            'status': 'done', 'error': None, 'wall_time': 0.0}
+
+
+def gen_dataset_list(identifier_list, tmp_path):
+    return [{'type': 'chip', 'identifier': identifier, 'out_dir': str(tmp_path / identifier)}
+            for identifier in identifier_list]
+
+
+def check_res_list(res_list, dataset_list, tmp_path):
+    # every data set is reported once, the summary can be written. A data set in flight when a worker dies may fail
+    # with the dying one
+    assert [res['identifier'] for res in res_list] == [dataset['identifier'] for dataset in dataset_list]
+    for res in res_list:
+        if res['identifier'].startswith('die'):
+            assert res['status'] == 'failed'
+        else:
+            assert res['status'] == 'done' or res['error'] == 'worker process terminated abruptly'
+    inimotif_cli.write_summary(res_list, str(tmp_path / 'batch_summary.tsv'))
+
+
+def test_worker_dies(tmp_path, monkeypatch):
+    monkeypatch.setattr(inimotif_cli, 'run_dataset', fake_run_dataset)
+    dataset_list = gen_dataset_list(['a', 'die1', 'b', 'c', 'die2', 'd', 'e'], tmp_path)
+    res_list = inimotif_cli.run_batch(dataset_list, n_jobs=2)
+    check_res_list(res_list, dataset_list, tmp_path)
+
+
+def test_submit_to_broken_pool(tmp_path, monkeypatch):
+    # the pool breaks between two submissions, the data set not submitted runs in the next pool
+    monkeypatch.setattr(inimotif_cli, 'run_dataset', fake_run_dataset)
+    submit = ProcessPoolExecutor.submit
+    n_call = [0]
+
+    def broken_submit(self, *args, **kwargs):
+        n_call[0] += 1
+        if n_call[0] == 2:
+            raise BrokenProcessPool('pool broke before submission')
+        return submit(self, *args, **kwargs)
+
+    monkeypatch.setattr(ProcessPoolExecutor, 'submit', broken_submit)
+    dataset_list = gen_dataset_list(['a', 'b', 'c'], tmp_path)
+    res_list = inimotif_cli.run_batch(dataset_list, n_jobs=2)
+    check_res_list(res_list, dataset_list, tmp_path)
+    assert all(res['status'] == 'done' for res in res_list)
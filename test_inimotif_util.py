@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+Description: MaskPlan against the regular expressions of RepeatPattern, run by python -m pytest test_inimotif_util.py
+"""
+import random
+
+import pytest
+
+from inimotif_util import MaskPlan, RepeatPattern
+
+# units whose copies overlap (e.g. "AA" in "AAA", "ATA" in "ATATA") or do not overlap
+UNIT_LIST = ['A', 'AA', 'AAA', 'ATA', 'ACA', 'ATAT', 'AAT', 'AGGA', 'AT', 'CA', 'GATA', 'TTAGGG']
+
+
+@pytest.mark.parametrize('unit', UNIT_LIST)
+def test_mask_plan_same_as_repeat_pattern(unit):
+    rng = random.Random(unit)
+    for n_min_rep in (1, 2, 3):
+        for n_max_rep in (None, n_min_rep, n_min_rep + 1):
+            for revcom_flag in (True, False):
+                pat = RepeatPattern(unit, n_min_rep, revcom_flag, n_max_rep)
+                plan = MaskPlan([pat])
+                for _ in range(100):
+                    # small alphabets give long runs of the units
+                    alphabet = rng.choice(['ACGT', 'AT', 'AC', 'AAT', 'AG'])
+                    seq = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+                    assert plan.mask(seq) == pat.mask(seq), (unit, n_min_rep, n_max_rep, revcom_flag, seq)
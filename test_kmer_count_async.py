@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Description: reading of long input sequences in bounded batches, run by python -m pytest test_kmer_count_async.py
+"""
+import numpy as np
+
+import kmer_count_async as K
+
+
+def write_long_seq_file(file_name, n_seq=5, seq_len=100000, line_width=60):
+    rng = np.random.default_rng(0)
+    seq_list = [''.join(rng.choice(list('ACGT'), seq_len)) for _ in range(n_seq)]
+    with open(file_name, 'w') as fh:
+        for i, seq in enumerate(seq_list):
+            fh.write(f'>chr{i}\n')
+            fh.writelines(seq[st:st + line_width] + '\n' for st in range(0, len(seq), line_width))
+    return seq_list
+
+
+def test_piece_batches_bounded_by_bases(tmp_path):
+    file_name = str(tmp_path / 'genome.fa')
+    seq_list = write_long_seq_file(file_name)
+    max_piece_len, max_batch_bases = 1000, 4096
+    batch_list = list(K.read_seq_piece_batches(file_name, max_piece_len=max_piece_len,
+                                               max_batch_bases=max_batch_bases))
+    assert len(batch_list) > 1
+    for piece_list, _ in batch_list:
+        assert sum(len(piece) for piece in piece_list) < max_batch_bases + max_piece_len
+    # the pieces put back together are the input sequences
+    piece_list = [piece for batch in batch_list for piece in batch[0]]
+    cont_list = [cont for batch in batch_list for cont in batch[1]]
+    res_list = []
+    for piece, cont_flag in zip(piece_list, cont_list):
+        if cont_flag:
+            res_list[-1] += piece
+        else:
+            res_list.append(piece)
+    assert res_list == seq_list
+
+
+def test_convert_input_chunks_long_seqs(tmp_path):
+    # chunks much smaller than the sequences give the same kmer counts as a single chunk
+    file_name = str(tmp_path / 'genome.fa')
+    write_long_seq_file(file_name, n_seq=3, seq_len=20000)
+    res_list = []
+    for buffer_size in (2 ** 20, 4096):
+        out_dir = tmp_path / f'out_{buffer_size}'
+        K.convert_input_chunks(file_name, K.Buffer(buffer_size), out_dir=str(out_dir / 'chunks'))
+        res_list.append(K.count_chunk_multi_kmers([5, 12], str(out_dir), backend='numpy'))
+    for kmer_len in (5, 12):
+        (ref_kh_arr, ref_cnt_arr), (kh_arr, cnt_arr) = res_list[0][kmer_len], res_list[1][kmer_len]
+        assert np.array_equal(ref_kh_arr, kh_arr) and np.array_equal(ref_cnt_arr, cnt_arr)
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import numpy as np
+
 
 # an close_open integer window class, e.g. [0,3) => 0,1,2
 class Window:
@@ -403,5 +405,37 @@ def gen_full_win_list(forward_motif_pos_arr, revcom_motif_pos_arr, kmer_len_forw
     win_list, win_type_list = gen_full_win_list(forward_motif_pos_arr, revcom_motif_pos_arr, kmer_len, kmer_len, seq_len)
 
 
+def paint_intervals(st_arr, ed_arr, seq_len):
+    # boolean mask of the positions covered by the intervals [st, ed), a difference array summed up by cumsum
+    diff_arr = np.zeros(seq_len + 1, dtype=np.int32)
+    np.add.at(diff_arr, st_arr, 1)
+    np.add.at(diff_arr, ed_arr, -1)
+    return np.cumsum(diff_arr[:-1]) > 0
 
 
+def gen_label_win_list(pos_arr_list, kmer_len_list, seq_len):
+    """
+    Split sequence into consecutive regions labelled by the set of motifs covering them, any number of motifs
+    Input
+    pos_arr_list: start positions of the matches of each motif
+    kmer_len_list: length of each motif
+    seq_len: length of input sequence
+    Output
+    win_list: a list of consecutive regions, each element is a tuple in the form of (start pos, end pos)
+    label_list: bitmask of the motifs covering the corresponding regions in "win_list", bit i is set if motif i
+        covers the region, 0 - non motif region
+    """
+    assert len(pos_arr_list) <= 64, 'at most 64 motifs are supported'
+    if seq_len == 0:
+        return [], []
+    # per-base bitmask of covering motifs
+    label_arr = np.zeros(seq_len, dtype=np.uint64)
+    for i, (pos_arr, kmer_len) in enumerate(zip(pos_arr_list, kmer_len_list)):
+        pos_arr = np.asarray(pos_arr, dtype=np.int64)
+        if len(pos_arr) > 0:
+            label_arr[paint_intervals(pos_arr, pos_arr + kmer_len, seq_len)] |= np.uint64(1 << i)
+
+    # run-length encoding of the bitmask
+    st_arr = np.concatenate([[0], np.flatnonzero(label_arr[1:] != label_arr[:-1]) + 1])
+    ed_arr = np.append(st_arr[1:], seq_len)
+    return list(zip(st_arr.tolist(), ed_arr.tolist())), label_arr[st_arr].tolist()